@@ -1,14 +1,19 @@
 from utils.api_handler import api
-from utils.memory import memory
-from config import CONTENT_CREATOR_MODEL
+from utils.memory import memory as default_memory
+from config import CONTENT_CREATOR_MODEL, LONG_FORM_MAX_SECTIONS
+from utils.topics import format_topic_summary
 from utils.guidelines import EVALUATION_CRITERIA
 
 import logging
+import re
 
 logger = logging.getLogger(__name__)
 
+GENERATION_FAILED = "I apologize, but I couldn't generate content at this time. Please try again later."
+
 class ContentCreator:
-    def __init__(self):
+    def __init__(self, memory=None):
+        self.memory = memory or default_memory
         self.model = CONTENT_CREATOR_MODEL
         self.system_message = (
             "You are an expert content creator with extensive knowledge across various subjects and exceptional linguistic proficiency.\n\n"
@@ -44,26 +49,91 @@ class ContentCreator:
         self.feedback = None
 
         
-    def create_content(self, prompt):
+    def create_content(self, prompt, temperature=None, instruction=None):
         context = self._generate_context(prompt)
+        if instruction:
+            context += f"\n\nAdditional instruction for this draft: {instruction}"
+        params = {'temperature': temperature} if temperature is not None else {}
         messages = [
             {"role": "system", "content": self.system_message},
             {"role": "user", "content": context}
         ]
-        response = api.get_completion(self.model, messages)
+        response = api.get_completion(self.model, messages, agent="creator", tracker=self.memory.usage, tier=api.tier_for_round(self.memory.get_iteration_count()), **params)
         if response and 'choices' in response:
             return response['choices'][0]['message']['content']
         else:
-            return "I apologize, but I couldn't generate content at this time. Please try again later."
+            return GENERATION_FAILED
+
+
+    def create_outline(self, prompt, max_sections=LONG_FORM_MAX_SECTIONS):
+        context = (f"Plan a long-form document for the prompt below as an outline of at most {max_sections} sections, "
+                   "from introduction to conclusion, covering the evaluation criteria. Reply with the numbered outline only, "
+                   "one section per line, formatted as '1. Section title: one-sentence purpose of the section'.\n\n")
+        context += f"Evaluation Criteria: {', '.join(EVALUATION_CRITERIA.keys())}\n\n"
+        context += f"Prompt: {prompt}\n"
+        messages = [
+            {"role": "system", "content": self.system_message},
+            {"role": "user", "content": context}
+        ]
+        response = api.get_completion(self.model, messages, agent="creator", tracker=self.memory.usage, tier=api.tier_for_round(self.memory.get_iteration_count()))
+        if not response or 'choices' not in response:
+            return []
+        outline = []
+        for line in response['choices'][0]['message']['content'].split('\n'):
+            match = re.match(r'^\s*\d+[.)]\s*(?:\*\*)?(.+?)(?:\*\*)?\s*(?::\s*(.*))?$', line)
+            if match:
+                outline.append({'title': match.group(1).strip(' *'), 'brief': (match.group(2) or '').strip()})
+        return outline[:max_sections]
 
+    def create_section(self, prompt, outline, index, revision=None):
+        # Writes one section of a long-form document; revision holds the previous text and its feedback
+        context = ("You are writing ONE section of a longer document whose other sections are written separately. "
+                   "Write only the body of the section below in markdown, without its heading. Stay within the section's "
+                   "purpose and do not repeat material that belongs to other sections of the outline.\n\n")
+        context += f"Evaluation Criteria: {', '.join(EVALUATION_CRITERIA.keys())}\n\n"
+        context += f"Prompt: {prompt}\n\n"
+        context += "Document outline (> marks the section to write):\n"
+        for position, section in enumerate(outline):
+            context += f"{'>' if position == index else '-'} {section['title']}: {section['brief']}\n"
+        context += f"\nSection to write: {outline[index]['title']}\n"
+        if revision:
+            context += ("\nRevise the previous version of this section, addressing the feedback below.\n"
+                        f"Previous version:\n{revision['text']}\n\nFeedback for this section:\n{revision['feedback']}\n")
+        messages = [
+            {"role": "system", "content": self.system_message},
+            {"role": "user", "content": context}
+        ]
+        response = api.get_completion(self.model, messages, agent="creator", tracker=self.memory.usage, tier=api.tier_for_round(self.memory.get_iteration_count()))
+        if response and 'choices' in response:
+            return response['choices'][0]['message']['content']
+        return revision['text'] if revision else GENERATION_FAILED
 
     def _generate_context(self, prompt):
-        memory_context = memory.get_content_creator_context(EVALUATION_CRITERIA)
-        relevant_iterations = memory.get_relevant_iterations(prompt)
+        memory_context = self.memory.get_content_creator_context(EVALUATION_CRITERIA)
+        relevant_summaries = self.memory.get_relevant_summaries(prompt)
+        relevant_iterations = [] if relevant_summaries else self.memory.get_relevant_iterations(prompt)
+        last_feedback = memory_context.get('last_feedback', {})
 
-        context = f"Prompt: {prompt}\n\n"
+        # Stable instructions first, volatile context last, so consecutive requests share a prefix
+        if last_feedback:
+            context = ("Generate the content based on the prompt. Explicitly acknowledge the previous feedback "
+                       "and explain how you've incorporated it into your response. Your response should follow this structure:\n"
+                       "1. Acknowledgment of previous feedback\n"
+                       "2. Explanation of how you've incorporated the feedback\n"
+                       "3. New content incorporating the feedback\n"
+                       "Focus on improving based on the evaluation criteria and previous feedback.\n\n")
+        else:
+            context = ("Generate the content based on the prompt. Your response should follow this structure:\n"
+                       "1. New content addressing the prompt\n"
+                       "Focus on addressing the evaluation criteria.\n\n")
         context += f"Evaluation Criteria: {', '.join(EVALUATION_CRITERIA.keys())}\n\n"
+        context += f"Prompt: {prompt}\n\n"
         
+        if relevant_summaries:
+            context += "Relevant Topic Summaries:\n"
+            for summary in relevant_summaries:
+                context += format_topic_summary(summary) + "\n"
+
         if relevant_iterations:
             context += "Relevant Previous Iterations:\n"
             for iteration in relevant_iterations:
@@ -72,6 +142,13 @@ class ContentCreator:
                 context += f"User Evaluation: {str(iteration['user_evaluation_content'])[:200]}...\n"
                 context += f"Relevance Score: {iteration['relevance_score']}\n\n"
 
+        rejected_candidates = self.memory.get_rejected_candidates(prompt)
+        if rejected_candidates:
+            context += "Rejected Drafts (scored lower than the selected draft, avoid their weaknesses):\n"
+            for candidate in rejected_candidates:
+                context += f"Score {candidate['total_score']:.1f}: {candidate['content'][:200]}...\n"
+            context += "\n"
+
         last_content = memory_context.get('last_content', '')
         if last_content:
             context += f"Last Generated Content: {last_content[:200]}...\n\n"
@@ -80,7 +157,6 @@ class ContentCreator:
         if highest_scoring_content and highest_scoring_content != last_content:
             context += f"Highest Scoring Content: {highest_scoring_content[:200]}...\n\n"
         
-        last_feedback = memory_context.get('last_feedback', {})
         if last_feedback:
             context += "Last Feedback:\n"
             context += f"Overall Analysis: {last_feedback.get('overall_analysis', '')[:200]}...\n"
@@ -89,19 +165,8 @@ class ContentCreator:
                 context += f"- {criterion}: {feedback[:100]}...\n"
             context += "\n"
         
-        if last_feedback:
-            context += ("Generate the content based on the prompt. Explicitly acknowledge the previous feedback "
-                        "and explain how you've incorporated it into your response. Your response should follow this structure:\n"
-                        "1. Acknowledgment of previous feedback\n"
-                        "2. Explanation of how you've incorporated the feedback\n"
-                        "3. New content incorporating the feedback\n"
-                        "Focus on improving based on the evaluation criteria and previous feedback.")
-        else:
-            context += ("Generate the content based on the prompt. Your response should follow this structure:\n"
-                        "1. New content addressing the prompt\n"
-                        "Focus on addressing the evaluation criteria.")
         if user_evaluation_content := memory_context.get("user_evaluation_content", None):
             context += "User feedback for the content creator (IMPORTANT):\n"
             context += str(user_evaluation_content)
 
-        return context
\ No newline at end of file
+        return context
@@ -1,14 +1,20 @@
-from utils.memory import memory
+from utils.memory import memory as default_memory
 from utils.api_handler import api
-from utils.guidelines import EVALUATION_CRITERIA, get_evaluation_prompt
-from config import EVALUATOR_MODEL
+from utils.topics import format_topic_summary
+from utils.guidelines import EVALUATION_CRITERIA, EVALUATION_RUBRIC
+from utils.content_diff import diff_sections, section_title
+from config import EVALUATOR_MODEL, LOW_SCORE_THRESHOLD, INCREMENTAL_EVALUATION, INCREMENTAL_MAX_CHANGE_RATIO
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+CRITERION_FORMAT = ("For each criterion, write the criterion name alone on a line, followed by a 'Score:' line (1-10), "
+                    "an 'Explanation:' line and suggestions as lines starting with '-'.\n\n")
+
 class Evaluator:
-    def __init__(self):
+    def __init__(self, memory=None):
+        self.memory = memory or default_memory
         self.model = EVALUATOR_MODEL
         self.system_message = (
             "You are an expert content evaluator with extensive linguistic knowledge and a commitment to objectivity.\n\n"
@@ -40,7 +46,8 @@ class Evaluator:
             "- Acknowledge exceptional quality when warranted, without emotional bias\n"
             "- Utilize web search to complement your knowledge and verify content accuracy\n\n"
             "Your evaluation must be thorough, impartial, and aimed at content improvement while recognizing genuine achievements.\n"
-            "Avoid emotional language, maintaining a neutral, professional tone throughout."
+            "Avoid emotional language, maintaining a neutral, professional tone throughout.\n\n"
+            f"{EVALUATION_RUBRIC}"
         )
         self.feedback = None
         self.last_prompt = None
@@ -48,12 +55,17 @@ class Evaluator:
     
 
     def evaluate_content(self, content, prompt):
+        if INCREMENTAL_EVALUATION:
+            evaluation = self._evaluate_incrementally(content, prompt)
+            if evaluation:
+                return evaluation
+
         evaluation_prompt = self._generate_evaluation_prompt(content, prompt)
         messages = [
             {"role": "system", "content": self.system_message},
             {"role": "user", "content": evaluation_prompt}
         ]
-        response = api.get_completion(self.model, messages)
+        response = api.get_completion(self.model, messages, agent="evaluator", tracker=self.memory.usage, tier=api.tier_for_round(self.memory.get_iteration_count()))
         if response and 'choices' in response:
             evaluation = response['choices'][0]['message']['content']
             parsed_evaluation = self._parse_evaluation(evaluation)
@@ -63,13 +75,140 @@ class Evaluator:
         else:
             return {"Error": "I apologize, but I couldn't evaluate the content at this time. Please try again later."}
 
+    def _evaluate_incrementally(self, content, prompt):
+        previous = self.memory.get_recent_iterations(1)
+        if not previous or previous[0]['prompt'] != prompt:
+            return None
+        previous_evaluation = previous[0]['ai_evaluation']
+        if not self._has_scores(previous_evaluation):
+            return None
+
+        diff = diff_sections(previous[0]['content'], content)
+        if diff['change_ratio'] > INCREMENTAL_MAX_CHANGE_RATIO:
+            logger.info(f"{diff['change_ratio']:.0%} of the content changed, running a full evaluation")
+            return None
+
+        criteria = self._affected_criteria(previous_evaluation, diff)
+        logger.info(f"Incremental evaluation: {len(diff['changed_indices'])}/{len(diff['sections'])} sections changed, "
+                    f"re-evaluating {len(criteria)}/{len(EVALUATION_CRITERIA)} criteria")
+        parsed = {}
+        if criteria:
+            messages = [
+                {"role": "system", "content": self.system_message},
+                {"role": "user", "content": self._generate_incremental_prompt(prompt, previous_evaluation, diff, criteria)}
+            ]
+            response = api.get_completion(self.model, messages, agent="evaluator", tracker=self.memory.usage, tier=api.tier_for_round(self.memory.get_iteration_count()))
+            if not response or 'choices' not in response:
+                return None
+            parsed = self._parse_evaluation(response['choices'][0]['message']['content'])
+            if any(criterion not in parsed for criterion in criteria):
+                logger.info("Incremental evaluation did not cover every requested criterion, running a full evaluation")
+                return None
+
+        evaluation = {}
+        for criterion in EVALUATION_CRITERIA:
+            if criterion in criteria:
+                evaluation[criterion] = parsed[criterion]
+            else:
+                evaluation[criterion] = {**previous_evaluation[criterion], 'carried_over': True}
+        return evaluation
+
+    def _has_scores(self, evaluation):
+        if not isinstance(evaluation, dict):
+            return False
+        for criterion in EVALUATION_CRITERIA:
+            details = evaluation.get(criterion)
+            if not isinstance(details, dict) or not isinstance(details.get('score'), (int, float)):
+                return False
+        return True
+
+    def _affected_criteria(self, previous_evaluation, diff):
+        if not diff['changed_indices']:
+            return []
+        affected = []
+        for criterion, details in EVALUATION_CRITERIA.items():
+            weak = previous_evaluation[criterion]['score'] < LOW_SCORE_THRESHOLD
+            scope = details.get('scope', 'document')
+            if weak or scope == 'section' or (scope == 'document' and diff['structural_change']):
+                affected.append(criterion)
+        return affected
+
+    def _generate_incremental_prompt(self, prompt, previous_evaluation, diff, criteria):
+        changed = set(diff['changed_indices'])
+        evaluation_prompt = ("This is a revision of content you evaluated previously. Only the sections listed under "
+                             "'Changed Sections' were modified; every other section is unchanged since your last evaluation.\n"
+                             "Re-evaluate ONLY the criteria listed below, judging the document as a whole but focusing on the changed sections.\n"
+                             + CRITERION_FORMAT)
+        evaluation_prompt += f"Objective: {prompt}\n\n"
+
+        evaluation_prompt += "Criteria to re-evaluate (with your previous assessment):\n"
+        for criterion in criteria:
+            details = previous_evaluation[criterion]
+            evaluation_prompt += f"{criterion}\nPrevious score: {details['score']}\nPrevious explanation: {details.get('explanation', '')}\n\n"
+
+        evaluation_prompt += "Document outline (* marks changed sections):\n"
+        for index, section in enumerate(diff['sections']):
+            evaluation_prompt += f"{'*' if index in changed else '-'} {section_title(section)}\n"
+
+        evaluation_prompt += "\nChanged Sections:\n\n"
+        evaluation_prompt += "\n\n".join(diff['sections'][index] for index in diff['changed_indices'])
+
+        return evaluation_prompt
+
+
+    def evaluate_section(self, prompt, outline, index, text):
+        # Scores one section of a long-form document on the section-scoped criteria
+        criteria = [criterion for criterion, details in EVALUATION_CRITERIA.items() if details.get('scope') == 'section']
+        evaluation_prompt = ("You are evaluating ONE section of a longer document; the other sections are evaluated separately. "
+                             "Judge only this section against its purpose in the outline.\n" + CRITERION_FORMAT)
+        evaluation_prompt += f"Criteria: {', '.join(criteria)}\n\n"
+        evaluation_prompt += f"Objective: {prompt}\n\n"
+        evaluation_prompt += "Document outline (> marks this section):\n"
+        for position, section in enumerate(outline):
+            evaluation_prompt += f"{'>' if position == index else '-'} {section['title']}: {section['brief']}\n"
+        evaluation_prompt += f"\nSection to evaluate:\n\n## {outline[index]['title']}\n\n{text}"
+        return self._evaluate_criteria(criteria, evaluation_prompt)
+
+    def evaluate_document_scope(self, prompt, outline, previews):
+        # Scores the document-scoped criteria on the outline and the opening of each section
+        criteria = [criterion for criterion, details in EVALUATION_CRITERIA.items() if details.get('scope') == 'document']
+        evaluation_prompt = ("You are evaluating the overall design of a long document from its outline and the opening of "
+                             "each section; the sections' detailed content is evaluated separately.\n" + CRITERION_FORMAT)
+        evaluation_prompt += f"Criteria: {', '.join(criteria)}\n\n"
+        evaluation_prompt += f"Objective: {prompt}\n\n"
+        for section, preview in zip(outline, previews):
+            evaluation_prompt += f"## {section['title']}\n{preview}...\n\n"
+        return self._evaluate_criteria(criteria, evaluation_prompt)
+
+    def _evaluate_criteria(self, criteria, evaluation_prompt):
+        messages = [
+            {"role": "system", "content": self.system_message},
+            {"role": "user", "content": evaluation_prompt}
+        ]
+        response = api.get_completion(self.model, messages, agent="evaluator", tracker=self.memory.usage, tier=api.tier_for_round(self.memory.get_iteration_count()))
+        if not response or 'choices' not in response:
+            return {}
+        parsed = self._parse_evaluation(response['choices'][0]['message']['content'])
+        return {criterion: parsed[criterion] for criterion in criteria if criterion in parsed}
 
     def _generate_evaluation_prompt(self, content, prompt):
-        memory_context = memory.get_evaluator_context(EVALUATION_CRITERIA)
-        relevant_iterations = memory.get_relevant_iterations(prompt)
+        memory_context = self.memory.get_evaluator_context(EVALUATION_CRITERIA)
+        relevant_summaries = self.memory.get_relevant_summaries(prompt)
+        relevant_iterations = [] if relevant_summaries else self.memory.get_relevant_iterations(prompt)
+
+        # Stable instructions first, volatile context last, so consecutive requests share a prefix
+        evaluation_prompt = ("Please evaluate the content based on the given criteria. Your evaluation should follow this structure:\n"
+                             "1. Acknowledgment of previous feedback and relevant iterations\n"
+                             "2. Explanation of how you've incorporated the feedback and relevant information into your evaluation process\n"
+                             "3. Detailed evaluation of the content, addressing each criterion\n"
+                             "Focus on providing constructive and actionable feedback, and explain any changes in your evaluation approach based on previous feedback and relevant iterations.\n\n")
+        evaluation_prompt += f"Evaluation Criteria: {', '.join(EVALUATION_CRITERIA.keys())}\n\n"
+        evaluation_prompt += f"Objective: {prompt}\n\n"
 
-        evaluation_prompt = get_evaluation_prompt(content, prompt)
-        evaluation_prompt += f"\n\nEvaluation Criteria: {', '.join(EVALUATION_CRITERIA.keys())}\n\n"
+        if relevant_summaries:
+            evaluation_prompt += "Relevant Topic Summaries:\n"
+            for summary in relevant_summaries:
+                evaluation_prompt += format_topic_summary(summary) + "\n"
 
         if relevant_iterations:
             evaluation_prompt += "Relevant Previous Iterations:\n"
@@ -96,16 +235,12 @@ class Evaluator:
             evaluation_prompt += "Last Feedback for Evaluator:\n"
             evaluation_prompt += f"Overall Analysis: {last_feedback.get('overall_analysis', '')[:200]}...\n"
             evaluation_prompt += "Specific Feedback for Evaluator:\n"
-            evaluation_prompt += str(last_feedback.get('evaluator_feedback', ""))
+            evaluation_prompt += str(last_feedback.get('evaluator_feedback', "")) + "\n\n"
         if user_feedback_evaluator := memory_context.get("user_feedback_evaluator", None):
             evaluation_prompt += "User feedback for the evaluator (IMPORTANT):\n"
-            evaluation_prompt += str(user_feedback_evaluator)
+            evaluation_prompt += str(user_feedback_evaluator) + "\n\n"
 
-        evaluation_prompt += ("\nPlease evaluate the content based on the given criteria. Your evaluation should follow this structure:\n"
-                              "1. Acknowledgment of previous feedback and relevant iterations\n"
-                              "2. Explanation of how you've incorporated the feedback and relevant information into your evaluation process\n"
-                              "3. Detailed evaluation of the content, addressing each criterion\n"
-                              "Focus on providing constructive and actionable feedback, and explain any changes in your evaluation approach based on previous feedback and relevant iterations.")
+        evaluation_prompt += f"Content to evaluate:\n\n{content}"
 
         return evaluation_prompt
     
@@ -1,37 +1,103 @@
 from utils.api_handler import api
-from config import FEEDBACK_MODEL
+from config import FEEDBACK_MODEL, LOCAL_ITERATE_DECISION, FEEDBACK_GATING, LOW_SCORE_THRESHOLD
+from utils.topics import format_topic_summary
 from utils.guidelines import EVALUATION_CRITERIA
-from utils.memory import memory
+from utils.memory import memory as default_memory
+from utils.feedback_parser import parse_feedback
+from utils.calibration import local_verdict_feedback
+from utils.feedback_gate import gate_decision, local_feedback, gate_stats, SKIP, DELTA, FULL
 
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
 class FeedbackAgent:
-    def __init__(self):
+    def __init__(self, memory=None):
+        self.memory = memory or default_memory
         self.model = FEEDBACK_MODEL
         self.system_message = (
             "You are an AI improvement specialist with expertise in content creation, evaluation, and system optimization. "
             "Your goal is to provide insightful analysis and actionable feedback to enhance AI performance."
         )
+        self.analysis_instructions = f"""
+        Provide a comprehensive analysis and actionable feedback for the interaction given below, in the following structure in markdown: 
+        
+        ### [###Overall Analysis###]
+        (Provide a brief overall analysis of the interaction, including major discrepancies between AI and user evaluations, and how it compares to relevant previous iterations)
+        
+        ### [###Feedback for Content Creator###]
+        (Under the 'Feedback for Content Creator section': For each criterion - and based on the AI and user evaluations, provide /10 rating as well as specific, actionable feedback for the content creator. If no improvement is needed, explicitly state why. Consider the performance in relevant previous iterations when providing feedback.)
+        
+        ### [###Feedback for Evaluator###]
+        (Provide specific, actionable feedback for the evaluator based on the user's feedback and your analysis. If no improvement is needed, explicitly state why. Consider the evaluator's performance in relevant previous iterations.)
+        
+        ### [###Improvements Needed###]
+        (Explicitly state 'YES' if improvements are needed, or 'NO' if no improvements are necessary. Provide a brief explanation for your decision.)
+        Note: Consider improvements necessary until the content rating is 10/10 across all criteria and both the user and evaluator are in full agreement. However, use your judgment to assess the overall quality and progress.
+        
+        Ensure you address all of the following criteria in the Content Creator section:
+        {', '.join(EVALUATION_CRITERIA.keys())} and include details on how you used the context of recent iterations and relevant previous iterations in your assessment and feedback.
 
-    def analyze_interaction(self, recent_iterations, prompt, content, evaluation, user_eval_content, user_feedback_evaluator):
-        relevant_iterations = memory.get_relevant_iterations(prompt)
+        For each criterion, provide at least one specific suggestion for improvement or explicitly state why no improvement is needed.
+        """
+        self.delta_instructions = """
+        All other criteria already meet the quality threshold and the user and evaluator agree on them. Provide concise, actionable feedback only for the weak criteria listed below, in the following structure in markdown:
+
+        ### [###Overall Analysis###]
+        (One or two sentences on why these criteria fall short)
+
+        ### [###Feedback for Content Creator###]
+        (For each weak criterion: a /10 rating and specific, actionable changes)
+
+        ### [###Feedback for Evaluator###]
+        (Only if the evaluator's scores for these criteria differ from the user's; otherwise state that none is needed)
+
+        ### [###Improvements Needed###]
+        (State 'YES' or 'NO' with a one-sentence explanation)
+        """
 
-        feedback_prompt = self._generate_feedback_prompt(recent_iterations, relevant_iterations, prompt, content, evaluation, user_eval_content, user_feedback_evaluator)
+    def analyze_interaction(self, recent_iterations, prompt, content, evaluation, user_eval_content, user_feedback_evaluator):
+        verdict = self.memory.calibration.decide(evaluation, user_eval_content.score) if LOCAL_ITERATE_DECISION else None
+        if verdict is False:
+            logger.info("Calibrated scores are conclusive, skipping the feedback agent call")
+            gate_stats.record(SKIP)
+            return local_verdict_feedback(self.memory.calibration.calibrate(evaluation), user_eval_content.score)
+
+        mode, weak_criteria = gate_decision(evaluation, user_eval_content.score) if FEEDBACK_GATING else (FULL, [])
+        if mode == SKIP:
+            logger.info("All criteria meet the threshold and the raters agree, skipping the feedback agent call")
+            gate_stats.record(SKIP)
+            return local_feedback(evaluation, user_eval_content)
+
+        if mode == DELTA:
+            logger.info(f"Requesting delta feedback for {len(weak_criteria)} weak criteria")
+            feedback_prompt = self._generate_delta_prompt(prompt, content, evaluation, user_eval_content, user_feedback_evaluator, weak_criteria)
+        else:
+            relevant_summaries = self.memory.get_relevant_summaries(prompt)
+            relevant_iterations = [] if relevant_summaries else self.memory.get_relevant_iterations(prompt)
+            feedback_prompt = self._generate_feedback_prompt(recent_iterations, relevant_iterations, relevant_summaries, prompt, content, evaluation, user_eval_content, user_feedback_evaluator)
 
         messages = [
             {"role": "system", "content": self.system_message},
             {"role": "user", "content": feedback_prompt}
         ]
 
-        response = api.get_completion(self.model, messages)
+        start = time.perf_counter()
+        response = api.get_completion(self.model, messages, agent="feedback", tracker=self.memory.usage)
+        gate_stats.record(mode, time.perf_counter() - start)
         if response and 'choices' in response:
-            feedback = response['choices'][0]['message']['content'].strip()
-            return self._parse_feedback(feedback)
+            feedback = self._parse_feedback(response['choices'][0]['message']['content'].strip())
+            if verdict and not feedback.get('needs_improvement'):
+                # Shown to the user, so it must not contradict the verdict
+                feedback['needs_improvement'] = True
+                feedback['improvements_needed'] = (
+                    f"YES. At least one criterion scores below {LOW_SCORE_THRESHOLD}/10 for both raters (decided locally "
+                    f"from the evaluator calibration). The feedback agent had answered: {feedback.get('improvements_needed', '')}")
+            return feedback
         return None
 
-    def _generate_feedback_prompt(self, recent_iterations, relevant_iterations, prompt, content, evaluation, user_eval_content, user_feedback_evaluator):
+    def _generate_feedback_prompt(self, recent_iterations, relevant_iterations, relevant_summaries, prompt, content, evaluation, user_eval_content, user_feedback_evaluator):
         context = "\n".join([f"Iteration {i}: {iter['content'][:100]}..." for i, iter in enumerate(recent_iterations)])
 
         relevant_context = "\n".join([
@@ -40,9 +106,10 @@ class FeedbackAgent:
             f"AI Evaluation: {str(iter['ai_evaluation'])[:100]}...\n"
             f"User Evaluation: {str(iter['user_evaluation_content'])[:100]}..."
             for iter in relevant_iterations
-        ])
+        ] + [format_topic_summary(summary) for summary in relevant_summaries])
 
-        return f"""
+        # Stable instructions first, volatile context last, so consecutive requests share a prefix
+        return f"""{self.analysis_instructions}
         Analyze the following interaction:
 
         Context of recent iterations:
@@ -57,62 +124,30 @@ class FeedbackAgent:
         AI Evaluation: {evaluation}
         User Evaluation for Content: {user_eval_content}
         User Feedback for Evaluator: {user_feedback_evaluator}
+        """
 
-        Provide a comprehensive analysis and actionable feedback in the following structure in markdown: 
-        
-        ### [###Overall Analysis###]
-        (Provide a brief overall analysis of the interaction, including major discrepancies between AI and user evaluations, and how it compares to relevant previous iterations)
-        
-        ### [###Feedback for Content Creator###]
-        (Under the 'Feedback for Content Creator section': For each criterion - and based on the AI and user evaluations, provide /10 rating as well as specific, actionable feedback for the content creator. If no improvement is needed, explicitly state why. Consider the performance in relevant previous iterations when providing feedback.)
-        
-        ### [###Feedback for Evaluator###]
-        (Provide specific, actionable feedback for the evaluator based on the user's feedback and your analysis. If no improvement is needed, explicitly state why. Consider the evaluator's performance in relevant previous iterations.)
-        
-        ### [###Improvements Needed###]
-        (Explicitly state 'YES' if improvements are needed, or 'NO' if no improvements are necessary. Provide a brief explanation for your decision.)
-        Note: Consider improvements necessary until the content rating is 10/10 across all criteria and both the user and evaluator are in full agreement. However, use your judgment to assess the overall quality and progress.
-        
-        Ensure you address all of the following criteria in the Content Creator section:
-        {', '.join(EVALUATION_CRITERIA.keys())} and include details on how you used the context of recent iterations and relevant previous iterations in your assessment and feedback.
-
-        For each criterion, provide at least one specific suggestion for improvement or explicitly state why no improvement is needed.
+    def _generate_delta_prompt(self, prompt, content, evaluation, user_eval_content, user_feedback_evaluator, weak_criteria):
+        weak_context = ""
+        for criterion in weak_criteria:
+            details = evaluation.get(criterion, {})
+            weak_context += (f"- {criterion}: AI score {details.get('score')}, user score {user_eval_content.score.get(criterion)}\n"
+                             f"  AI explanation: {details.get('explanation', '')}\n"
+                             f"  User feedback: {(user_eval_content.feedback or {}).get(criterion, '')}\n")
+
+        # Stable instructions first, volatile context last, so consecutive requests share a prefix
+        return f"""{self.delta_instructions}
+        Weak criteria:
+        {weak_context}
+        Original Prompt: {prompt}
+        Generated Content: {content}
+        User Feedback for Evaluator: {user_feedback_evaluator}
         """
 
     def _parse_feedback(self, feedback):
-        sections = feedback.split('###')
-        parsed_feedback = {
-            'improvements_needed': '',
-            'everything': '',
-        }
-
-        for section in sections:
-            section = section.strip()
-            if section:
-                lines = section.split('\n', 1)
-                if len(lines) > 1:
-                    header, content = lines
-                    header = header.lower().strip()
-                    content = content.strip()
-
-                    if 'improvements needed' in header:
-                        parsed_feedback['improvements_needed'] = content
-                    else:
-                        parsed_feedback['everything'] += f"### {header.capitalize()}\n{content}\n\n"
-
-        # Removing "Improvements Needed" section from 'everything'
-        parsed_feedback['everything'] = parsed_feedback['everything'].replace(f"### Improvements Needed\n{parsed_feedback['improvements_needed']}\n\n", "")
-
-        return parsed_feedback
+        return parse_feedback(feedback).to_dict()
 
     def incorporate_user_feedback(self, previous_feedback, additional_feedback):
         incorporation_prompt = f"""
-        Previous analysis:
-        {previous_feedback.get('overall_analysis', '')}
-
-        Additional user feedback:
-        {additional_feedback}
-
         Please incorporate the additional user feedback into your previous analysis and feedback. Update your recommendations for both the content creator and evaluator based on this new information.
 
         Provide your updated feedback in the following structure:
@@ -128,6 +163,12 @@ class FeedbackAgent:
         
         ### [###Improvements Needed###]
         (State 'YES' or 'NO', and provide a brief explanation for your decision, considering the additional feedback)
+
+        Previous analysis:
+        {previous_feedback.get('overall_analysis', '')}
+
+        Additional user feedback:
+        {additional_feedback}
         """
 
         messages = [
@@ -135,7 +176,7 @@ class FeedbackAgent:
             {"role": "user", "content": incorporation_prompt}
         ]
 
-        response = api.get_completion(self.model, messages)
+        response = api.get_completion(self.model, messages, agent="feedback", tracker=self.memory.usage)
         if response and 'choices' in response:
             updated_feedback = response['choices'][0]['message']['content']
             return self._parse_feedback(updated_feedback)
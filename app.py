@@ -7,6 +7,11 @@ from models.evaluation import UserEvaluation
 from utils.memory import memory
 from utils.guidelines import EVALUATION_CRITERIA
 from agents.feedback_agent import FeedbackAgent
+from utils.usage import usage
+from utils.feedback_parser import needs_improvement
+from utils.profiler import profiler
+from utils.scheduler import request_context, REFINEMENT
+from config import PROFILING, PROFILE_OUTPUT
 import traceback
 
 # Initialize session state variables
@@ -71,6 +76,25 @@ st.title("Instructo", anchor="center")
 
 # Sidebar
 st.sidebar.header(f"Current Iteration: {st.session_state.iteration_count}")
+usage_snapshot = usage.snapshot()
+st.sidebar.metric("Session Tokens", usage_snapshot['total']['total_tokens'])
+st.sidebar.metric("Session Cost ($)", f"{usage_snapshot['total']['cost']:.4f}")
+with st.sidebar.expander("Usage by Agent"):
+    for agent_name, totals in usage_snapshot['by_agent'].items():
+        st.write(f"{agent_name}: {totals['total_tokens']} tokens, ${totals['cost']:.4f}")
+if usage.budget_exceeded():
+    st.sidebar.warning(f"Session budget exceeded (action: {usage.action}).")
+# The profiler samples the whole server process, so it covers every open session
+if st.sidebar.checkbox("Profile", value=PROFILING, help="Sample the app and write flamegraph and summary files"):
+    if not profiler.running:
+        profiler.start()
+    if st.sidebar.button("Write profile"):
+        st.session_state.profile_paths = profiler.write(PROFILE_OUTPUT)
+elif profiler.running:
+    profiler.stop()
+    st.session_state.profile_paths = profiler.write(PROFILE_OUTPUT)
+if st.session_state.get('profile_paths'):
+    st.sidebar.caption("Profile: " + ", ".join(st.session_state.profile_paths.values()))
 
 # User Input Section (Prompt)
 st.header("User Input")
@@ -81,10 +105,16 @@ if new_prompt != st.session_state.prompt:
     st.session_state.iteration_count = 0
     st.session_state.stage = "generate"
 
+def round_context():
+    # Rounds after the first are refinement traffic for the scheduler
+    return request_context(REFINEMENT if st.session_state.iteration_count else None)
+
 if st.button("Generate Content") or st.session_state.stage == "generate":
-    with st.spinner("Generating content..."):
-        st.session_state.content = creator.create_content(st.session_state.prompt)
-        st.session_state.evaluation = evaluator.evaluate_content(st.session_state.content, st.session_state.prompt)
+    with st.spinner("Generating content..."), round_context():
+        with profiler.stage('create'):
+            st.session_state.content = creator.create_content(st.session_state.prompt)
+        with profiler.stage('evaluate'):
+            st.session_state.evaluation = evaluator.evaluate_content(st.session_state.content, st.session_state.prompt)
     st.session_state.stage = "user_eval"
     st.experimental_rerun()
 
@@ -133,10 +163,13 @@ with col2:
         st.markdown('<div class="section-container">', unsafe_allow_html=True)
         st.subheader("AI Evaluation")
         if st.session_state.evaluation:
+            calibrated = memory.calibration.calibrate(st.session_state.evaluation)
             for criterion, details in st.session_state.evaluation.items():
                 with st.expander(criterion):
                     if isinstance(details, dict):
                         st.write(f"Score: {details['score']}")
+                        if calibrated.get(criterion) is not None:
+                            st.write(f"Calibrated score (expected user score): {calibrated[criterion]:.1f}")
                         st.write(f"Explanation: {details['explanation']}")
                         if details['suggestions']:
                             st.write("Suggestions:")
@@ -155,7 +188,7 @@ with col2:
         
         # Feedback Agent Section
         if st.session_state.stage == "generate_feedback":
-            with st.spinner("Generating feedback..."):
+            with st.spinner("Generating feedback..."), profiler.stage('feedback'), round_context():
                 recent_iterations = memory.get_recent_iterations(5)
                 st.session_state.feedback = feedback_agent.analyze_interaction(
                     recent_iterations,
@@ -179,8 +212,7 @@ with col2:
             decision = st.radio("What would you like to do?", ["Continue", "Disagree", "New", "Quit"])
             if st.button("Confirm"):
                 if decision == "Continue":
-                    improvements_needed = st.session_state.feedback.get('improvements_needed', '').strip().upper().startswith('YES')
-                    if improvements_needed:
+                    if needs_improvement(st.session_state.feedback):
                         st.session_state.iteration_count += 1
                         st.session_state.stage = "generate"
                         # Clear content, evaluation, and feedback for the new iteration
@@ -212,7 +244,7 @@ if st.session_state.stage == "disagree":
     st.header("Provide Additional Feedback")
     additional_feedback = st.text_area("Enter your additional feedback:", height=150)
     if st.button("Submit Additional Feedback"):
-        with st.spinner("Incorporating additional feedback..."):
+        with st.spinner("Incorporating additional feedback..."), profiler.stage('feedback'), round_context():
             st.session_state.feedback = feedback_agent.incorporate_user_feedback(st.session_state.feedback, additional_feedback)
         st.success("Feedback updated!")
         st.session_state.stage = "iteration_control"
@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+import random
+import re
+import time
+from utils.feedback_parser import parse_feedback
+
+# Checks the feedback parser against a corpus of feedback agent outputs, fuzzes it
+# with mutated variants and compares its speed with the previous split/replace parser.
+# Run from the repository root: python -m benchmarks.feedback_parser
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), 'feedback_corpus.jsonl')
+
+
+def legacy_parse(feedback):
+    sections = feedback.split('###')
+    parsed_feedback = {'improvements_needed': '', 'everything': ''}
+    for section in sections:
+        section = section.strip()
+        if section:
+            lines = section.split('\n', 1)
+            if len(lines) > 1:
+                header, content = lines
+                header = header.lower().strip()
+                content = content.strip()
+                if 'improvements needed' in header:
+                    parsed_feedback['improvements_needed'] = content
+                else:
+                    parsed_feedback['everything'] += f"### {header.capitalize()}\n{content}\n\n"
+    parsed_feedback['everything'] = parsed_feedback['everything'].replace(
+        f"### Improvements Needed\n{parsed_feedback['improvements_needed']}\n\n", "")
+    return parsed_feedback
+
+
+def load_corpus(path):
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def check_corpus(corpus):
+    failures = 0
+    legacy_correct = 0
+    for sample in corpus:
+        analysis = parse_feedback(sample['text'])
+        expected = sample['expected']
+        ratings = sum(1 for item in analysis.content_creator_feedback.values() if item.rating is not None)
+        actual = {'needs_improvement': analysis.needs_improvement,
+                  'criteria': len(analysis.content_creator_feedback), 'ratings': ratings}
+        if actual != expected:
+            failures += 1
+            print(f"FAIL {sample['name']}: expected {expected}, got {actual}")
+        legacy_verdict = legacy_parse(sample['text'])['improvements_needed'].strip().upper().startswith('YES')
+        legacy_correct += legacy_verdict == expected['needs_improvement']
+    print(f"Corpus: {len(corpus) - failures}/{len(corpus)} samples parsed as expected "
+          f"(previous parser verdict correct on {legacy_correct}/{len(corpus)})")
+    return failures
+
+
+def mutate(text, rng):
+    lines = text.splitlines()
+    mutation = rng.choice(['truncate', 'drop_line', 'duplicate_line', 'shuffle_blocks', 'restyle_headings',
+                           'noise', 'crlf', 'strip_markup'])
+    if mutation == 'truncate':
+        return text[:rng.randint(0, len(text))]
+    if mutation == 'drop_line' and lines:
+        del lines[rng.randrange(len(lines))]
+    elif mutation == 'duplicate_line' and lines:
+        index = rng.randrange(len(lines))
+        lines.insert(index, lines[index])
+    elif mutation == 'shuffle_blocks':
+        blocks = text.split('\n\n')
+        rng.shuffle(blocks)
+        return '\n\n'.join(blocks)
+    elif mutation == 'restyle_headings':
+        style = rng.choice(['## {}', '**{}**', '{}:', '# [###{}###]', '### {} ###'])
+        return re.sub(r'^#*\s*\[?#*([A-Z][A-Za-z ]+?)#*\]?\s*$', lambda m: style.format(m.group(1)), text, flags=re.M)
+    elif mutation == 'noise':
+        index = rng.randrange(len(text) + 1)
+        return text[:index] + ''.join(rng.choice('#[]*:/\n 0123456789abcYESNO') for _ in range(rng.randint(1, 40))) + text[index:]
+    elif mutation == 'crlf':
+        return text.replace('\n', '\r\n')
+    elif mutation == 'strip_markup':
+        return re.sub(r'[#\[\]*]', '', text)
+    return '\n'.join(lines)
+
+
+def fuzz(corpus, iterations, seed):
+    rng = random.Random(seed)
+    errors = 0
+    for _ in range(iterations):
+        text = rng.choice(corpus)['text']
+        for _ in range(rng.randint(1, 3)):
+            text = mutate(text, rng)
+        try:
+            analysis = parse_feedback(text)
+            assert isinstance(analysis.needs_improvement, bool)
+            for item in analysis.content_creator_feedback.values():
+                assert item.rating is None or 0 <= item.rating
+            json.dumps(analysis.to_dict())
+        except Exception as e:
+            errors += 1
+            if errors <= 5:
+                print(f"Fuzz error {type(e).__name__}: {e}\n{text[:300]!r}")
+    print(f"Fuzz: {iterations} mutated inputs, {errors} errors")
+    return errors
+
+
+def benchmark(corpus, repeat):
+    texts = [sample['text'] for sample in corpus]
+    for name, parse in (('previous parser', legacy_parse), ('section parser', parse_feedback)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for text in texts:
+                parse(text)
+        elapsed = time.perf_counter() - start
+        print(f"{name:16} {elapsed / (repeat * len(texts)) * 1e6:8.1f} us per parse")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check, fuzz and benchmark the feedback parser.")
+    parser.add_argument('--corpus', default=CORPUS_PATH)
+    parser.add_argument('--fuzz', type=int, default=2000, help="Number of mutated inputs")
+    parser.add_argument('--repeat', type=int, default=200, help="Benchmark passes over the corpus")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    failures = check_corpus(corpus)
+    failures += fuzz(corpus, args.fuzz, args.seed)
+    benchmark(corpus, args.repeat)
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import argparse
+import json
+import shutil
+import tempfile
+import threading
+import time
+from utils.storage import SQLiteStorage, PostgresStorage
+
+# Runs the same checks against every storage backend: the SQLite one, the Postgres one on
+# its SQLite emulation and, with --dsn, the Postgres one on a real server. Also times
+# inserts and reads from several threads sharing the connection pool.
+# Run from the repository root: python -m benchmarks.storage_backends
+
+
+def iteration_values(index, session_id='bench'):
+    return {
+        'session_id': session_id, 'timestamp': f"2024-01-01T00:00:{index:05d}", 'prompt': f"prompt {index % 10}",
+        'content': f"content {index}", 'ai_evaluation': json.dumps({'Clarity': {'score': index % 10}}),
+        'user_evaluation_content': json.dumps({'score': {'Clarity': (index + 1) % 10}, 'feedback': {}}),
+        'user_feedback_evaluator': '', 'feedback_agent_analysis': json.dumps({'needs_improvement': True}),
+        'total_score': float(index % 10), 'embedding': json.dumps([0.0, 1.0]), 'usage': json.dumps({'calls': 1}),
+        'content_hash': f"hash-{index}",
+    }
+
+
+def check(storage):
+    failures = []
+    storage.init_schema()
+    storage.init_schema()  # idempotent
+    first = storage.insert_iteration(iteration_values(0))
+    second = storage.insert_iteration(iteration_values(1))
+    storage.insert_iteration({**iteration_values(2), 'kind': 'rejected'})
+    expectations = [
+        ('insert returns increasing ids', second > first),
+        ('find_iteration', storage.find_iteration('hash-1', '2024-01-01T00:00:00001') == second),
+        ('iteration_texts skips rejected rows', [row_id for row_id, _ in storage.iteration_texts()] == [first, second]),
+        ('iteration_texts by id', storage.iteration_texts([second]) == [(second, 'content 1')]),
+        ('iterations_by_id decodes JSON', storage.iterations_by_id([first])[first]['ai_evaluation'] == {'Clarity': {'score': 0}}),
+        ('rejected_candidates', [row['content'] for row in storage.rejected_candidates('bench', 'prompt 2', 5)] == ['content 2']),
+        ('usage_rows', storage.usage_rows('bench') == [{'calls': 1}] * 3),
+        ('stream_iterations chunks', [len(chunk) for chunk in storage.stream_iterations(('id',), 2)] == [2, 1]),
+    ]
+    for name, passed in expectations:
+        if not passed:
+            failures.append(name)
+            print(f"  FAIL {name}")
+    return failures
+
+
+def benchmark(storage, rows, threads):
+    def insert(offset):
+        for index in range(offset, rows, threads):
+            storage.insert_iteration(iteration_values(1000 + index, session_id='load'))
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=insert, args=(offset,)) for offset in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    insert_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    streamed = sum(len(chunk) for chunk in storage.stream_iterations(chunk_size=1000))
+    stream_seconds = time.perf_counter() - start
+    print(f"  {rows} inserts from {threads} threads: {rows / insert_seconds:.0f} rows/s; "
+          f"streamed {streamed} rows at {streamed / stream_seconds:.0f} rows/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and benchmark the storage backends.")
+    parser.add_argument('--dsn', help="Also run against a real Postgres server")
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='storage_bench_')
+    backends = [('sqlite', SQLiteStorage(f"{directory}/memory.db")),
+                ('postgres (emulated)', PostgresStorage(f"emulated://{directory}/pg", 'memory_bench'))]
+    if args.dsn:
+        backends.append(('postgres', PostgresStorage(args.dsn, f"bench_{int(time.time())}")))
+    failures = []
+    try:
+        for name, storage in backends:
+            print(name)
+            failures += check(storage)
+            benchmark(storage, args.rows, args.threads)
+            storage.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    print(f"{len(failures)} failed checks")
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,4 +17,122 @@ MEMORY_FILE = 'memory.yaml'
 MAX_MEMORY_SIZE = 100
 
 # Evaluation threshold
-LOW_SCORE_THRESHOLD = 7
\ No newline at end of file
+LOW_SCORE_THRESHOLD = 7
+
+# Usage accounting and budgets (0 disables a limit)
+SESSION_TOKEN_BUDGET = int(os.getenv('SESSION_TOKEN_BUDGET', 0))
+SESSION_COST_BUDGET = float(os.getenv('SESSION_COST_BUDGET', 0))
+BUDGET_ACTION = os.getenv('BUDGET_ACTION', 'downgrade')  # 'downgrade' or 'stop'
+BUDGET_DOWNGRADE_MODEL = "perplexity/llama-3-sonar-small-32k-chat"
+
+# Per-agent model routing tiers and failover
+ROUTING_CONFIG_FILE = os.getenv('ROUTING_CONFIG_FILE', 'routing.yaml')
+
+# Prompt prefix reuse measurement (characters; ~4 characters per token)
+PREFIX_BLOCK_CHARS = 512
+PREFIX_MIN_CHARS = 4096
+PREFIX_MAX_BLOCKS = 10000
+
+# Incremental re-evaluation of revised content
+INCREMENTAL_EVALUATION = os.getenv('INCREMENTAL_EVALUATION', '1') == '1'
+INCREMENTAL_MAX_CHANGE_RATIO = 0.5  # Above this share of changed text, re-evaluate from scratch
+
+# Offline stubs for the LLM and Cohere APIs (local load testing)
+STUB_LLM = os.getenv('INSTRUCTO_STUB_LLM') == '1'
+STUB_LLM_LATENCY = float(os.getenv('INSTRUCTO_STUB_LATENCY', 0))  # Mean simulated seconds per completion
+
+# HTTP API service
+SERVICE_DATA_DIR = os.getenv('SERVICE_DATA_DIR', 'user_memories')
+SERVICE_WORKERS = int(os.getenv('SERVICE_WORKERS', 8))
+SERVICE_QUEUE_SIZE = int(os.getenv('SERVICE_QUEUE_SIZE', 32))  # Jobs waiting for a worker before requests get a 503
+SERVICE_MAX_WORKSPACES = int(os.getenv('SERVICE_MAX_WORKSPACES', 256))  # Open user workspaces kept, least recently used evicted first
+SERVICE_WORKSPACE_IDLE_SECONDS = float(os.getenv('SERVICE_WORKSPACE_IDLE_SECONDS', 1800))  # Idle workspaces are closed after this
+
+# Topic clusters and summaries used as retrieval context
+USE_TOPIC_SUMMARIES = os.getenv('USE_TOPIC_SUMMARIES', '1') == '1'
+TOPIC_SIMILARITY_THRESHOLD = 0.75  # Cosine similarity needed to join an existing cluster
+TOPIC_SUMMARY_COUNT = 3
+
+# Speculative drafting of the next iteration while the user decides whether to continue
+SPECULATIVE_DRAFTS = os.getenv('SPECULATIVE_DRAFTS', '0') == '1'
+
+# Calibration of evaluator scores against user scores
+CALIBRATION_METHOD = os.getenv('CALIBRATION_METHOD', 'isotonic')  # 'isotonic' or 'linear'
+CALIBRATION_MIN_SAMPLES = 20  # Paired scores needed before a criterion is calibrated
+CALIBRATION_STOP_SCORE = 9.0  # Calibrated and user scores at or above this on every criterion end the refinement locally
+LOCAL_ITERATE_DECISION = os.getenv('LOCAL_ITERATE_DECISION', '1') == '1'
+
+# Gating of the feedback agent call
+FEEDBACK_GATING = os.getenv('FEEDBACK_GATING', '1') == '1'
+FEEDBACK_GATE_MAX_DIVERGENCE = 1.5  # Mean |AI - user| score gap above which the full analysis always runs
+FEEDBACK_DELTA_MAX_WEAK = 2  # Up to this many weak criteria get the shorter delta feedback prompt
+
+# Best-of-N candidate generation
+BEST_OF_N = int(os.getenv('BEST_OF_N', 1))  # Candidates generated per round; 1 disables
+BEST_OF_N_CONCURRENCY = int(os.getenv('BEST_OF_N_CONCURRENCY', 4))  # Candidates generated and evaluated at once
+CANDIDATE_VARIANTS = [  # Cycled through for the candidates of a round
+    {'temperature': 0.7, 'instruction': None},
+    {'temperature': 1.0, 'instruction': "Favour depth: fewer points, each developed with evidence and examples."},
+    {'temperature': 0.4, 'instruction': "Favour precision: concise, tightly structured, every claim verifiable."},
+    {'temperature': 1.2, 'instruction': "Favour originality: an unexpected angle or framing while staying on the objective."},
+]
+
+# Long-form documents generated and evaluated section by section
+LONG_FORM_MAX_SECTIONS = 8
+LONG_FORM_CONCURRENCY = int(os.getenv('LONG_FORM_CONCURRENCY', 4))  # Sections generated or evaluated at once
+LONG_FORM_PREVIEW_CHARS = 600  # Opening of each section shown for document-level criteria
+
+# Approximate nearest-neighbour index over stored embeddings
+ANN_INDEX = os.getenv('ANN_INDEX', '1') == '1'
+ANN_MIN_ROWS = 1000  # Below this many embeddings, retrieval reranks every stored iteration
+ANN_NPROBE = int(os.getenv('ANN_NPROBE', 8))  # Inverted lists searched per query: higher is slower with better recall
+ANN_CANDIDATES = 50  # Nearest neighbours passed on to the reranker
+ANN_REBUILD_DELTA = 5000  # Rows appended since the last build that trigger a background compaction
+ANN_KMEANS_ITERATIONS = 10
+
+# Embedding and rerank provider for memory retrieval ('cohere', or 'hashing'/'onnx' to run offline in-process)
+EMBEDDING_PROVIDER = os.getenv('EMBEDDING_PROVIDER', 'cohere')
+HASHING_EMBEDDING_DIM = int(os.getenv('HASHING_EMBEDDING_DIM', 1024))
+ONNX_MODEL_PATH = os.getenv('ONNX_MODEL_PATH', 'embedding_model')  # Directory with model.onnx and tokenizer.json
+ONNX_BATCH_SIZE = 32
+ONNX_MAX_TOKENS = 256
+REEMBED_BATCH_SIZE = 96  # Texts per embed call when re-embedding stored rows
+
+# Rate limits shared by every process on the host, per provider or per 'provider/model' key (0 disables a limit)
+RATE_LIMITING = os.getenv('RATE_LIMITING', '1') == '1'
+RATE_LIMIT_DB = os.getenv('RATE_LIMIT_DB', 'rate_limits.db')
+RATE_LIMITS = {
+    'perplexity': {'requests_per_minute': 50, 'tokens_per_minute': 0},
+    'cohere': {'requests_per_minute': 100, 'tokens_per_minute': 0},
+}
+RATE_LIMIT_BURST_SECONDS = 5  # Quota that may be spent at once after an idle period, in seconds of the per-minute rate
+RATE_LIMIT_COMPLETION_TOKENS = 1000  # Completion tokens reserved per call until the actual usage is known
+RATE_LIMIT_MAX_WAIT = 120  # Seconds a call may wait for its slot before failing
+RATE_LIMIT_RETRIES = 3  # Retries of a call rejected with HTTP 429
+RATE_LIMIT_COOLDOWN_SECONDS = 10  # Pause for every process after a 429 without a Retry-After header
+
+# Scheduling of completion calls within a process by priority class and tenant
+SCHEDULER = os.getenv('SCHEDULER', '1') == '1'
+SCHEDULER_CONCURRENCY = int(os.getenv('SCHEDULER_CONCURRENCY', 16))  # Completion calls in flight at once
+SCHEDULER_WEIGHTS = {'interactive': 8, 'refinement': 3, 'batch': 1}  # Shares of the call slots while classes compete
+SCHEDULER_INTERACTIVE_SLOTS = 4  # Slots only interactive calls may use, so a turn never waits behind a full batch
+SCHEDULER_TENANT_CONCURRENCY = int(os.getenv('SCHEDULER_TENANT_CONCURRENCY', 4))  # Calls in flight per tenant (0 disables)
+SCHEDULER_BATCH_HEADROOM = 0.2  # Share of the rate limit burst that batch calls leave to other classes
+
+# Bulk ingestion of existing corpora into memory (python ingest.py)
+INGEST_BATCH_SIZE = 96  # Documents per embed call
+INGEST_CONCURRENCY = int(os.getenv('INGEST_CONCURRENCY', 4))  # Embed calls in flight; reading pauses while all are busy
+INGEST_COMMIT_ROWS = 1000  # Rows written per transaction, together with the resume checkpoint
+
+# Storage backend for the iterations table ('sqlite', or 'postgres' with POSTGRES_DSN)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')
+POSTGRES_DSN = os.getenv('POSTGRES_DSN', 'postgresql://localhost/instructo')  # emulated://<directory> runs on SQLite files
+STORAGE_POOL_SIZE = int(os.getenv('STORAGE_POOL_SIZE', 4))  # Idle connections kept per database
+EXPORT_CHUNK_ROWS = 5000  # Rows per read and per Parquet row group in python export.py
+
+# Sampling profiler (python main.py --profile, or the sidebar toggle in app.py)
+PROFILING = os.getenv('PROFILING', '0') == '1'  # Profile every session, writing to PROFILE_OUTPUT
+PROFILE_OUTPUT = os.getenv('PROFILE_OUTPUT', 'profile')  # Prefix of the speedscope, collapsed-stack and summary files
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.01))  # Seconds between samples
+PROFILE_MAX_DEPTH = 64  # Innermost frames kept per stack
+PROFILE_TOP_FUNCTIONS = 40  # Functions listed in the summary
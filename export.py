@@ -0,0 +1,90 @@
+import argparse
+import json
+import os
+import time
+from loguru import logger
+from config import EXPORT_CHUNK_ROWS
+from utils.storage import open_storage, ITERATION_COLUMNS
+
+# Streams the iterations table into a Parquet file (or an Arrow IPC file) one chunk at a
+# time, each chunk a separate short read, so analytics run on the export instead of
+# contending with the interactive writers on the live database.
+
+
+def arrow_schema(pa, embeddings):
+    fields = [
+        ('id', pa.int64()), ('session_id', pa.string()), ('timestamp', pa.string()), ('prompt', pa.string()),
+        ('content', pa.string()), ('ai_evaluation', pa.string()), ('user_evaluation_content', pa.string()),
+        ('user_feedback_evaluator', pa.string()), ('feedback_agent_analysis', pa.string()), ('total_score', pa.float64()),
+        ('usage', pa.string()), ('content_hash', pa.string()), ('kind', pa.string()),
+        ('user_scores', pa.map_(pa.string(), pa.float64())),
+    ]
+    if embeddings:
+        fields.append(('embedding', pa.list_(pa.float32())))
+    return pa.schema(fields)
+
+
+def _user_scores(value):
+    user_evaluation = json.loads(value) if value else None
+    scores = user_evaluation.get('score') if isinstance(user_evaluation, dict) else None
+    return [(criterion, float(score)) for criterion, score in (scores or {}).items() if isinstance(score, (int, float))]
+
+
+def to_record_batch(pa, schema, rows):
+    columns = {name: [row[name] for row in rows] for name in schema.names if name not in ('user_scores', 'embedding')}
+    columns['user_scores'] = [_user_scores(row['user_evaluation_content']) for row in rows]
+    if 'embedding' in schema.names:
+        columns['embedding'] = [json.loads(row['embedding']) if row['embedding'] else None for row in rows]
+    return pa.RecordBatch.from_pydict(columns, schema=schema)
+
+
+def export_iterations(db_path, output, file_format='parquet', chunk_rows=EXPORT_CHUNK_ROWS, since_id=0, embeddings=False):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("Exporting needs the pyarrow package") from e
+    schema = arrow_schema(pa, embeddings)
+    columns = [column for column in ITERATION_COLUMNS if embeddings or column != 'embedding']
+    storage = open_storage(db_path, read_only=True)
+    temporary = f"{output}.tmp"
+    rows, last_id, start = 0, since_id, time.perf_counter()
+    if file_format == 'parquet':
+        writer = pq.ParquetWriter(temporary, schema, compression='zstd')
+    else:
+        writer = pa.ipc.new_file(temporary, schema)
+    try:
+        for chunk in storage.stream_iterations(columns, chunk_rows, since_id):
+            batch = to_record_batch(pa, schema, chunk)
+            if file_format == 'parquet':
+                writer.write_batch(batch, row_group_size=chunk_rows)
+            else:
+                writer.write_batch(batch)
+            rows += len(chunk)
+            last_id = chunk[-1]['id']
+            logger.info(f"Exported {rows} rows (last id {last_id})")
+    finally:
+        writer.close()
+        storage.close()
+    # Readers never see a half-written file
+    os.replace(temporary, output)
+    return {'rows': rows, 'last_id': last_id, 'seconds': time.perf_counter() - start, 'bytes': os.path.getsize(output)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the iterations table to Parquet or Arrow for offline analytics.")
+    parser.add_argument('--db', default='memory.db', help="Memory database to export")
+    parser.add_argument('--out', default='iterations.parquet', help="Output file")
+    parser.add_argument('--format', choices=('parquet', 'arrow'), default='parquet')
+    parser.add_argument('--chunk-rows', type=int, default=EXPORT_CHUNK_ROWS, help="Rows per read and per row group")
+    parser.add_argument('--since-id', type=int, default=0, help="Only export rows with a larger id (incremental exports)")
+    parser.add_argument('--embeddings', action='store_true', help="Include embeddings as float32 lists")
+    args = parser.parse_args()
+
+    report = export_iterations(args.db, args.out, args.format, args.chunk_rows, args.since_id, args.embeddings)
+    print(f"Exported {report['rows']} rows to {args.out} ({report['bytes'] / 1024:.1f} KiB) in {report['seconds']:.1f}s")
+    print(f"Last exported id: {report['last_id']} (pass --since-id {report['last_id']} for the next incremental export)")
+
+
+if __name__ == "__main__":
+    main()
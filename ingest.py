@@ -0,0 +1,301 @@
+import argparse
+import csv
+import json
+import os
+import resource
+import sqlite3
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from loguru import logger
+from config import COHERE_EMBED_MODEL, INGEST_BATCH_SIZE, INGEST_CONCURRENCY, INGEST_COMMIT_ROWS, STORAGE_BACKEND
+from utils.memory import Memory, content_hash
+from utils.embeddings import embedding_client
+from utils.guidelines import EVALUATION_CRITERIA
+from utils.scheduler import request_context, propagate, BATCH
+from utils.topics import TopicIndex
+from utils.analytics import ScoreAnalytics
+from utils.ann_index import AnnIndex
+
+# Streams past content into memory: records are read lazily, embedded in concurrent batches
+# (reading pauses while INGEST_CONCURRENCY batches are in flight) and written in order, with
+# each source's read position committed in the same transaction as its rows so an
+# interrupted run resumes where it stopped.
+
+EXTENSIONS = {'.jsonl': 'jsonl', '.csv': 'csv', '.md': 'markdown', '.markdown': 'markdown', '.txt': 'markdown'}
+PROGRESS_SECONDS = 5
+
+
+def init_progress(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_progress (
+            source TEXT PRIMARY KEY,
+            position INTEGER,
+            rows INTEGER,
+            fingerprint TEXT,
+            completed INTEGER DEFAULT 0
+        )
+    ''')
+    conn.commit()
+
+
+def fingerprint(path):
+    stat = os.stat(path)
+    return f"{stat.st_size}:{int(stat.st_mtime)}"
+
+
+def find_sources(paths):
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, files in os.walk(path):
+                sources.extend(os.path.join(directory, name) for name in files if os.path.splitext(name)[1].lower() in EXTENSIONS)
+        elif os.path.splitext(path)[1].lower() in EXTENSIONS:
+            sources.append(path)
+        else:
+            logger.warning(f"Skipping {path}: unsupported format")
+    return sorted(os.path.abspath(source) for source in sources)
+
+
+def read_jsonl(path, skip):
+    position = 0
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            position += 1
+            if position <= skip:
+                continue
+            try:
+                yield position, json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning(f"{path}:{position}: invalid JSON ({e})")
+                yield position, None
+
+
+def read_csv(path, skip):
+    csv.field_size_limit(sys.maxsize)
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for position, row in enumerate(csv.DictReader(f), start=1):
+            if position > skip:
+                yield position, row
+
+
+def read_markdown(path, skip):
+    # One document per file; the first heading (or the file name) is taken as the prompt
+    if skip:
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    heading = next((line.lstrip('#').strip() for line in text.splitlines() if line.startswith('#')), None)
+    yield 1, {'prompt': heading or os.path.splitext(os.path.basename(path))[0], 'content': text}
+
+
+READERS = {'jsonl': read_jsonl, 'csv': read_csv, 'markdown': read_markdown}
+
+
+def _score(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def normalize_record(record):
+    # JSONL records and CSV rows: prompt, content (or text), timestamp, total_score, scores
+    # ({criterion: score}) or one column per evaluation criterion, optional ai_evaluation and feedback
+    if not isinstance(record, dict):
+        return None
+    content = record.get('content') or record.get('text')
+    if not content or not str(content).strip():
+        return None
+    scores = record.get('scores') or {criterion: record.get(criterion) for criterion in EVALUATION_CRITERIA}
+    if isinstance(scores, str):
+        scores = json.loads(scores)
+    if not isinstance(scores, dict):
+        raise ValueError("scores must map criteria to numbers")
+    scores = {criterion: _score(value) for criterion, value in scores.items() if _score(value) is not None}
+    total_score = _score(record.get('total_score'))
+    if total_score is None and scores:
+        total_score = sum(scores.values()) / len(scores)
+    ai_evaluation = record.get('ai_evaluation') or {}
+    if isinstance(ai_evaluation, str):
+        ai_evaluation = json.loads(ai_evaluation)
+    if not isinstance(ai_evaluation, dict):
+        raise ValueError("ai_evaluation must be an object")
+    feedback = record.get('feedback') or {}
+    return {
+        'prompt': str(record.get('prompt') or ''),
+        'content': str(content),
+        'timestamp': str(record.get('timestamp') or datetime.now().isoformat()),
+        'ai_evaluation': ai_evaluation,
+        'user_evaluation_content': {'score': scores, 'feedback': feedback if isinstance(feedback, dict) else {}},
+        'total_score': total_score,
+    }
+
+
+def batches(source, skip, batch_size):
+    reader = READERS[EXTENSIONS[os.path.splitext(source)[1].lower()]]
+    batch, position = [], skip
+    for position, record in reader(source, skip):
+        try:
+            record = normalize_record(record)
+        except ValueError as e:  # includes malformed JSON in scores or ai_evaluation
+            logger.warning(f"{source}:{position}: skipping record ({e})")
+            record = None
+        if record:
+            batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch, position, False
+            batch = []
+    # The last batch, possibly empty, marks the source as completed once it is written
+    yield batch, position, True
+
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class Ingestor:
+    def __init__(self, db_path, batch_size=INGEST_BATCH_SIZE, concurrency=INGEST_CONCURRENCY, commit_rows=INGEST_COMMIT_ROWS):
+        if STORAGE_BACKEND != 'sqlite':
+            raise RuntimeError(f"Ingest writes to SQLite memory databases only (STORAGE_BACKEND is {STORAGE_BACKEND})")
+        Memory(db_path=db_path)  # creates or migrates the schema
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.commit_rows = commit_rows
+        self.session_id = datetime.now().strftime("ingest_%Y%m%d_%H%M%S")
+        self.client = embedding_client()
+        self.conn = sqlite3.connect(db_path)
+        init_progress(self.conn)
+        self.in_flight_hashes = set()
+        self.uncommitted = 0
+        self.stats = {'read': 0, 'written': 0, 'duplicates': 0, 'sources': 0}
+        self.start = time.perf_counter()
+        self._last_report = self.start
+
+    def _embed(self, texts):
+        if not texts:
+            return []
+        return list(self.client.embed(texts=texts, model=COHERE_EMBED_MODEL, input_type='search_document').embeddings)
+
+    def _new_records(self, batch):
+        # Drops records already stored (rows written in this run are visible to our own connection)
+        # or waiting in an earlier batch
+        for record in batch:
+            record['content_hash'] = content_hash(record['content'])
+        hashes = list({record['content_hash'] for record in batch})
+        stored = {row[0] for row in self.conn.execute(
+            f"SELECT content_hash FROM iterations WHERE content_hash IN ({','.join('?' * len(hashes))})", hashes)} if hashes else set()
+        records = []
+        for record in batch:
+            if record['content_hash'] in stored or record['content_hash'] in self.in_flight_hashes:
+                self.stats['duplicates'] += 1
+                continue
+            self.in_flight_hashes.add(record['content_hash'])
+            records.append(record)
+        return records
+
+    def _write(self, source, records, future, position, completed):
+        embeddings = future.result()
+        self.conn.executemany('''
+            INSERT INTO iterations (
+                session_id, timestamp, prompt, content, ai_evaluation, user_evaluation_content,
+                user_feedback_evaluator, feedback_agent_analysis, total_score, embedding, content_hash, kind
+            ) VALUES (?, ?, ?, ?, ?, ?, '', 'null', ?, ?, ?, 'iteration')
+        ''', [(
+            self.session_id, record['timestamp'], record['prompt'], record['content'], json.dumps(record['ai_evaluation']),
+            json.dumps(record['user_evaluation_content']), record['total_score'], json.dumps(list(embedding)), record['content_hash']
+        ) for record, embedding in zip(records, embeddings)])
+        self.in_flight_hashes.difference_update(record['content_hash'] for record in records)
+        self.conn.execute('''
+            INSERT INTO ingest_progress (source, position, rows, fingerprint, completed) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (source) DO UPDATE SET position = excluded.position, rows = rows + excluded.rows,
+                fingerprint = excluded.fingerprint, completed = excluded.completed
+        ''', (source, position, len(records), fingerprint(source), int(completed)))
+        self.stats['written'] += len(records)
+        self.uncommitted += len(records)
+        if completed or self.uncommitted >= self.commit_rows:
+            self.conn.commit()
+            self.uncommitted = 0
+        self._report()
+
+    def _report(self, final=False):
+        now = time.perf_counter()
+        if not final and now - self._last_report < PROGRESS_SECONDS:
+            return
+        self._last_report = now
+        elapsed = max(now - self.start, 1e-9)
+        logger.info(f"Ingested {self.stats['written']} rows ({self.stats['written'] / elapsed:.0f} rows/s), "
+                    f"{self.stats['duplicates']} duplicates skipped, peak RSS {peak_rss_mib():.0f} MiB")
+
+    def run(self, paths):
+        sources = find_sources(paths)
+        progress = {source: (position, completed, saved_fingerprint) for source, position, completed, saved_fingerprint in
+                    self.conn.execute('SELECT source, position, completed, fingerprint FROM ingest_progress')}
+        pending = deque()
+        embed = propagate(self._embed)
+        try:
+            with request_context(BATCH), ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='ingest') as executor:
+                for source in sources:
+                    position, completed, saved_fingerprint = progress.get(source, (0, 0, None))
+                    if completed and saved_fingerprint == fingerprint(source):
+                        logger.info(f"Skipping {source}: already ingested")
+                        continue
+                    if completed:
+                        # Changed since the last run: read it again, stored rows are skipped as duplicates
+                        position = 0
+                    logger.info(f"Ingesting {source}" + (f" from record {position + 1}" if position else ""))
+                    self.stats['sources'] += 1
+                    for batch, batch_position, last in batches(source, position, self.batch_size):
+                        self.stats['read'] += len(batch)
+                        records = self._new_records(batch)
+                        future = executor.submit(embed, [record['content'] for record in records])
+                        pending.append((source, records, future, batch_position, last))
+                        # Backpressure: wait for the oldest batch once every embed slot is busy
+                        while len(pending) > self.concurrency:
+                            self._write(*pending.popleft())
+                while pending:
+                    self._write(*pending.popleft())
+            self.conn.commit()
+        except BaseException:
+            # Rows of the unfinished transaction are read again on the next run
+            self.conn.rollback()
+            raise
+        finally:
+            self.conn.close()
+        self._report(final=True)
+        return dict(self.stats, seconds=time.perf_counter() - self.start, peak_rss_mib=peak_rss_mib())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-load past content and scores into the memory database.")
+    parser.add_argument('paths', nargs='+', help="JSONL, CSV or markdown files, or directories containing them")
+    parser.add_argument('--db', default='memory.db', help="Memory database to load into")
+    parser.add_argument('--batch-size', type=int, default=INGEST_BATCH_SIZE, help="Documents per embed call")
+    parser.add_argument('--concurrency', type=int, default=INGEST_CONCURRENCY, help="Embed calls in flight at once")
+    parser.add_argument('--no-index', action='store_true', help="Skip rebuilding topic clusters and the nearest-neighbour index afterwards")
+    args = parser.parse_args()
+    if STORAGE_BACKEND != 'sqlite':
+        parser.error(f"ingest.py works on SQLite memory databases only (STORAGE_BACKEND is {STORAGE_BACKEND})")
+
+    report = Ingestor(args.db, args.batch_size, args.concurrency).run(args.paths)
+    if report['written'] and not args.no_index:
+        TopicIndex(args.db).rebuild()
+        AnnIndex(args.db).rebuild()
+    ScoreAnalytics(args.db).refresh()
+    print(f"Sources read:        {report['sources']}")
+    print(f"Records read:        {report['read']}")
+    print(f"Rows written:        {report['written']}")
+    print(f"Duplicates skipped:  {report['duplicates']}")
+    print(f"Throughput:          {report['written'] / max(report['seconds'], 1e-9):.0f} rows/s over {report['seconds']:.1f}s")
+    print(f"Peak memory (RSS):   {report['peak_rss_mib']:.0f} MiB")
+
+
+if __name__ == "__main__":
+    main()
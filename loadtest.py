@@ -0,0 +1,92 @@
+import argparse
+import json
+import statistics
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from utils.guidelines import EVALUATION_CRITERIA
+
+# Drives create -> evaluate -> feedback rounds against server.py from many
+# simulated users. Start the server with INSTRUCTO_STUB_LLM=1 to test locally.
+
+
+def post(base_url, path, payload, timings, errors, priority=None):
+    request = urllib.request.Request(
+        f"{base_url}{path}" + (f"?priority={priority}" if priority else ''),
+        data=json.dumps(payload).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    endpoint = path.rsplit('/', 1)[-1] + (f" ({priority})" if priority else '')
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=300) as response:
+            body = json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        errors[f"{endpoint} {e.code}"] += 1
+        return None
+    except urllib.error.URLError as e:
+        errors[f"{endpoint} {e.reason}"] += 1
+        return None
+    timings[endpoint].append(time.perf_counter() - start)
+    return body
+
+
+def simulate_user(base_url, user_index, rounds, timings, errors, priority=None):
+    user = f"loadtest-{priority or 'user'}-{user_index}"
+    prompt = f"Write a short explainer about topic {user_index % 7}"
+    post(base_url, f"/users/{user}/sessions", {}, timings, errors)
+    for _ in range(rounds):
+        created = post(base_url, f"/users/{user}/create", {'prompt': prompt}, timings, errors, priority)
+        if not created:
+            continue
+        evaluated = post(base_url, f"/users/{user}/evaluate", {'prompt': prompt, 'content': created['content']}, timings, errors, priority)
+        if not evaluated:
+            continue
+        post(base_url, f"/users/{user}/feedback", {
+            'prompt': prompt,
+            'content': created['content'],
+            'evaluation': evaluated['evaluation'],
+            'user_scores': {criterion: 7 for criterion in EVALUATION_CRITERIA},
+            'user_feedback': {criterion: 'ok' for criterion in EVALUATION_CRITERIA},
+            'user_feedback_evaluator': 'ok',
+        }, timings, errors, priority)
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the Instructo HTTP API.")
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--batch-users', type=int, default=0, help="Additional users sending batch-priority traffic alongside")
+    parser.add_argument('--batch-rounds', type=int, default=10)
+    args = parser.parse_args()
+
+    timings = defaultdict(list)
+    errors = defaultdict(int)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users + args.batch_users) as executor:
+        for user_index in range(args.batch_users):
+            executor.submit(simulate_user, args.url, user_index, args.batch_rounds, timings, errors, 'batch')
+        for user_index in range(args.users):
+            executor.submit(simulate_user, args.url, user_index, args.rounds, timings, errors)
+    elapsed = time.perf_counter() - start
+
+    total = sum(len(samples) for samples in timings.values())
+    print(f"{total} successful requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)")
+    for endpoint, samples in sorted(timings.items()):
+        print(f"{endpoint:18} n={len(samples):5} p50={statistics.median(samples) * 1000:8.1f} ms "
+              f"p95={percentile(samples, 0.95) * 1000:8.1f} ms")
+    for error, count in sorted(errors.items()):
+        print(f"error {error}: {count}")
+
+
+if __name__ == "__main__":
+    main()
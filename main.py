@@ -11,9 +11,24 @@ from models.evaluation import UserEvaluation
 from utils.memory import memory
 from utils.guidelines import EVALUATION_CRITERIA
 from agents.feedback_agent import FeedbackAgent
+from utils.usage import usage
+from utils.prefix_cache import prefix_stats
+from utils.rate_limit import rate_limiter
+from utils.scheduler import scheduler, request_context, REFINEMENT
+from utils import single_flight
+from utils.recorder import recorder
+from utils.feedback_parser import needs_improvement
+from utils.feedback_gate import gate_stats
+from utils.speculation import SpeculativeDraft, speculation_stats
+from utils.best_of_n import select_best_candidate
+from utils.long_form import LongFormPipeline
+from utils.profiler import profiler
+from config import SPECULATIVE_DRAFTS, BEST_OF_N, PROFILING, PROFILE_OUTPUT
 # from utils.api_handler import api
 # from config import FEEDBACK_MODEL
 import traceback
+import argparse
+import time
 
 
 
@@ -24,9 +39,15 @@ import traceback
 # logger = logging.getLogger(__name__)
 
 
-def run_interaction(prompt, creator, evaluator, feedback_agent):
+def ask(*args, **kwargs):
+    return recorder.user_input(Prompt.ask, *args, **kwargs)
+
+
+def run_interaction(prompt, creator, evaluator, feedback_agent, speculate=False, candidates=1, long_form=False):
     console = Console()
+    pipeline = LongFormPipeline(creator, evaluator) if long_form else None
     iteration_count = 0
+    draft = None
     
     while True:
         # logger.debug(f"Starting iteration {iteration_count}")
@@ -34,18 +55,37 @@ def run_interaction(prompt, creator, evaluator, feedback_agent):
         # logger.debug(f"Starting iteration {memory.get_iteration_count()}")
         # logger.debug(f"Using memory with {len(memory.get_recent_iterations(5))} recent iterations")
         
+        # Rounds after the first are refinement traffic for the scheduler; the first keeps the caller's class
+        priority = REFINEMENT if iteration_count else None
+
         # Content creation
         console.print("Fetching relevant iterations from memory...")
-        relevant_iterations = memory.get_relevant_iterations(prompt)
+        with profiler.stage('retrieve'), request_context(priority):
+            relevant_iterations = memory.get_relevant_iterations(prompt)
         console.print(f"Found {len(relevant_iterations)} relevant iterations.")
-        console.print("Creating content...")
-        content = creator.create_content(prompt)
-        console.print(Panel(content, title="Generated Content", expand=False), style="cyan")
+        content = draft.take() if draft else None
+        draft = None
+        evaluation = None
+        with profiler.stage('create'), request_context(priority):
+            if pipeline:
+                console.print("Writing document section by section...")
+                recent = memory.get_recent_iterations(1)
+                content, evaluation = pipeline.run_round(prompt, recent[0] if recent else None)
+            elif content is None and candidates > 1:
+                console.print(f"Creating and evaluating {candidates} candidates...")
+                content, evaluation = select_best_candidate(creator, evaluator, prompt, candidates)
+            elif content is None:
+                console.print("Creating content...")
+                content = creator.create_content(prompt)
+        with profiler.stage('render'):
+            console.print(Panel(content, title="Generated Content", expand=False), style="cyan")
 
         # AI Evaluation
         #logger.debug("Evaluating content")
-        evaluation = evaluator.evaluate_content(content, prompt)
-        display_evaluation(evaluation, console)
+        if evaluation is None:
+            with profiler.stage('evaluate'), request_context(priority):
+                evaluation = evaluator.evaluate_content(content, prompt)
+        display_evaluation(evaluation, console, memory.calibration.calibrate(evaluation))
 
         # User Evaluation for Content
         #logger.debug("Getting user evaluation for content")
@@ -59,49 +99,69 @@ def run_interaction(prompt, creator, evaluator, feedback_agent):
         #logger.debug("Generating and displaying feedback")
         recent_iterations = memory.get_recent_iterations(5)  # Get the recent iterations
         #logger.debug(f"recent iterations: {recent_iterations}")
-        feedback = feedback_agent.analyze_interaction(recent_iterations, prompt, content, evaluation, user_eval_content, user_feedback_evaluator)
+        with profiler.stage('feedback'), request_context(priority):
+            feedback = feedback_agent.analyze_interaction(recent_iterations, prompt, content, evaluation, user_eval_content, user_feedback_evaluator)
         display_feedback(feedback, console)
         #logger.debug(f"Feedback before storing in memory: {feedback}")
 
 
         # Store iteration in memory
         #logger.debug("Storing iteration in memory")
-        memory.add_iteration(prompt, content, evaluation, user_eval_content, user_feedback_evaluator, feedback)
+        with profiler.stage('store'), request_context(priority):
+            memory.add_iteration(prompt, content, evaluation, user_eval_content, user_feedback_evaluator, feedback)
+        display_usage(console)
 
+        # Draft the next iteration from the stored ratings and feedback while the user decides
+        if speculate and not pipeline and needs_improvement(feedback):
+            draft = SpeculativeDraft(creator, prompt)
+
+        disagreed = False
         while True:
             #logger.debug("Asking for user decision")
-            decision = Prompt.ask(
+            decision = ask(
                 "What would you like to do?",
                 choices=["continue", "disagree", "new", "quit"],
                 default="continue"
             )
 
             if decision == "continue":
-                improvements_needed = feedback['improvements_needed'].strip().upper().startswith('YES')
-                if improvements_needed:
+                if needs_improvement(feedback):
                     #logger.debug("Improvements needed, starting next iteration")
                     iteration_count += 1
+                    if draft and disagreed:
+                        # Drafted before the user's additional feedback
+                        draft.discard()
+                        draft = None
                     break  # Break the inner loop to start a new iteration
                 else:
                     #logger.debug("No improvements needed")
                     console.print("No further improvements needed. Starting a new interaction.")
+                    if draft:
+                        draft.discard()
                     return True
             elif decision == "disagree":
                 #logger.debug("User disagreed, incorporating additional feedback")
+                disagreed = True
                 additional_feedback = get_additional_feedback(console)
-                feedback = feedback_agent.incorporate_user_feedback(feedback, additional_feedback)
+                with profiler.stage('feedback'), request_context(priority):
+                    feedback = feedback_agent.incorporate_user_feedback(feedback, additional_feedback)
                 display_feedback(feedback, console)
             elif decision == "new":
                 #logger.debug("Starting new interaction")
+                if draft:
+                    draft.discard()
                 memory.start_new_session()
                 return True
             elif decision == "quit":
                 #logger.debug("Quitting")
+                if draft:
+                    draft.discard()
                 return False
 
     return True  # Continue the main loop
 
 
+@profiler.stage('render')
 def display_feedback(feedback, console):
     #logger.debug("Displaying feedback")
     console.print("\n[bold magenta]Feedback Agent Analysis:[/bold magenta]")
@@ -130,11 +190,30 @@ def display_feedback(feedback, console):
 
 
 
+@profiler.stage('render')
+def display_usage(console):
+    snapshot = usage.snapshot()
+    table = Table(title="Session Usage", box=box.ROUNDED)
+    table.add_column("Agent / Model", style="cyan")
+    table.add_column("Calls", justify="right")
+    table.add_column("Tokens", justify="right", style="magenta")
+    table.add_column("Cost ($)", justify="right", style="green")
+    for group in ('by_agent', 'by_model'):
+        for name, totals in snapshot[group].items():
+            table.add_row(name, str(totals['calls']), str(totals['total_tokens']), f"{totals['cost']:.4f}")
+    total = snapshot['total']
+    table.add_row("[bold]Total[/bold]", str(total['calls']), str(total['total_tokens']), f"{total['cost']:.4f}")
+    console.print(table)
+    if usage.budget_exceeded():
+        console.print(f"[red]Session budget exceeded (action: {usage.action}).[/red]")
+
+
 def get_additional_feedback(console):
     console.print("\n[bold]Please provide additional feedback for improvement:[/bold]")
-    return Prompt.ask("Your feedback")
+    return ask("Your feedback")
 
-def display_evaluation(evaluation, console):
+@profiler.stage('render')
+def display_evaluation(evaluation, console, calibrated=None):
     console.print("\n[bold yellow]AI Evaluation:[/bold yellow]")
     if isinstance(evaluation, str):
         console.print(evaluation)
@@ -144,6 +223,10 @@ def display_evaluation(evaluation, console):
             if isinstance(details, dict):
                 if 'score' in details:
                     console.print(f"Score: {details['score']}")
+                if details.get('sections'):
+                    console.print("Per section: " + ", ".join(f"{title} {score}" for title, score in details['sections'].items()))
+                if calibrated and calibrated.get(criterion) is not None:
+                    console.print(f"Calibrated score (expected user score): {calibrated[criterion]:.1f}")
                 if 'explanation' in details:
                     console.print(f"Explanation: {details['explanation']}")
                 if 'suggestions' in details and details['suggestions']:
@@ -169,7 +252,7 @@ def get_user_evaluation_for_content(console):
 
     for criterion in EVALUATION_CRITERIA.keys():
         while True:
-            score = Prompt.ask(f"Rate the [cyan]{criterion}[/cyan] (0-10)", default="5")
+            score = ask(f"Rate the [cyan]{criterion}[/cyan] (0-10)", default="5")
             try:
                 score = float(score)
                 if 0 <= score <= 10:
@@ -179,7 +262,7 @@ def get_user_evaluation_for_content(console):
             except ValueError:
                 console.print("[red]Invalid input. Please enter a number.[/red]")
         
-        feedback = Prompt.ask(f"Provide feedback for [cyan]{criterion}[/cyan]")
+        feedback = ask(f"Provide feedback for [cyan]{criterion}[/cyan]")
         
         user_scores[criterion] = score
         user_feedbacks[criterion] = feedback
@@ -192,23 +275,45 @@ def get_user_evaluation_for_content(console):
 
 def get_user_feedback_for_evaluator(console):
     console.print("\n[bold]Please provide feedback for the AI Evaluator:[/bold]")
-    return Prompt.ask("Your feedback for the evaluator")
+    return ask("Your feedback for the evaluator")
 
 def main():
+    parser = argparse.ArgumentParser(description="Instructo CLI")
+    parser.add_argument('--record', metavar='FILE', help="Record all LLM, Cohere and user-input traffic of the session to FILE")
+    parser.add_argument('--replay', metavar='FILE', help="Replay a recorded session from FILE without network access")
+    parser.add_argument('--speculate', action='store_true', default=SPECULATIVE_DRAFTS, help="Draft the next iteration in the background while you rate the current one")
+    parser.add_argument('--candidates', type=int, default=BEST_OF_N, help="Generate this many candidates per round and keep the best-scoring one")
+    parser.add_argument('--long-form', action='store_true', help="Outline the document and write, evaluate and revise it section by section")
+    parser.add_argument('--replay-latency', action='store_true', help="Sleep for the recorded duration of each replayed API call")
+    parser.add_argument('--profile', metavar='PREFIX', nargs='?', const=PROFILE_OUTPUT, default=PROFILE_OUTPUT if PROFILING else None,
+                        help="Sample the session and write PREFIX.speedscope.json, PREFIX.collapsed.txt and PREFIX.summary.txt")
+    args = parser.parse_args()
+
+    if args.profile:
+        profiler.start()
+
     creator = ContentCreator()
     evaluator = Evaluator()
     feedback_agent = FeedbackAgent()
     
-    memory.load_from_file()  # Load previous interactions if available
+    if args.replay:
+        replay_db = recorder.start_replay(args.replay, simulate_latency=args.replay_latency)
+        if replay_db:
+            memory.use_database(replay_db)
+    elif args.record:
+        recorder.start_recording(args.record, db_path=memory.db_path)
+    else:
+        memory.load_from_file()  # Load previous interactions if available
     
+    start = time.perf_counter()
     try:
         while True:
-            prompt = input("Enter a content prompt (or 'quit' to exit): ")
+            prompt = recorder.user_input(input, "Enter a content prompt (or 'quit' to exit): ")
             if prompt.lower() == 'quit':
                 break
 
             memory.start_new_session()
-            continue_main_loop = run_interaction(prompt, creator, evaluator, feedback_agent)
+            continue_main_loop = run_interaction(prompt, creator, evaluator, feedback_agent, speculate=args.speculate, candidates=args.candidates, long_form=args.long_form)
             if not continue_main_loop:
                 break
 
@@ -217,6 +322,22 @@ def main():
         print(traceback.format_exc())
     finally:
         memory.save_to_file()  # Save the latest interaction before exiting
+        prefix_stats.log_report()
+        speculation_stats.log_report()
+        gate_stats.log_report()
+        rate_limiter.log_report()
+        scheduler.log_report()
+        single_flight.log_report()
+        if args.profile:
+            profiler.stop()
+            profiler.log_report()
+            paths = profiler.write(args.profile)
+            print(f"Profile written to {paths['speedscope']} (open in speedscope.app), {paths['collapsed']} and {paths['summary']}")
+        if recorder.mode:
+            elapsed = time.perf_counter() - start
+            print(f"Session time: {elapsed:.2f}s, external calls and user input: {recorder.external_seconds:.2f}s, "
+                  f"local processing: {elapsed - recorder.external_seconds:.2f}s")
+            recorder.stop()
         
 if __name__ == "__main__":
     main()
\ No newline at end of file
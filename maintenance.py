@@ -0,0 +1,293 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import statistics
+import time
+import zlib
+from datetime import datetime, timedelta
+from loguru import logger
+from config import LOW_SCORE_THRESHOLD, COHERE_EMBED_MODEL, REEMBED_BATCH_SIZE, STORAGE_BACKEND
+from utils.memory import content_hash
+from utils.topics import TopicIndex
+from utils.analytics import ScoreAnalytics
+from utils.ann_index import AnnIndex
+from utils.embeddings import embedding_client
+
+
+def normalize_prompt(prompt):
+    return re.sub(r'\s+', ' ', (prompt or '').strip().lower())
+
+
+def measure_retrieval_latency(db_path, runs=5, top_n=5):
+    # Local part of Memory.get_relevant_iterations: full scan, then fetching the top rows
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, content FROM iterations')
+        rows = cursor.fetchall()
+        for row_id, _content in rows[:top_n]:
+            cursor.execute('SELECT * FROM iterations WHERE id = ?', (row_id,))
+            cursor.fetchone()
+        conn.close()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def backfill_hashes(conn):
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, content FROM iterations WHERE content_hash IS NULL')
+    rows = cursor.fetchall()
+    cursor.executemany('UPDATE iterations SET content_hash = ? WHERE id = ?',
+                       [(content_hash(content), row_id) for row_id, content in rows])
+    return len(rows)
+
+
+def find_duplicates(conn):
+    # Keep the best-scoring copy of each content, the oldest one on ties. Rejected best-of-N
+    # candidates are left to find_stale_rejected.
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id FROM (
+            SELECT id, ROW_NUMBER() OVER (
+                PARTITION BY content_hash ORDER BY total_score DESC, id ASC
+            ) AS copy_rank
+            FROM iterations
+            WHERE kind = 'iteration'
+        ) WHERE copy_rank > 1
+    ''')
+    return [row[0] for row in cursor.fetchall()]
+
+
+def find_retention_candidates(conn, keep_top, stale_days, min_score, exclude=()):
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, prompt, timestamp, total_score FROM iterations WHERE kind = 'iteration'")
+    clusters = {}
+    for row_id, prompt, timestamp, total_score in cursor.fetchall():
+        if row_id in exclude:
+            continue
+        clusters.setdefault(normalize_prompt(prompt), []).append((row_id, timestamp, total_score or 0.0))
+
+    stale_before = (datetime.now() - timedelta(days=stale_days)).isoformat() if stale_days else None
+    to_archive = []
+    for rows in clusters.values():
+        rows.sort(key=lambda row: (-row[2], row[0]))
+        for rank, (row_id, timestamp, total_score) in enumerate(rows):
+            beyond_top = keep_top and rank >= keep_top
+            stale_low = stale_before and timestamp < stale_before and total_score < min_score
+            if beyond_top or stale_low:
+                to_archive.append(row_id)
+    return to_archive, len(clusters)
+
+
+def find_stale_rejected(conn, rejected_days):
+    # Rejected candidates only serve as recent negative examples; they are deleted, not archived
+    if not rejected_days:
+        return []
+    stale_before = (datetime.now() - timedelta(days=rejected_days)).isoformat()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM iterations WHERE kind = 'rejected' AND timestamp < ?", (stale_before,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def init_archive(archive_path):
+    conn = sqlite3.connect(archive_path)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archived_iterations (
+            id INTEGER PRIMARY KEY,
+            session_id TEXT,
+            timestamp TEXT,
+            prompt TEXT,
+            total_score REAL,
+            content_hash TEXT,
+            archived_at TEXT,
+            payload BLOB
+        )
+    ''')
+    conn.commit()
+    return conn
+
+
+def archive_rows(conn, archive_conn, row_ids, chunk_size=500):
+    cursor = conn.cursor()
+    columns = None
+    archived_at = datetime.now().isoformat()
+    for start in range(0, len(row_ids), chunk_size):
+        chunk = row_ids[start:start + chunk_size]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f'SELECT * FROM iterations WHERE id IN ({placeholders})', chunk)
+        columns = columns or [description[0] for description in cursor.description]
+        records = []
+        for row in cursor.fetchall():
+            record = dict(zip(columns, row))
+            payload = zlib.compress(json.dumps(record).encode('utf-8'), 9)
+            records.append((record['id'], record['session_id'], record['timestamp'], record['prompt'],
+                            record['total_score'], record['content_hash'], archived_at, payload))
+        archive_conn.executemany('INSERT OR REPLACE INTO archived_iterations VALUES (?, ?, ?, ?, ?, ?, ?, ?)', records)
+        archive_conn.commit()
+        cursor.execute(f'DELETE FROM iterations WHERE id IN ({placeholders})', chunk)
+        conn.commit()
+
+
+def delete_rows(conn, row_ids, chunk_size=500):
+    for start in range(0, len(row_ids), chunk_size):
+        chunk = row_ids[start:start + chunk_size]
+        conn.execute(f"DELETE FROM iterations WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+    conn.commit()
+
+
+def restore_archived(db_path, archive_path, row_ids):
+    archive_conn = sqlite3.connect(archive_path)
+    conn = sqlite3.connect(db_path)
+    restored = 0
+    for row_id in row_ids:
+        row = archive_conn.execute('SELECT payload FROM archived_iterations WHERE id = ?', (row_id,)).fetchone()
+        if not row:
+            logger.warning(f"Row {row_id} is not in the archive")
+            continue
+        record = json.loads(zlib.decompress(row[0]))
+        columns = ', '.join(record)
+        conn.execute(f"INSERT OR REPLACE INTO iterations ({columns}) VALUES ({','.join('?' * len(record))})",
+                     list(record.values()))
+        archive_conn.execute('DELETE FROM archived_iterations WHERE id = ?', (row_id,))
+        restored += 1
+    conn.commit()
+    archive_conn.commit()
+    conn.close()
+    archive_conn.close()
+    ScoreAnalytics(db_path).refresh()
+    return restored
+
+
+def reembed_rows(conn, batch_size=REEMBED_BATCH_SIZE):
+    # Replaces stored embeddings with ones from the configured provider, in batches
+    client = embedding_client()
+    last_id, total = 0, 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, content FROM iterations WHERE id > ? AND kind = 'iteration' ORDER BY id LIMIT ?", (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        embeddings = client.embed(texts=[content or '' for _, content in rows], model=COHERE_EMBED_MODEL, input_type='search_document').embeddings
+        conn.executemany('UPDATE iterations SET embedding = ? WHERE id = ?',
+                         [(json.dumps(list(embedding)), row_id) for (row_id, _), embedding in zip(rows, embeddings)])
+        conn.commit()
+        total += len(rows)
+        last_id = rows[-1][0]
+    logger.info(f"Re-embedded {total} rows")
+    return total
+
+
+def run_maintenance(db_path, archive_path, keep_top, stale_days, min_score, dry_run=False, recluster=False, reindex=False, reembed=False,
+                    rejected_days=30):
+    report = {
+        'rows_before': 0, 'size_before': os.path.getsize(db_path),
+        'latency_before': measure_retrieval_latency(db_path),
+    }
+    conn = sqlite3.connect(db_path)
+    report['rows_before'] = conn.execute('SELECT COUNT(*) FROM iterations').fetchone()[0]
+    report['hashes_backfilled'] = backfill_hashes(conn)
+    conn.commit()
+
+    duplicates = find_duplicates(conn)
+    to_archive, report['clusters'] = find_retention_candidates(conn, keep_top, stale_days, min_score, exclude=set(duplicates))
+    rejected = find_stale_rejected(conn, rejected_days)
+    report['duplicates_removed'] = len(duplicates)
+    report['rejected_purged'] = len(rejected)
+    report['rows_archived'] = len(to_archive)
+
+    if dry_run:
+        logger.info("Dry run: no rows were removed or archived.")
+        conn.close()
+        return report
+
+    logger.info(f"Removing {len(duplicates)} duplicate rows.")
+    delete_rows(conn, duplicates)
+    logger.info(f"Purging {len(rejected)} stale rejected candidates.")
+    delete_rows(conn, rejected)
+    if to_archive:
+        logger.info(f"Archiving {len(to_archive)} rows to {archive_path}.")
+        archive_conn = init_archive(archive_path)
+        archive_rows(conn, archive_conn, to_archive)
+        archive_conn.execute('VACUUM')
+        archive_conn.close()
+
+    if reembed:
+        report['rows_reembedded'] = reembed_rows(conn)
+        recluster = reindex = True
+    if duplicates or to_archive or recluster:
+        report['topic_clusters'], _ = TopicIndex(db_path).rebuild()
+    ScoreAnalytics(db_path).refresh()
+    if ((duplicates or to_archive) and os.path.exists(f"{db_path}.ann/meta.json")) or reindex:
+        meta = AnnIndex(db_path).rebuild()
+        report['ann_vectors'] = meta['count'] if meta else 0
+
+    logger.info("Running VACUUM and ANALYZE.")
+    conn.execute('VACUUM')
+    conn.execute('ANALYZE')
+    report['rows_after'] = conn.execute('SELECT COUNT(*) FROM iterations').fetchone()[0]
+    conn.close()
+
+    report['size_after'] = os.path.getsize(db_path)
+    report['latency_after'] = measure_retrieval_latency(db_path)
+    return report
+
+
+def print_report(report):
+    print(f"Prompt groups:             {report['clusters']}")
+    print(f"Rows before:               {report['rows_before']}")
+    print(f"Content hashes backfilled: {report['hashes_backfilled']}")
+    print(f"Duplicates removed:        {report['duplicates_removed']}")
+    print(f"Rejected rows purged:      {report['rejected_purged']}")
+    print(f"Rows archived:             {report['rows_archived']}")
+    print(f"Retrieval scan latency:    {report['latency_before'] * 1000:.2f} ms before", end='')
+    if 'latency_after' in report:
+        print(f", {report['latency_after'] * 1000:.2f} ms after")
+        print(f"Rows after:                {report['rows_after']}")
+        if 'rows_reembedded' in report:
+            print(f"Rows re-embedded:          {report['rows_reembedded']}")
+        if 'topic_clusters' in report:
+            print(f"Topic clusters rebuilt:    {report['topic_clusters']}")
+        if 'ann_vectors' in report:
+            print(f"ANN index rebuilt:         {report['ann_vectors']} vectors")
+        print(f"Database size:             {report['size_before'] / 1024:.1f} KiB before, {report['size_after'] / 1024:.1f} KiB after")
+    else:
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact the memory database: deduplicate, apply retention, archive and vacuum.")
+    parser.add_argument('--db', default='memory.db', help="Memory database to maintain")
+    parser.add_argument('--archive', default='memory_archive.db', help="Compressed archive database for retired rows")
+    parser.add_argument('--keep-top', type=int, default=20, help="Rows kept per prompt cluster, by total score (0 keeps all)")
+    parser.add_argument('--stale-days', type=int, default=90, help="Age after which low-scoring rows are retired (0 disables)")
+    parser.add_argument('--min-score', type=float, default=LOW_SCORE_THRESHOLD, help="Total score below which stale rows are retired")
+    parser.add_argument('--rejected-days', type=int, default=30, help="Age after which rejected best-of-N candidates are deleted (0 keeps them)")
+    parser.add_argument('--recluster', action='store_true', help="Rebuild topic clusters and summaries even if no rows were removed")
+    parser.add_argument('--reindex', action='store_true', help="Rebuild the approximate nearest-neighbour index even if no rows were removed")
+    parser.add_argument('--reembed', action='store_true', help="Re-embed every stored row with the configured embedding provider, then recluster and reindex")
+    parser.add_argument('--dry-run', action='store_true', help="Report what would change without modifying anything")
+    parser.add_argument('--restore', type=int, nargs='+', metavar='ID', help="Move the given archived rows back into the memory database")
+    args = parser.parse_args()
+
+    if STORAGE_BACKEND != 'sqlite':
+        parser.error(f"maintenance.py works on SQLite memory databases only (STORAGE_BACKEND is {STORAGE_BACKEND})")
+    if not os.path.exists(args.db):
+        parser.error(f"Database not found: {args.db}")
+
+    if args.restore:
+        restored = restore_archived(args.db, args.archive, args.restore)
+        print(f"Restored {restored} rows from {args.archive}")
+        return
+
+    report = run_maintenance(args.db, args.archive, args.keep_top, args.stale_days, args.min_score, args.dry_run, args.recluster, args.reindex, args.reembed,
+                             args.rejected_days)
+    print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+@dataclass
+class CriterionFeedback:
+    feedback: str
+    rating: Optional[float] = None
+
+@dataclass
+class FeedbackAnalysis:
+    overall_analysis: str = ''
+    content_creator_feedback: Dict[str, CriterionFeedback] = field(default_factory=dict)
+    evaluator_feedback: str = ''
+    improvements_needed: str = ''
+    needs_improvement: bool = True
+    everything: str = ''
+
+    def to_dict(self):
+        # Plain dict stored in memory and read by the agents
+        return {
+            'overall_analysis': self.overall_analysis,
+            'content_creator_feedback': {criterion: item.feedback for criterion, item in self.content_creator_feedback.items()},
+            'criterion_ratings': {criterion: item.rating for criterion, item in self.content_creator_feedback.items() if item.rating is not None},
+            'evaluator_feedback': self.evaluator_feedback,
+            'improvements_needed': self.improvements_needed,
+            'needs_improvement': self.needs_improvement,
+            'everything': self.everything,
+        }
@@ -0,0 +1,49 @@
+import argparse
+import os
+import pandas as pd
+from utils.analytics import ScoreAnalytics
+from config import STORAGE_BACKEND
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report AI-vs-user score disagreement, trends and drift from the memory database.")
+    parser.add_argument('--db', default='memory.db', help="Memory database to analyse")
+    parser.add_argument('--session', help="Restrict the report to one session")
+    parser.add_argument('--criterion', help="Restrict the report to one criterion")
+    parser.add_argument('--top-sessions', type=int, default=10, help="Sessions with the largest score drift to list")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error(f"Database not found: {args.db}")
+
+    analytics = ScoreAnalytics(args.db)
+    if STORAGE_BACKEND == 'sqlite':
+        analytics.refresh()
+    else:
+        # The iterations live on the server; the local scores were materialized as they were saved
+        print(f"Reporting scores saved through this application ({STORAGE_BACKEND} backend); rows imported or deleted elsewhere are not reflected.\n")
+    frame = analytics.frame(session_id=args.session, criterion=args.criterion)
+    if frame.empty:
+        print("No scored iterations found.")
+        return
+
+    pd.set_option('display.width', 200)
+    pd.set_option('display.float_format', '{:.2f}'.format)
+    print(f"{frame['iteration_id'].nunique()} iterations in {frame['session_id'].nunique()} sessions\n")
+    print("AI vs user disagreement (gap = AI - user):")
+    print(analytics.disagreement(frame).to_string(), "\n")
+    print("User score trend per iteration:")
+    print(analytics.trends(frame).to_string(), "\n")
+    print("AI score trend per iteration:")
+    print(analytics.trends(frame, column='ai_score').to_string(), "\n")
+
+    drift = analytics.session_drift(frame)
+    drift = drift[drift['iterations'] > 1]
+    if not drift.empty:
+        by_session = drift.groupby(level='session_id')[['score_drift', 'gap_drift']].mean()
+        print(f"Sessions with the largest mean score drift (top {args.top_sessions}):")
+        print(by_session.reindex(by_session['score_drift'].abs().sort_values(ascending=False).index).head(args.top_sessions).to_string())
+
+
+if __name__ == "__main__":
+    main()
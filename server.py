@@ -0,0 +1,364 @@
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from flask import Flask, Response, g, jsonify, request
+from loguru import logger
+from agents.content_creator import ContentCreator
+from agents.evaluator import Evaluator
+from agents.feedback_agent import FeedbackAgent
+from models.evaluation import UserEvaluation
+from utils.memory import Memory
+from utils.guidelines import EVALUATION_CRITERIA
+from utils.usage import UsageTracker
+from utils.feedback_gate import gate_stats
+from utils.rate_limit import rate_limiter
+from utils.scheduler import scheduler, request_context, PRIORITIES, INTERACTIVE
+from utils.single_flight import flight_stats
+from config import (SERVICE_DATA_DIR, SERVICE_WORKERS, SERVICE_QUEUE_SIZE, SERVICE_MAX_WORKSPACES,
+                    SERVICE_WORKSPACE_IDLE_SECONDS, MAX_MEMORY_SIZE)
+
+USER_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+SSE_KEEPALIVE_SECONDS = 15
+
+
+class QueueFull(Exception):
+    pass
+
+
+class UserWorkspace:
+    # Memory and agents are built by open(), outside the global workspaces lock, so a slow
+    # Memory init only holds up requests for the same user
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.memory = None
+        # A user's memory holds one session, so their jobs run one at a time: while one runs,
+        # the next wait in jobs without taking a worker (see WorkerPool.submit)
+        self.lock = threading.Lock()
+        self.jobs = deque()
+        self.running = False
+        self.holders = 0  # requests currently using the workspace; it is never evicted while held
+        self.last_used = time.monotonic()
+        self._open_lock = threading.Lock()
+
+    def open(self):
+        with self._open_lock:
+            if self.memory is None:
+                logger.info(f"Opening workspace for user {self.user_id}")
+                os.makedirs(SERVICE_DATA_DIR, exist_ok=True)
+                self.memory = Memory(
+                    max_size=MAX_MEMORY_SIZE,
+                    db_path=os.path.join(SERVICE_DATA_DIR, f'memory_{self.user_id}.db'),
+                    usage_tracker=UsageTracker()
+                )
+                self.creator = ContentCreator(memory=self.memory)
+                self.evaluator = Evaluator(memory=self.memory)
+                self.feedback_agent = FeedbackAgent(memory=self.memory)
+        return self
+
+    def busy(self):
+        return bool(self.holders or self.running or self.jobs)
+
+    def close(self):
+        if self.memory is not None:
+            self.memory.storage.close()
+
+
+class Job:
+    def __init__(self, name, executor, slots, fn, args, workspace=None):
+        self.name = name
+        self.started = threading.Event()
+        self.future = Future()
+        self.executor = executor
+        self.slots = slots
+        self.fn = fn
+        self.args = args
+        self.workspace = workspace
+
+
+class WorkerPool:
+    def __init__(self, workers=SERVICE_WORKERS, queue_size=SERVICE_QUEUE_SIZE):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='instructo-worker')
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        # Refinement and batch jobs get their own workers and queue so they never hold up interactive jobs
+        self.background_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='instructo-background')
+        self.background_slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self.counters = {'pending': 0, 'running': 0, 'completed': 0, 'failed': 0, 'rejected': 0}
+
+    def submit(self, name, fn, *args, background=False, workspace=None):
+        # Jobs for a workspace are dispatched one at a time, so a user with many queued jobs
+        # never fills the workers with threads blocked on their own lock
+        slots = self.background_slots if background else self.slots
+        if not slots.acquire(blocking=False):
+            with self._lock:
+                self.counters['rejected'] += 1
+            raise QueueFull()
+        executor = self.background_executor if background else self.executor
+        job = Job(name, executor, slots, fn, args, workspace)
+        with self._lock:
+            self.counters['pending'] += 1
+            if workspace is not None:
+                if workspace.running:
+                    workspace.jobs.append(job)
+                    return job
+                workspace.running = True
+        job.executor.submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        with self._lock:
+            self.counters['pending'] -= 1
+            self.counters['running'] += 1
+        job.started.set()
+        try:
+            result = job.fn(*job.args)
+            with self._lock:
+                self.counters['completed'] += 1
+            job.future.set_result(result)
+        except Exception as e:
+            with self._lock:
+                self.counters['failed'] += 1
+            job.future.set_exception(e)
+        finally:
+            next_job = None
+            with self._lock:
+                self.counters['running'] -= 1
+                if job.workspace is not None:
+                    if job.workspace.jobs:
+                        next_job = job.workspace.jobs.popleft()
+                    else:
+                        job.workspace.running = False
+            job.slots.release()
+            if next_job:
+                next_job.executor.submit(self._run, next_job)
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.workers, **self.counters}
+
+
+app = Flask(__name__)
+pool = WorkerPool()
+workspaces = OrderedDict()  # user id -> UserWorkspace, least recently used first
+workspaces_lock = threading.Lock()
+
+
+def evict_workspaces(now):
+    # Called with workspaces_lock held; returns the evicted workspaces for the caller to close
+    over = len(workspaces) - SERVICE_MAX_WORKSPACES
+    evicted = []
+    for user_id, workspace in list(workspaces.items()):
+        if workspace.busy():
+            continue
+        if over > 0 or now - workspace.last_used > SERVICE_WORKSPACE_IDLE_SECONDS:
+            del workspaces[user_id]
+            evicted.append(workspace)
+            over -= 1
+    return evicted
+
+
+def get_workspace(user_id):
+    # The workspace is held until the request ends (release_workspaces), and its queued jobs keep it busy after that
+    now = time.monotonic()
+    with workspaces_lock:
+        workspace = workspaces.get(user_id)
+        if workspace is None:
+            workspace = workspaces[user_id] = UserWorkspace(user_id)
+        workspaces.move_to_end(user_id)
+        workspace.holders += 1
+        workspace.last_used = now
+        evicted = evict_workspaces(now)
+    g.setdefault('workspaces', []).append(workspace)
+    for stale in evicted:
+        logger.info(f"Closing idle workspace for user {stale.user_id}")
+        stale.close()
+    return workspace.open()
+
+
+def create_job(workspace, prompt):
+    with workspace.lock:
+        return {'content': workspace.creator.create_content(prompt)}
+
+
+def evaluate_job(workspace, prompt, content):
+    with workspace.lock:
+        evaluation = workspace.evaluator.evaluate_content(content, prompt)
+        return {'evaluation': evaluation, 'calibrated_scores': workspace.memory.calibration.calibrate(evaluation)}
+
+
+def feedback_job(workspace, prompt, content, evaluation, user_eval_content, user_feedback_evaluator):
+    with workspace.lock:
+        recent_iterations = workspace.memory.get_recent_iterations(5)
+        feedback = workspace.feedback_agent.analyze_interaction(
+            recent_iterations, prompt, content, evaluation, user_eval_content, user_feedback_evaluator
+        )
+        workspace.memory.add_iteration(prompt, content, evaluation, user_eval_content, user_feedback_evaluator, feedback)
+        return {'feedback': feedback, 'iteration_count': workspace.memory.get_iteration_count()}
+
+
+def incorporate_job(workspace, feedback, additional_feedback):
+    with workspace.lock:
+        return {'feedback': workspace.feedback_agent.incorporate_user_feedback(feedback, additional_feedback)}
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_job(job):
+    yield sse_event('queued', {'job': job.name})
+    while not job.started.wait(SSE_KEEPALIVE_SECONDS):
+        yield ": keep-alive\n\n"
+    yield sse_event('started', {'job': job.name})
+    while True:
+        try:
+            result = job.future.result(timeout=SSE_KEEPALIVE_SECONDS)
+            yield sse_event('result', result)
+            return
+        except FutureTimeout:
+            yield ": keep-alive\n\n"
+        except Exception as e:
+            yield sse_event('error', {'error': str(e)})
+            return
+
+
+def scheduled(priority, tenant, fn, *args):
+    with request_context(priority, tenant):
+        return fn(*args)
+
+
+def run_job(name, fn, workspace, *args):
+    # Clients mark bulk traffic with ?priority=batch (or an X-Priority header) so that it yields to interactive turns
+    priority = request.args.get('priority') or request.headers.get('X-Priority') or INTERACTIVE
+    if priority not in PRIORITIES:
+        return jsonify({'error': f"Unknown priority: {priority}"}), 400
+    tenant = (request.view_args or {}).get('user_id')
+    try:
+        job = pool.submit(name, scheduled, priority, tenant, fn, workspace, *args, background=priority != INTERACTIVE,
+                          workspace=workspace)
+    except QueueFull:
+        response = jsonify({'error': 'Server busy, retry later'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+        return response
+
+    if request.args.get('stream') == '1' or 'text/event-stream' in request.headers.get('Accept', ''):
+        return Response(stream_job(job), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    try:
+        return jsonify(job.future.result())
+    except Exception as e:
+        logger.exception(e)
+        return jsonify({'error': str(e)}), 500
+
+
+def require_fields(payload, *fields):
+    missing = [field for field in fields if payload.get(field) in (None, '')]
+    if missing:
+        return jsonify({'error': f"Missing fields: {', '.join(missing)}"}), 400
+    return None
+
+
+@app.before_request
+def validate_user():
+    user_id = (request.view_args or {}).get('user_id')
+    if user_id is not None and not USER_ID_PATTERN.match(user_id):
+        return jsonify({'error': 'Invalid user id'}), 400
+
+
+@app.teardown_request
+def release_workspaces(error=None):
+    now = time.monotonic()
+    with workspaces_lock:
+        for workspace in g.pop('workspaces', []):
+            workspace.holders -= 1
+            workspace.last_used = now
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({'status': 'ok', 'pool': pool.stats(), 'users': len(workspaces), 'feedback_gating': gate_stats.snapshot(),
+                    'rate_limits': rate_limiter.snapshot(), 'scheduler': scheduler.snapshot(),
+                    'single_flight': flight_stats()})
+
+
+@app.route('/users/<user_id>/sessions', methods=['POST'])
+def new_session(user_id):
+    workspace = get_workspace(user_id)
+    with workspace.lock:
+        workspace.memory.start_new_session()
+        return jsonify({'session_id': workspace.memory.session_id})
+
+
+@app.route('/users/<user_id>/create', methods=['POST'])
+def create(user_id):
+    payload = request.get_json(silent=True) or {}
+    if error := require_fields(payload, 'prompt'):
+        return error
+    return run_job('create', create_job, get_workspace(user_id), payload['prompt'])
+
+
+@app.route('/users/<user_id>/evaluate', methods=['POST'])
+def evaluate(user_id):
+    payload = request.get_json(silent=True) or {}
+    if error := require_fields(payload, 'prompt', 'content'):
+        return error
+    return run_job('evaluate', evaluate_job, get_workspace(user_id), payload['prompt'], payload['content'])
+
+
+@app.route('/users/<user_id>/feedback', methods=['POST'])
+def feedback(user_id):
+    payload = request.get_json(silent=True) or {}
+    if error := require_fields(payload, 'prompt', 'content', 'evaluation', 'user_scores'):
+        return error
+    # Validated before the job is queued, so a bad request never pays for the feedback-agent call
+    try:
+        user_scores = {criterion: float(score) for criterion, score in payload['user_scores'].items()}
+    except (AttributeError, TypeError, ValueError):
+        return jsonify({'error': 'user_scores must map criteria to numbers'}), 400
+    user_feedback = payload.get('user_feedback') or {}
+    if not isinstance(user_feedback, dict):
+        return jsonify({'error': 'user_feedback must map criteria to text'}), 400
+    unknown = [criterion for criterion in list(user_scores) + list(user_feedback) if criterion not in EVALUATION_CRITERIA]
+    if not user_scores or unknown:
+        return jsonify({'error': f"user_scores must rate evaluation criteria ({', '.join(EVALUATION_CRITERIA)})"
+                                 + (f"; unknown: {', '.join(unknown)}" if unknown else '')}), 400
+    if any(not 0 <= score <= 10 for score in user_scores.values()):
+        return jsonify({'error': 'user_scores must be between 0 and 10'}), 400
+    user_eval_content = UserEvaluation(user_scores, {criterion: str(user_feedback.get(criterion, '')) for criterion in user_scores})
+    return run_job('feedback', feedback_job, get_workspace(user_id), payload['prompt'], payload['content'],
+                   payload['evaluation'], user_eval_content, payload.get('user_feedback_evaluator', ''))
+
+
+@app.route('/users/<user_id>/feedback/incorporate', methods=['POST'])
+def incorporate(user_id):
+    payload = request.get_json(silent=True) or {}
+    if error := require_fields(payload, 'feedback', 'additional_feedback'):
+        return error
+    return run_job('incorporate', incorporate_job, get_workspace(user_id), payload['feedback'], payload['additional_feedback'])
+
+
+@app.route('/users/<user_id>/usage', methods=['GET'])
+def user_usage(user_id):
+    workspace = get_workspace(user_id)
+    return jsonify({
+        'session': workspace.memory.usage.snapshot(),
+        'stored': workspace.memory.get_usage_summary(request.args.get('session_id')),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the Instructo agents over HTTP.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
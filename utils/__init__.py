@@ -1,3 +1,4 @@
 from .api_handler import PerplexityAPI
 from .guidelines import EVALUATION_CRITERIA
-from .memory import Memory
\ No newline at end of file
+from .memory import Memory
+from .usage import UsageTracker
\ No newline at end of file
@@ -0,0 +1,171 @@
+import json
+import sqlite3
+import numpy as np
+import pandas as pd
+from loguru import logger
+from utils.topics import criterion_scores
+
+
+def _grouped_moments(frame, keys, x, y):
+    # Per-group means of x, y, x*y, x^2 and y^2, from which covariance, correlation
+    # and regression slope follow without iterating over groups
+    moments = pd.DataFrame({
+        'x': frame[x], 'y': frame[y], 'xy': frame[x] * frame[y],
+        'xx': frame[x] ** 2, 'yy': frame[y] ** 2,
+    })
+    for key in keys:
+        moments[key] = frame[key]
+    grouped = moments.groupby(keys)
+    means = grouped[['x', 'y', 'xy', 'xx', 'yy']].mean()
+    means['count'] = grouped.size()
+    means['cov'] = means['xy'] - means['x'] * means['y']
+    means['var_x'] = (means['xx'] - means['x'] ** 2).clip(lower=0)
+    means['var_y'] = (means['yy'] - means['y'] ** 2).clip(lower=0)
+    return means
+
+
+class ScoreAnalytics:
+    # Per-criterion AI and user scores, materialized from the iterations table into
+    # criterion_scores (one row per iteration and criterion) and analysed as columns
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._init_db()
+
+    def _init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS criterion_scores (
+                iteration_id INTEGER,
+                session_id TEXT,
+                timestamp TEXT,
+                criterion TEXT,
+                ai_score REAL,
+                user_score REAL,
+                PRIMARY KEY (iteration_id, criterion)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_criterion_scores_session ON criterion_scores (session_id, criterion)')
+        conn.commit()
+        conn.close()
+
+    def _score_rows(self, iteration_id, session_id, timestamp, iteration):
+        ai_scores, user_scores = criterion_scores(iteration)
+        return [(iteration_id, session_id, timestamp, criterion, ai_scores.get(criterion), user_scores.get(criterion))
+                for criterion in sorted(set(ai_scores) | set(user_scores))]
+
+    def add(self, iteration_id, session_id, iteration):
+        conn = sqlite3.connect(self.db_path)
+        conn.executemany('INSERT OR REPLACE INTO criterion_scores VALUES (?, ?, ?, ?, ?, ?)',
+                         self._score_rows(iteration_id, session_id, iteration['timestamp'], iteration))
+        conn.commit()
+        conn.close()
+
+    def refresh(self, chunk_size=5000):
+        # Catch up with rows written outside Memory (restores, imports, older databases)
+        # and drop scores of iterations that were deleted or archived
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            DELETE FROM criterion_scores WHERE NOT EXISTS (
+                SELECT 1 FROM iterations WHERE iterations.id = criterion_scores.iteration_id
+            )
+        ''')
+        removed = cursor.rowcount
+        added = 0
+        last_id = 0
+        while True:
+            cursor.execute('''
+                SELECT id, session_id, timestamp, ai_evaluation, user_evaluation_content FROM iterations
+                WHERE id > ? AND user_evaluation_content IS NOT NULL AND NOT EXISTS (
+                    SELECT 1 FROM criterion_scores WHERE criterion_scores.iteration_id = iterations.id
+                )
+                ORDER BY id LIMIT ?
+            ''', (last_id, chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            records = []
+            for iteration_id, session_id, timestamp, ai_evaluation, user_evaluation in rows:
+                iteration = {'ai_evaluation': json.loads(ai_evaluation or 'null'),
+                             'user_evaluation_content': json.loads(user_evaluation or 'null')}
+                records.extend(self._score_rows(iteration_id, session_id, timestamp, iteration))
+            cursor.executemany('INSERT OR REPLACE INTO criterion_scores VALUES (?, ?, ?, ?, ?, ?)', records)
+            added += len(rows)
+            last_id = rows[-1][0]
+        conn.commit()
+        conn.close()
+        if added or removed:
+            logger.info(f"Materialized criterion scores: {added} iterations added, {removed} score rows removed")
+        return added, removed
+
+    def frame(self, session_id=None, criterion=None):
+        query = 'SELECT iteration_id, session_id, timestamp, criterion, ai_score, user_score FROM criterion_scores'
+        conditions, params = [], []
+        if session_id:
+            conditions.append('session_id = ?')
+            params.append(session_id)
+        if criterion:
+            conditions.append('criterion = ?')
+            params.append(criterion)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        conn = sqlite3.connect(self.db_path)
+        frame = pd.read_sql_query(query + ' ORDER BY iteration_id', conn, params=params)
+        conn.close()
+        frame['gap'] = frame['ai_score'] - frame['user_score']
+        return frame
+
+    def disagreement(self, frame=None):
+        # AI minus user score per criterion: bias, spread and agreement of the two raters
+        frame = self.frame() if frame is None else frame
+        scored = frame.dropna(subset=['ai_score', 'user_score'])
+        moments = _grouped_moments(scored, ['criterion'], 'ai_score', 'user_score')
+        grouped = scored.assign(abs_gap=scored['gap'].abs()).groupby('criterion')
+        result = pd.DataFrame({
+            'count': moments['count'],
+            'ai_mean': moments['x'],
+            'user_mean': moments['y'],
+            'mean_gap': grouped['gap'].mean(),
+            'mean_abs_gap': grouped['abs_gap'].mean(),
+            'gap_std': grouped['gap'].std(ddof=0),
+        })
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result['correlation'] = moments['cov'] / np.sqrt(moments['var_x'] * moments['var_y'])
+        return result.sort_values('mean_abs_gap', ascending=False)
+
+    def trends(self, frame=None, column='user_score'):
+        # Least-squares slope of the score per stored iteration, for each criterion
+        frame = self.frame() if frame is None else frame
+        scored = frame.dropna(subset=[column])
+        scored = scored.assign(position=scored.groupby('criterion').cumcount().astype(float))
+        moments = _grouped_moments(scored, ['criterion'], 'position', column)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = moments['cov'] / moments['var_x']
+        grouped = scored.groupby('criterion')[column]
+        return pd.DataFrame({
+            'count': moments['count'],
+            'mean': moments['y'],
+            'slope': slope.fillna(0.0),
+            'first': grouped.first(),
+            'last': grouped.last(),
+        })
+
+    def session_drift(self, frame=None):
+        # Change of the user score and of the AI-user gap from first to last iteration of each session
+        frame = self.frame() if frame is None else frame
+        grouped = frame.groupby(['session_id', 'criterion'])
+        first = grouped[['user_score', 'gap']].first()
+        last = grouped[['user_score', 'gap']].last()
+        return pd.DataFrame({
+            'iterations': grouped.size(),
+            'user_first': first['user_score'],
+            'user_last': last['user_score'],
+            'score_drift': last['user_score'] - first['user_score'],
+            'gap_drift': last['gap'] - first['gap'],
+        })
+
+    def best_iterations(self, top_n=5, criterion=None):
+        frame = self.frame(criterion=criterion)
+        totals = frame.groupby('iteration_id')['user_score'].mean()
+        return totals.nlargest(top_n)
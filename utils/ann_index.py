@@ -0,0 +1,279 @@
+import fcntl
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import numpy as np
+from loguru import logger
+from config import ANN_MIN_ROWS, ANN_REBUILD_DELTA, ANN_KMEANS_ITERATIONS
+
+BUILD_CHUNK_ROWS = 4096
+STALE_LOCK_SECONDS = 3600
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class AnnIndex:
+    # IVF index over the stored embeddings, kept next to the database in <db>.ann/.
+    # Each generation directory holds the compacted base (vectors grouped by inverted
+    # list, memory-mapped read-only so processes share the page cache) and an
+    # append-only delta of rows added since, searched exhaustively until the next
+    # background compaction folds it into a new generation.
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.path = f"{db_path}.ann"
+        self._lock = threading.Lock()
+        self._meta_mtime = None
+        self.meta = None
+        self.centroids = None
+        self.vectors = None
+        self.ids = None
+        self.offsets = None
+        self._building = False
+        self._reload()
+
+    def _file(self, name, generation=None):
+        generation = self.meta['generation'] if generation is None else generation
+        return os.path.join(self.path, f"gen-{generation}", name)
+
+    def _reload(self):
+        meta_path = os.path.join(self.path, 'meta.json')
+        try:
+            mtime = os.stat(meta_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._meta_mtime:
+            return
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        dim, count = meta['dim'], meta['count']
+        self.centroids = np.load(self._file('centroids.npy', meta['generation']))
+        self.offsets = np.load(self._file('offsets.npy', meta['generation']))
+        self.vectors = np.memmap(self._file('vectors.f32', meta['generation']), dtype='<f4', mode='r', shape=(count, dim)) if count else np.zeros((0, dim), '<f4')
+        self.ids = np.memmap(self._file('ids.i64', meta['generation']), dtype='<i8', mode='r', shape=(count,)) if count else np.zeros(0, '<i8')
+        self.meta = meta
+        self._meta_mtime = mtime
+
+    def _record_dtype(self):
+        return np.dtype([('id', '<i8'), ('vector', '<f4', (self.meta['dim'],))])
+
+    def _delta(self):
+        delta_path = self._file('delta.bin')
+        dtype = self._record_dtype()
+        size = os.path.getsize(delta_path) if os.path.exists(delta_path) else 0
+        rows = size // dtype.itemsize
+        return np.memmap(delta_path, dtype=dtype, mode='r', shape=(rows,)) if rows else np.zeros(0, dtype)
+
+    def count(self):
+        self._reload()
+        if not self.meta:
+            return 0
+        return self.meta['count'] + len(self._delta())
+
+    def add(self, iteration_id, embedding):
+        self._reload()
+        if not self.meta:
+            self.maybe_rebuild()
+            return
+        vector = _normalize(np.asarray(embedding, dtype='<f4'))
+        if vector.shape[0] != self.meta['dim']:
+            logger.warning(f"Embedding dimension {vector.shape[0]} does not match the ANN index ({self.meta['dim']}), rebuilding")
+            self.rebuild_in_background()
+            return
+        record = np.zeros(1, self._record_dtype())
+        record['id'] = iteration_id
+        record['vector'] = vector
+        while True:
+            generation = self.meta['generation']
+            try:
+                with open(self._file('delta.bin', generation), 'ab') as f:
+                    # A compaction holds this lock while it carries the delta over and publishes the next
+                    # generation; appending only to the still-current generation means no row is lost
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    self._reload()
+                    if self.meta['generation'] == generation:
+                        f.write(record.tobytes())
+                        break
+            except FileNotFoundError:  # generation already removed
+                self._reload()
+        self.maybe_rebuild()
+
+    def maybe_rebuild(self):
+        if self.meta:
+            if len(self._delta()) >= max(ANN_REBUILD_DELTA, self.meta['count'] // 10):
+                self.rebuild_in_background()
+            return
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute("SELECT COUNT(*) FROM iterations WHERE embedding IS NOT NULL AND kind = 'iteration'").fetchone()[0]
+        conn.close()
+        if rows >= ANN_MIN_ROWS:
+            self.rebuild_in_background()
+
+    def search(self, query_embedding, top_k, nprobe):
+        # Returns [(iteration_id, similarity)], best first; nprobe trades recall for latency
+        self._reload()
+        if not self.meta:
+            return []
+        query = _normalize(np.asarray(query_embedding, dtype='<f4'))
+        if query.shape[0] != self.meta['dim']:
+            return []
+        id_parts, score_parts = [], []
+        if len(self.centroids):
+            lists = np.argsort(-(self.centroids @ query))[:max(1, nprobe)]
+            for inverted_list in lists:
+                start, end = self.offsets[inverted_list], self.offsets[inverted_list + 1]
+                if end > start:
+                    id_parts.append(self.ids[start:end])
+                    score_parts.append(self.vectors[start:end] @ query)
+        delta = self._delta()
+        if len(delta):
+            id_parts.append(delta['id'])
+            score_parts.append(delta['vector'] @ query)
+        if not id_parts:
+            return []
+        ids = np.concatenate(id_parts)
+        scores = np.concatenate(score_parts)
+        if len(scores) > top_k:
+            best = np.argpartition(-scores, top_k)[:top_k]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best])]
+        # A row can be in both the base and the delta while a compaction is being published
+        results, seen = [], set()
+        for index in best:
+            iteration_id = int(ids[index])
+            if iteration_id not in seen:
+                seen.add(iteration_id)
+                results.append((iteration_id, float(scores[index])))
+        return results
+
+    def rebuild_in_background(self):
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+
+        def run():
+            try:
+                self.rebuild()
+            except Exception as e:
+                logger.error(f"ANN index rebuild failed: {e}")
+            finally:
+                self._building = False
+
+        threading.Thread(target=run, name='ann-rebuild', daemon=True).start()
+
+    def _acquire_build_lock(self):
+        lock_path = os.path.join(self.path, 'build.lock')
+        try:
+            if time.time() - os.path.getmtime(lock_path) > STALE_LOCK_SECONDS:
+                os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL))
+            return lock_path
+        except FileExistsError:
+            return None
+
+    def rebuild(self):
+        os.makedirs(self.path, exist_ok=True)
+        lock_path = self._acquire_build_lock()
+        if not lock_path:
+            logger.info("ANN index rebuild already running in another process")
+            return None
+        try:
+            return self._build()
+        finally:
+            os.remove(lock_path)
+
+    def _publish(self, meta):
+        temporary = os.path.join(self.path, 'meta.json.tmp')
+        with open(temporary, 'w') as f:
+            json.dump(meta, f)
+        os.replace(temporary, os.path.join(self.path, 'meta.json'))
+
+    def _build(self):
+        start = time.perf_counter()
+        self._reload()
+        generation = (self.meta['generation'] + 1) if self.meta else 1
+        directory = os.path.join(self.path, f"gen-{generation}")
+        os.makedirs(directory, exist_ok=True)
+
+        # Pass 1: stream embeddings from SQLite into an unsorted scratch file
+        unsorted_path = os.path.join(directory, 'unsorted.f32')
+        ids, dim = [], None
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, embedding FROM iterations WHERE embedding IS NOT NULL AND kind = 'iteration' ORDER BY id")
+        with open(unsorted_path, 'wb') as f:
+            while True:
+                rows = cursor.fetchmany(BUILD_CHUNK_ROWS)
+                if not rows:
+                    break
+                chunk = np.asarray([json.loads(embedding) for _, embedding in rows], dtype='<f4')
+                dim = dim or chunk.shape[1]
+                if chunk.shape[1] != dim:
+                    raise ValueError("Stored embeddings have mixed dimensions; re-embed the database first")
+                f.write(_normalize(chunk).astype('<f4').tobytes())
+                ids.extend(row_id for row_id, _ in rows)
+        conn.close()
+        if not ids:
+            shutil.rmtree(directory)
+            return None
+        count = len(ids)
+        ids = np.asarray(ids, dtype='<i8')
+        unsorted = np.memmap(unsorted_path, dtype='<f4', mode='r', shape=(count, dim))
+
+        # Coarse quantizer: k-means on a sample, then every vector assigned to its nearest centroid
+        rng = np.random.default_rng(0)
+        nlist = max(1, int(np.sqrt(count)))
+        sample = np.asarray(unsorted[np.sort(rng.choice(count, min(count, nlist * 64), replace=False))])
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(ANN_KMEANS_ITERATIONS):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            filled = np.bincount(assignment, minlength=nlist) > 0
+            centroids[filled] = _normalize(sums[filled])
+        labels = np.concatenate([np.argmax(unsorted[offset:offset + BUILD_CHUNK_ROWS] @ centroids.T, axis=1)
+                                 for offset in range(0, count, BUILD_CHUNK_ROWS)])
+
+        # Pass 2: write vectors grouped by inverted list
+        order = np.argsort(labels, kind='stable')
+        vectors = np.memmap(os.path.join(directory, 'vectors.f32'), dtype='<f4', mode='w+', shape=(count, dim))
+        for offset in range(0, count, BUILD_CHUNK_ROWS):
+            vectors[offset:offset + BUILD_CHUNK_ROWS] = unsorted[order[offset:offset + BUILD_CHUNK_ROWS]]
+        vectors.flush()
+        del vectors, unsorted
+        os.remove(unsorted_path)
+        ids[order].tofile(os.path.join(directory, 'ids.i64'))
+        np.save(os.path.join(directory, 'centroids.npy'), centroids.astype('<f4'))
+        np.save(os.path.join(directory, 'offsets.npy'), np.searchsorted(labels[order], np.arange(nlist + 1)))
+
+        watermark = int(ids.max())
+        meta = {'generation': generation, 'dim': int(dim), 'count': count, 'nlist': nlist, 'watermark': watermark,
+                'built_at': time.time()}
+        previous = self.meta['generation'] if self.meta else None
+        if previous is None:
+            self._publish(meta)
+        else:
+            # Carry over delta rows added while building and publish while holding the old delta's
+            # lock, so writers append either before the copy or to the new generation
+            with open(self._file('delta.bin', previous), 'ab') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                delta = self._delta()
+                delta[delta['id'] > watermark].tofile(os.path.join(directory, 'delta.bin'))
+                self._publish(meta)
+        self._reload()
+        if previous is not None:
+            # Readers that still map the old files keep them alive until they reload
+            shutil.rmtree(os.path.join(self.path, f"gen-{previous}"), ignore_errors=True)
+        logger.info(f"Built ANN index generation {generation}: {count} vectors, {nlist} lists in {time.perf_counter() - start:.1f}s")
+        return meta
@@ -1,23 +1,155 @@
 import litellm
 from litellm import completion
 import os
-from config import API_KEY
+import math
+import threading
+import time
+import yaml
+from collections import defaultdict, deque
+from loguru import logger
+from config import API_KEY, ROUTING_CONFIG_FILE, STUB_LLM
+from utils.usage import usage
+from utils.prefix_cache import prefix_stats
+from utils.stubs import stub_completion
+from utils.recorder import recorder
+from utils.rate_limit import rate_limiter, estimate_tokens
+from utils.scheduler import scheduler, current_priority
+from utils.single_flight import SingleFlight, request_key
+from utils.profiler import profiler
 
 litellm.set_verbose=False
 
+completion_flight = SingleFlight('completion')
+
+
+class ModelRouter:
+    def __init__(self, config_path=ROUTING_CONFIG_FILE):
+        self.config = self._load_config(config_path)
+        window = self.config.get('latency_window', 50)
+        self.latencies = defaultdict(lambda: deque(maxlen=window))
+        self.failed_until = {}
+        self._lock = threading.Lock()
+
+    def _load_config(self, config_path):
+        if not config_path or not os.path.exists(config_path):
+            logger.info(f"No routing config at {config_path}, using the models configured in config.py.")
+            return {}
+        with open(config_path, 'r') as f:
+            config = yaml.safe_load(f) or {}
+        logger.info(f"Loaded routing config from {config_path} for agents: {', '.join(config.get('agents', {}))}")
+        return config
+
+    def tier_for_round(self, round_index):
+        draft_final = self.config.get('draft_final', {})
+        if draft_final.get('enabled') and round_index < draft_final.get('draft_rounds', 1):
+            return 'draft'
+        return 'final'
+
+    def p95(self, model):
+        with self._lock:
+            samples = sorted(self.latencies[model])
+        if not samples:
+            return None
+        return samples[max(0, math.ceil(0.95 * len(samples)) - 1)]
+
+    def record_latency(self, model, seconds):
+        with self._lock:
+            self.latencies[model].append(seconds)
+            self.failed_until.pop(model, None)
+
+    def record_failure(self, model):
+        cooldown = self.config.get('cooldown_seconds', 60)
+        with self._lock:
+            self.failed_until[model] = time.monotonic() + cooldown
+        logger.warning(f"Model {model} failed, skipping it for {cooldown}s")
+
+    def candidates(self, agent, model, tier=None):
+        agent_config = self.config.get('agents', {}).get(agent, {})
+        models = agent_config.get('draft_models') if tier == 'draft' else None
+        models = list(models or agent_config.get('models') or [model])
+
+        now = time.monotonic()
+        slow = self.config.get('slow_p95_seconds')
+        fastest = self.config.get('strategy') == 'fastest'
+
+        def sort_key(item):
+            index, name = item
+            p95 = self.p95(name)
+            cooling_down = self.failed_until.get(name, 0) > now
+            if fastest:
+                return (cooling_down, p95 or 0.0, index)
+            return (cooling_down, bool(slow and p95 and p95 > slow), index)
+
+        # Models in cooldown stay at the back so a fully degraded tier still gets tried
+        return [name for _, name in sorted(enumerate(models), key=sort_key)]
+
+    def stats(self):
+        return {model: {'calls': len(self.latencies[model]), 'p95': self.p95(model)} for model in list(self.latencies)}
+
+
 class PerplexityAPI:
     def __init__(self):
-        os.environ['PERPLEXITYAI_API_KEY'] = API_KEY
-
-    def get_completion(self, model, messages):
-        try:
-            response = completion(
-                model=model,
-                messages=messages
-            )
-            return response
-        except Exception as e:
-            print(f"API request failed: {e}")
+        os.environ['PERPLEXITYAI_API_KEY'] = API_KEY or ''
+        self.router = ModelRouter()
+
+    def tier_for_round(self, round_index):
+        return self.router.tier_for_round(round_index)
+
+    def _complete(self, model, messages, agent, params):
+        if STUB_LLM:
+            with scheduler.slot():
+                return stub_completion(model, messages, agent)
+        # The scheduler slot is taken only once rate limit quota is reserved, so callers
+        # waiting for headroom do not hold slots that other classes could use
+        return rate_limiter.call(model, estimate_tokens(messages), lambda: completion(
+            model=model,
+            messages=messages,
+            **params
+        ), slot=scheduler.slot)
+
+    def _scheduled(self, model, messages, agent, params, request):
+        live_call = lambda: self._complete(model, messages, agent, params)
+        if not recorder.replaying:
+            return recorder.call('completion', request, live_call)
+        # A replay sleeps through the recorded latency, holding a slot as the live call did
+        with scheduler.slot():
+            return recorder.call('completion', request, live_call)
+
+    def get_completion(self, model, messages, agent=None, tier=None, tracker=None, **params):
+        # params are passed through to the completion call (e.g. temperature)
+        tracker = tracker or usage
+        budget_model = tracker.apply_budget(model)
+        if budget_model is None:
+            print("API request skipped: session budget exceeded")
             return None
+        if budget_model != model:
+            candidates = [budget_model]
+        else:
+            candidates = self.router.candidates(agent, model, tier)
+
+        prefix_stats.record(agent, messages)
+        request = {'agent': agent, 'messages': messages, **({'params': params} if params else {})}
+        with profiler.stage(f"agent:{agent or 'unknown'}"):
+            for candidate in candidates:
+                start = time.perf_counter()
+                try:
+                    if params.get('temperature'):
+                        # Sampled on purpose (best-of-N candidates): every caller needs its own draw
+                        response, shared = self._scheduled(candidate, messages, agent, params, request), False
+                    else:
+                        # Keyed by priority too, so an interactive caller never waits on a batch call's slot
+                        response, shared = completion_flight.do(request_key(candidate, messages, params, current_priority()),
+                                                                lambda: self._scheduled(candidate, messages, agent, params, request))
+                except Exception as e:
+                    print(f"API request failed ({candidate}): {e}")
+                    self.router.record_failure(candidate)
+                    continue
+                if shared:
+                    # Identical request already in flight for another caller: its latency and usage are accounted there
+                    return response
+                self.router.record_latency(candidate, time.perf_counter() - start)
+                tracker.record(agent, candidate, response)
+                return response
+        return None
 
-api = PerplexityAPI()
\ No newline at end of file
+api = PerplexityAPI()
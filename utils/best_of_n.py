@@ -0,0 +1,55 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from config import BEST_OF_N_CONCURRENCY, CANDIDATE_VARIANTS
+from agents.content_creator import GENERATION_FAILED
+from utils.calibration import ai_scores
+from utils.scheduler import propagate
+
+
+def candidate_score(memory, evaluation):
+    # Mean expected user score: calibrated where the calibration has enough history, raw AI score otherwise
+    scores = ai_scores(evaluation)
+    if not scores:
+        return None
+    calibrated = memory.calibration.calibrate(evaluation)
+    values = [calibrated[criterion] if calibrated.get(criterion) is not None else score for criterion, score in scores.items()]
+    return sum(values) / len(values)
+
+
+def _generate_and_evaluate(creator, evaluator, prompt, variant):
+    content = creator.create_content(prompt, temperature=variant.get('temperature'), instruction=variant.get('instruction'))
+    if content == GENERATION_FAILED:
+        return None
+    evaluation = evaluator.evaluate_content(content, prompt)
+    return {'content': content, 'evaluation': evaluation, 'score': candidate_score(creator.memory, evaluation), 'variant': variant}
+
+
+def select_best_candidate(creator, evaluator, prompt, n, concurrency=BEST_OF_N_CONCURRENCY):
+    # Generates and evaluates n candidates concurrently, returns (content, evaluation) of the best one
+    # and stores the others in memory as rejected candidates
+    variants = [CANDIDATE_VARIANTS[index % len(CANDIDATE_VARIANTS)] for index in range(n)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(n, concurrency)), thread_name_prefix='candidate') as executor:
+        futures = [executor.submit(propagate(_generate_and_evaluate), creator, evaluator, prompt, variant) for variant in variants]
+        candidates = []
+        for future in futures:
+            try:
+                candidate = future.result()
+            except Exception as e:
+                logger.error(f"Candidate generation failed: {e}")
+                continue
+            if candidate:
+                candidates.append(candidate)
+    elapsed = time.perf_counter() - start
+
+    if not candidates:
+        return GENERATION_FAILED, None
+    candidates.sort(key=lambda candidate: candidate['score'] if candidate['score'] is not None else -1.0, reverse=True)
+    best, rejected = candidates[0], candidates[1:]
+    for candidate in rejected:
+        creator.memory.add_rejected_candidate(prompt, candidate['content'], candidate['evaluation'], candidate['score'])
+    scores = ", ".join(f"{candidate['score']:.2f}" if candidate['score'] is not None else "-" for candidate in candidates)
+    logger.info(f"Best of {len(candidates)} candidates in {elapsed:.1f}s (scores: {scores}), "
+                f"selected temperature {best['variant'].get('temperature')}")
+    return best['content'], best['evaluation']
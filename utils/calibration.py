@@ -0,0 +1,184 @@
+import math
+import sqlite3
+from loguru import logger
+from config import CALIBRATION_METHOD, CALIBRATION_MIN_SAMPLES, CALIBRATION_STOP_SCORE, LOW_SCORE_THRESHOLD
+from models.feedback import FeedbackAnalysis
+from utils.guidelines import EVALUATION_CRITERIA
+
+
+def ai_scores(evaluation):
+    if not isinstance(evaluation, dict):
+        return {}
+    return {criterion: float(details['score']) for criterion, details in evaluation.items()
+            if isinstance(details, dict) and isinstance(details.get('score'), (int, float))}
+
+
+def pool_adjacent_violators(points):
+    # points: [(x, weight, mean_y)] sorted by x; returns a non-decreasing fit per point
+    blocks = []
+    for x, weight, value in points:
+        blocks.append([weight, value * weight, 1])
+        while len(blocks) > 1 and blocks[-2][1] / blocks[-2][0] > blocks[-1][1] / blocks[-1][0]:
+            weight, total, size = blocks.pop()
+            blocks[-1][0] += weight
+            blocks[-1][1] += total
+            blocks[-1][2] += size
+    fitted = []
+    for weight, total, size in blocks:
+        fitted.extend([total / weight] * size)
+    return fitted
+
+
+class CriterionModel:
+    # Mapping from AI score to expected user score for one criterion, fitted from
+    # per-AI-score buckets: {bucket: [count, user_sum, user_sq_sum]}
+    def __init__(self, buckets, method):
+        self.method = method
+        self.xs = sorted(buckets)
+        self.count = sum(buckets[x][0] for x in self.xs)
+        if method == 'linear':
+            n = self.count
+            sx = sum(x * buckets[x][0] for x in self.xs)
+            sy = sum(buckets[x][1] for x in self.xs)
+            sxx = sum(x * x * buckets[x][0] for x in self.xs)
+            sxy = sum(x * buckets[x][1] for x in self.xs)
+            variance = n * sxx - sx * sx
+            self.slope = (n * sxy - sx * sy) / variance if variance else 0.0
+            self.intercept = (sy - self.slope * sx) / n if n else 0.0
+            self.fitted = [self.intercept + self.slope * x for x in self.xs]
+        else:
+            self.fitted = pool_adjacent_violators([(x, buckets[x][0], buckets[x][1] / buckets[x][0]) for x in self.xs])
+        squared_error = sum(buckets[x][2] - 2 * fit * buckets[x][1] + buckets[x][0] * fit * fit
+                            for x, fit in zip(self.xs, self.fitted))
+        self.rmse = math.sqrt(max(squared_error, 0.0) / self.count) if self.count else 0.0
+
+    def predict(self, score):
+        if self.method == 'linear':
+            value = self.intercept + self.slope * score
+        elif score <= self.xs[0]:
+            value = self.fitted[0]
+        elif score >= self.xs[-1]:
+            value = self.fitted[-1]
+        else:
+            for index in range(1, len(self.xs)):
+                if score <= self.xs[index]:
+                    low, high = self.xs[index - 1], self.xs[index]
+                    share = (score - low) / (high - low)
+                    value = self.fitted[index - 1] + share * (self.fitted[index] - self.fitted[index - 1])
+                    break
+        return min(10.0, max(0.0, value))
+
+
+class ScoreCalibrator:
+    # Learns per-criterion AI -> user score mappings. Statistics are kept per rounded
+    # AI score in SQLite, so each new iteration is an O(1) update.
+    def __init__(self, db_path, method=CALIBRATION_METHOD, min_samples=CALIBRATION_MIN_SAMPLES):
+        self.db_path = db_path
+        self.method = method
+        self.min_samples = min_samples
+        self.buckets = {}
+        self.models = {}
+        self._init_db()
+        self._load()
+
+    def _init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS calibration_buckets (
+                criterion TEXT,
+                ai_bucket INTEGER,
+                count INTEGER,
+                user_sum REAL,
+                user_sq_sum REAL,
+                PRIMARY KEY (criterion, ai_bucket)
+            )
+        ''')
+        cursor.execute('SELECT COUNT(*) FROM calibration_buckets')
+        if not cursor.fetchone()[0]:
+            # Bootstrap from the materialized score history
+            cursor.execute('''
+                INSERT INTO calibration_buckets
+                SELECT criterion, CAST(ROUND(ai_score) AS INTEGER), COUNT(*), SUM(user_score), SUM(user_score * user_score)
+                FROM criterion_scores WHERE ai_score IS NOT NULL AND user_score IS NOT NULL
+                GROUP BY criterion, CAST(ROUND(ai_score) AS INTEGER)
+            ''')
+            if cursor.rowcount > 0:
+                logger.info(f"Initialized {cursor.rowcount} calibration buckets from stored scores")
+        conn.commit()
+        conn.close()
+
+    def _load(self):
+        conn = sqlite3.connect(self.db_path)
+        for criterion, bucket, count, user_sum, user_sq_sum in conn.execute('SELECT * FROM calibration_buckets'):
+            self.buckets.setdefault(criterion, {})[bucket] = [count, user_sum, user_sq_sum]
+        conn.close()
+        for criterion in self.buckets:
+            self._fit(criterion)
+
+    def _fit(self, criterion):
+        buckets = self.buckets[criterion]
+        if sum(bucket[0] for bucket in buckets.values()) >= self.min_samples:
+            self.models[criterion] = CriterionModel(buckets, self.method)
+
+    def update(self, evaluation, user_scores):
+        scores = ai_scores(evaluation)
+        pairs = [(criterion, int(round(score)), float(user_scores[criterion]))
+                 for criterion, score in scores.items() if criterion in (user_scores or {})]
+        if not pairs:
+            return
+        conn = sqlite3.connect(self.db_path)
+        for criterion, bucket, user_score in pairs:
+            conn.execute('''
+                INSERT INTO calibration_buckets VALUES (?, ?, 1, ?, ?)
+                ON CONFLICT (criterion, ai_bucket) DO UPDATE SET
+                    count = count + 1, user_sum = user_sum + excluded.user_sum, user_sq_sum = user_sq_sum + excluded.user_sq_sum
+            ''', (criterion, bucket, user_score, user_score * user_score))
+            stats = self.buckets.setdefault(criterion, {}).setdefault(bucket, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += user_score
+            stats[2] += user_score * user_score
+            self._fit(criterion)
+        conn.commit()
+        conn.close()
+
+    def calibrate(self, evaluation):
+        # Expected user score per criterion; None where there is too little history
+        return {criterion: self.models[criterion].predict(score) if criterion in self.models else None
+                for criterion, score in ai_scores(evaluation).items()}
+
+    def decide(self, evaluation, user_scores):
+        # True: clearly needs another round, False: clearly done, None: leave it to the feedback agent.
+        # Only decided when every criterion is both calibrated and scored by the user
+        calibrated = self.calibrate(evaluation)
+        user_scores = user_scores or {}
+        bounds = {}
+        for criterion in EVALUATION_CRITERIA:
+            value = calibrated.get(criterion)
+            if value is None or criterion not in user_scores:
+                return None
+            rmse = self.models[criterion].rmse
+            bounds[criterion] = (min(value - rmse, user_scores[criterion]), max(value + rmse, user_scores[criterion]))
+        if (all(low >= CALIBRATION_STOP_SCORE for low, _ in bounds.values())
+                and all(score >= CALIBRATION_STOP_SCORE for score in user_scores.values())):
+            return False
+        if any(high < LOW_SCORE_THRESHOLD for _, high in bounds.values()):
+            return True
+        return None
+
+    def report(self):
+        return {criterion: {'samples': model.count, 'rmse': model.rmse} for criterion, model in self.models.items()}
+
+
+def local_verdict_feedback(calibrated, user_scores):
+    reason = (f"All calibrated AI scores and user scores are at or above {CALIBRATION_STOP_SCORE}/10, "
+              "so no further improvements are needed (decided locally from the evaluator calibration).")
+    analysis = FeedbackAnalysis(
+        overall_analysis=reason,
+        improvements_needed=f"NO. {reason}",
+        needs_improvement=False,
+        everything="### Overall Analysis\n" + reason + "\n\n" + "".join(
+            f"- {criterion}: calibrated {value:.1f}, user {user_scores.get(criterion)}\n" for criterion, value in calibrated.items()
+        ),
+    )
+    return analysis.to_dict()
@@ -0,0 +1,53 @@
+import re
+from difflib import SequenceMatcher
+
+HEADING_PATTERN = re.compile(r'^\s{0,3}#{1,6}\s+\S')
+
+
+def split_sections(content):
+    # A section is a markdown heading with the paragraphs under it; text before
+    # the first heading is split on blank lines so unstructured drafts still diff well
+    sections = []
+    current = []
+    for line in (content or '').split('\n'):
+        if HEADING_PATTERN.match(line) and current:
+            sections.append('\n'.join(current).strip())
+            current = []
+        current.append(line)
+    if current:
+        sections.append('\n'.join(current).strip())
+
+    if len(sections) <= 1:
+        sections = [paragraph.strip() for paragraph in re.split(r'\n\s*\n', content or '')]
+    return [section for section in sections if section]
+
+
+def section_title(section):
+    first_line = section.split('\n', 1)[0].strip()
+    if HEADING_PATTERN.match(first_line):
+        return first_line.lstrip('#').strip()
+    return first_line[:60] + ('...' if len(first_line) > 60 else '')
+
+
+def diff_sections(old_content, new_content):
+    old_sections = split_sections(old_content)
+    new_sections = split_sections(new_content)
+    matcher = SequenceMatcher(None, old_sections, new_sections, autojunk=False)
+
+    changed = []
+    structural = False
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        if tag != 'replace' or (i2 - i1) != (j2 - j1):
+            structural = True
+        changed.extend(range(j1, j2))
+
+    total_chars = sum(len(section) for section in new_sections) or 1
+    changed_chars = sum(len(new_sections[index]) for index in changed)
+    return {
+        'sections': new_sections,
+        'changed_indices': changed,
+        'structural_change': structural,
+        'change_ratio': changed_chars / total_chars,
+    }
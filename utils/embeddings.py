@@ -0,0 +1,145 @@
+import os
+import re
+import zlib
+from types import SimpleNamespace
+import numpy as np
+from cohere import Client
+from loguru import logger
+from config import (COHERE_API_KEY, STUB_LLM, EMBEDDING_PROVIDER, HASHING_EMBEDDING_DIM,
+                    ONNX_MODEL_PATH, ONNX_BATCH_SIZE, ONNX_MAX_TOKENS)
+from utils.stubs import StubCohereClient
+from utils.rate_limit import rate_limiter
+
+TOKEN = re.compile(r'\w+')
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _rerank_results(scores, top_n):
+    order = np.argsort(-scores, kind='stable')[:top_n]
+    return SimpleNamespace(results=[SimpleNamespace(index=int(index), relevance_score=float(scores[index])) for index in order])
+
+
+class LocalEmbedder:
+    # In-process provider with the embed/rerank interface of the Cohere client;
+    # subclasses turn a batch of texts into an L2-normalized matrix
+    def vectors(self, texts, input_type=None):
+        raise NotImplementedError
+
+    def embed(self, texts, model=None, input_type=None):
+        return SimpleNamespace(embeddings=self.vectors(list(texts), input_type).tolist())
+
+    def rerank(self, query, documents, top_n=5, model=None):
+        if not documents:
+            return SimpleNamespace(results=[])
+        query_vector = self.vectors([query], 'search_query')[0]
+        return _rerank_results(self.vectors(list(documents), 'search_document') @ query_vector, top_n)
+
+
+class HashingEmbedder(LocalEmbedder):
+    # Signed feature hashing of unigrams and bigrams with sublinear term frequency. Needs
+    # no vocabulary, so stored embeddings stay valid as the corpus grows; rerank adds
+    # inverse document frequency computed over the candidate documents.
+    def __init__(self, dimensions=HASHING_EMBEDDING_DIM):
+        self.dimensions = dimensions
+        self._buckets = {}
+
+    def _bucket(self, feature):
+        bucket = self._buckets.get(feature)
+        if bucket is None:
+            digest = zlib.crc32(feature.encode('utf-8'))
+            bucket = self._buckets[feature] = (digest % self.dimensions, 1.0 if digest & 0x80000000 else -1.0)
+            if len(self._buckets) > 500000:
+                self._buckets.clear()
+        return bucket
+
+    def counts(self, texts):
+        # Term counts of the whole batch scattered into one (texts, dimensions) matrix at once
+        rows, columns, signs = [], [], []
+        for row, text in enumerate(texts):
+            tokens = TOKEN.findall((text or '').lower())
+            for feature in tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]:
+                column, sign = self._bucket(feature)
+                rows.append(row)
+                columns.append(column)
+                signs.append(sign)
+        counts = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        np.add.at(counts, (np.asarray(rows, dtype=np.intp), np.asarray(columns, dtype=np.intp)), np.asarray(signs, dtype=np.float32))
+        return counts
+
+    def vectors(self, texts, input_type=None):
+        counts = self.counts(texts)
+        return _normalize_rows(np.sign(counts) * np.log1p(np.abs(counts)))
+
+    def rerank(self, query, documents, top_n=5, model=None):
+        if not documents:
+            return SimpleNamespace(results=[])
+        counts = self.counts([query] + list(documents))
+        weights = np.sign(counts) * np.log1p(np.abs(counts))
+        document_frequency = np.count_nonzero(counts[1:], axis=0)
+        weights *= np.log((1 + len(documents)) / (1 + document_frequency)) + 1.0
+        weights = _normalize_rows(weights)
+        return _rerank_results(weights[1:] @ weights[0], top_n)
+
+
+class OnnxEmbedder(LocalEmbedder):
+    # Sentence-embedding model exported to ONNX, run on CPU with mean pooling. The model
+    # directory holds model.onnx and the matching Hugging Face tokenizer.json.
+    def __init__(self, model_path=ONNX_MODEL_PATH, batch_size=ONNX_BATCH_SIZE, max_tokens=ONNX_MAX_TOKENS):
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise RuntimeError("The onnx embedding provider needs the onnxruntime and tokenizers packages") from e
+        self.batch_size = batch_size
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_path, 'tokenizer.json'))
+        self.tokenizer.enable_truncation(max_length=max_tokens)
+        self.tokenizer.enable_padding()
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(os.path.join(model_path, 'model.onnx'), options, providers=['CPUExecutionProvider'])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        logger.info(f"Loaded ONNX embedding model from {model_path}")
+
+    def vectors(self, texts, input_type=None):
+        batches = []
+        for start in range(0, len(texts), self.batch_size):
+            encodings = self.tokenizer.encode_batch([text or '' for text in texts[start:start + self.batch_size]])
+            mask = np.asarray([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+            feeds = {'input_ids': np.asarray([encoding.ids for encoding in encodings], dtype=np.int64), 'attention_mask': mask}
+            if 'token_type_ids' in self.input_names:
+                feeds['token_type_ids'] = np.asarray([encoding.type_ids for encoding in encodings], dtype=np.int64)
+            hidden = self.session.run(None, {name: value for name, value in feeds.items() if name in self.input_names})[0]
+            weights = mask[:, :, None].astype(np.float32)
+            batches.append((hidden * weights).sum(axis=1) / np.maximum(weights.sum(axis=1), 1.0))
+        if not batches:
+            return np.zeros((0, 0), dtype=np.float32)
+        return _normalize_rows(np.concatenate(batches).astype(np.float32))
+
+
+class RateLimitedCohereClient:
+    def __init__(self, client):
+        self.client = client
+
+    def embed(self, texts, model=None, input_type=None):
+        tokens = sum(len(text or '') for text in texts) // 4
+        return rate_limiter.call(f"cohere/{model}", tokens, lambda: self.client.embed(texts=texts, model=model, input_type=input_type))
+
+    def rerank(self, query, documents, top_n=5, model=None):
+        return rate_limiter.call(f"cohere/{model}", 0, lambda: self.client.rerank(query=query, documents=documents, top_n=top_n, model=model))
+
+
+def embedding_client(provider=EMBEDDING_PROVIDER):
+    # Providers produce embeddings of different sizes: re-embed stored rows after switching
+    # (python maintenance.py --reembed)
+    if provider == 'hashing':
+        return HashingEmbedder()
+    if provider == 'onnx':
+        return OnnxEmbedder()
+    if provider != 'cohere':
+        raise ValueError(f"Unknown embedding provider: {provider}")
+    return StubCohereClient() if STUB_LLM else RateLimitedCohereClient(Client(COHERE_API_KEY))
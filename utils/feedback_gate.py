@@ -0,0 +1,97 @@
+import threading
+from loguru import logger
+from config import LOW_SCORE_THRESHOLD, CALIBRATION_STOP_SCORE, FEEDBACK_GATE_MAX_DIVERGENCE, FEEDBACK_DELTA_MAX_WEAK
+from models.feedback import CriterionFeedback, FeedbackAnalysis
+from utils.calibration import ai_scores
+from utils.guidelines import EVALUATION_CRITERIA
+
+SKIP, DELTA, FULL = 'skip', 'delta', 'full'
+
+
+def gate_decision(evaluation, user_scores):
+    # Returns (mode, weak criteria) for the feedback agent call:
+    # skip when both raters score every criterion at or above LOW_SCORE_THRESHOLD and agree,
+    # delta when only a few criteria are weak, full otherwise; full unless both raters scored every criterion
+    scores = ai_scores(evaluation)
+    user_scores = user_scores or {}
+    if any(criterion not in scores or criterion not in user_scores for criterion in EVALUATION_CRITERIA):
+        weak = [criterion for criterion in {**scores, **user_scores}
+                if min(scores.get(criterion, 10), user_scores.get(criterion, 10)) < LOW_SCORE_THRESHOLD]
+        return FULL, weak
+    weak = [criterion for criterion in EVALUATION_CRITERIA
+            if min(scores[criterion], user_scores[criterion]) < LOW_SCORE_THRESHOLD]
+    divergence = sum(abs(scores[criterion] - user_scores[criterion]) for criterion in EVALUATION_CRITERIA) / len(EVALUATION_CRITERIA)
+    if divergence > FEEDBACK_GATE_MAX_DIVERGENCE:
+        return FULL, weak
+    if not weak:
+        return SKIP, []
+    if len(weak) <= FEEDBACK_DELTA_MAX_WEAK:
+        return DELTA, weak
+    return FULL, weak
+
+
+def local_feedback(evaluation, user_eval_content):
+    # Feedback assembled from the evaluator's suggestions and the user's comments, used when the call is skipped
+    analysis = FeedbackAnalysis(
+        overall_analysis="Every criterion is at or above the quality threshold for both the evaluator and the user, "
+                         "and their scores agree; feedback was assembled locally.",
+    )
+    evaluation = evaluation if isinstance(evaluation, dict) else {}
+    user_comments = user_eval_content.feedback or {}
+    # Every criterion either rater covered, including user comments on criteria the evaluator did not parse
+    rated = {**{criterion: details for criterion, details in evaluation.items() if isinstance(details, dict)},
+             **user_comments, **user_eval_content.score}
+    criteria = [criterion for criterion in EVALUATION_CRITERIA if criterion in rated]
+    criteria += [criterion for criterion in rated if criterion not in EVALUATION_CRITERIA]
+    for criterion in criteria:
+        details = evaluation.get(criterion)
+        suggestions = "; ".join(details.get('suggestions') or []) if isinstance(details, dict) else ''
+        user_comment = user_comments.get(criterion, '')
+        text = " ".join(part for part in (suggestions, f"User: {user_comment}" if user_comment else '') if part)
+        analysis.content_creator_feedback[criterion] = CriterionFeedback(text, user_eval_content.score.get(criterion))
+    analysis.needs_improvement = any(score < CALIBRATION_STOP_SCORE for score in user_eval_content.score.values())
+    if analysis.needs_improvement:
+        analysis.improvements_needed = f"YES. Some user scores are still below {CALIBRATION_STOP_SCORE}/10."
+    else:
+        analysis.improvements_needed = f"NO. All user scores are at or above {CALIBRATION_STOP_SCORE}/10."
+    analysis.everything = f"### Overall Analysis\n{analysis.overall_analysis}\n\n### Feedback for Content Creator\n" + "".join(
+        f"- {criterion}: {item.feedback}\n" for criterion, item in analysis.content_creator_feedback.items()
+    )
+    return analysis.to_dict()
+
+
+class GateStats:
+    def __init__(self):
+        self.calls = {SKIP: 0, DELTA: 0, FULL: 0}
+        self.seconds = {DELTA: 0.0, FULL: 0.0}
+        self._lock = threading.Lock()
+
+    def record(self, mode, elapsed=0.0):
+        with self._lock:
+            self.calls[mode] += 1
+            if mode in self.seconds:
+                self.seconds[mode] += elapsed
+
+    def snapshot(self):
+        with self._lock:
+            total = sum(self.calls.values())
+            full_mean = self.seconds[FULL] / self.calls[FULL] if self.calls[FULL] else 0.0
+            delta_mean = self.seconds[DELTA] / self.calls[DELTA] if self.calls[DELTA] else 0.0
+            # Estimated against the mean latency of full feedback calls in this process
+            saved = self.calls[SKIP] * full_mean + self.calls[DELTA] * max(0.0, full_mean - delta_mean)
+            return {
+                'decisions': dict(self.calls),
+                'skip_rate': self.calls[SKIP] / total if total else 0.0,
+                'full_mean_seconds': full_mean,
+                'delta_mean_seconds': delta_mean,
+                'estimated_seconds_saved': saved,
+            }
+
+    def log_report(self):
+        snapshot = self.snapshot()
+        if sum(snapshot['decisions'].values()):
+            logger.info(f"Feedback gating: {snapshot['decisions']}, skip rate {snapshot['skip_rate']:.0%}, "
+                        f"~{snapshot['estimated_seconds_saved']:.1f}s saved")
+
+
+gate_stats = GateStats()
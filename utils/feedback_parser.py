@@ -0,0 +1,128 @@
+import re
+from models.feedback import CriterionFeedback, FeedbackAnalysis
+from utils.guidelines import EVALUATION_CRITERIA
+
+SECTION_TITLES = {
+    'overall': "Overall Analysis",
+    'creator': "Feedback for Content Creator",
+    'evaluator': "Feedback for Evaluator",
+    'verdict': "Improvements Needed",
+}
+
+# Heading lines as the model writes them: "### [###Overall Analysis###]", "## 1. Overall Analysis",
+# "**Feedback for Evaluator:**", "[###Improvements Needed###]". Lines are classified with plain string
+# operations (strip the markup, then a dict or prefix lookup) rather than a regex per line.
+HEADINGS = {
+    'overall analysis': 'overall',
+    'improvements needed': 'verdict',
+    'improvement needed': 'verdict',
+}
+for _specific in ('', 'specific '):
+    for _article in ('', 'the '):
+        HEADINGS[f"{_specific}feedback for {_article}content creator"] = 'creator'
+        HEADINGS[f"{_specific}feedback for {_article}evaluator"] = 'evaluator'
+HEADING_MARKUP = ' \t#*_[]:'
+MAX_HEADING_LENGTH = 80
+LIST_MARKUP = ' \t#-*•_0123456789.)'
+NUMBERING = '0123456789.) \t'
+RATING = re.compile(r'(\d+(?:\.\d+)?)\s*(?:/|out of)\s*10\b', re.I)
+# The verdict leads the Improvements Needed section, as in "YES - the structure still needs work"
+VERDICT = re.compile(r'\W*(YES|NO)\b', re.I)
+
+CRITERIA = list(EVALUATION_CRITERIA)
+# Lower-cased name -> criterion, also with "&" for "and"; longest first so a prefix never shadows a longer name
+CRITERION_NAMES = {}
+for _name in CRITERIA:
+    CRITERION_NAMES[_name.lower()] = _name
+    CRITERION_NAMES[_name.lower().replace(' and ', ' & ')] = _name
+CRITERION_PREFIXES = tuple(sorted(CRITERION_NAMES, key=len, reverse=True))
+
+
+def _section_of(lowered_line):
+    # Returns the section a heading line opens, or None for ordinary text
+    title = lowered_line.strip(HEADING_MARKUP)
+    if title[:1].isdigit():
+        title = title.lstrip(NUMBERING)
+    return HEADINGS.get(' '.join(title.rstrip('?').split()))
+
+
+def _headings(lowered):
+    # (line index, section) of every heading; only short lines naming a section get the full check
+    candidates = [index for index, line in enumerate(lowered) if len(line) <= MAX_HEADING_LENGTH and (
+        'analysis' in line or 'feedback for' in line or 'needed' in line)]
+    headings = []
+    for index in candidates:
+        section = _section_of(lowered[index])
+        if section:
+            headings.append((index, section))
+    return headings
+
+
+def _criterion_of(lowered_line):
+    line = lowered_line.lstrip(LIST_MARKUP)
+    for prefix in CRITERION_PREFIXES:
+        if line.startswith(prefix):
+            return CRITERION_NAMES[prefix]
+
+
+def _parse_verdict(text, ratings):
+    # Only the first non-empty line carries the verdict; a "no" further on is part of the explanation
+    first_line = next((line for line in text.splitlines() if line.strip()), '')
+    match = VERDICT.match(first_line)
+    if match:
+        return match.group(1).upper() == 'YES'
+    # No explicit verdict: keep iterating unless every criterion was rated 10/10
+    return not ratings or any(rating < 10 for rating in ratings)
+
+
+def parse_feedback(text):
+    lines = text.splitlines()
+    lowered = text.lower().splitlines()
+    headings = _headings(lowered)
+    sections = {}
+    criteria = {}
+    # Each section runs to the next heading; lines before the first heading are ignored
+    for position, (start, section) in enumerate(headings):
+        end = headings[position + 1][0] if position + 1 < len(headings) else len(lines)
+        sections.setdefault(section, []).extend(lines[start + 1:end])
+        if section == 'creator':
+            # A criterion block starts on a line that leads with the criterion name, after any list or heading markup
+            starts = [index for index in range(start + 1, end)
+                      if lowered[index].lstrip(LIST_MARKUP).startswith(CRITERION_PREFIXES)]
+            for number, block_start in enumerate(starts):
+                block_end = starts[number + 1] if number + 1 < len(starts) else end
+                criteria.setdefault(_criterion_of(lowered[block_start]), []).extend(lines[block_start:block_end])
+
+    body = {section: "\n".join(chunk).strip() for section, chunk in sections.items()}
+    analysis = FeedbackAnalysis()
+    if not body:
+        # Free-form answer without any recognisable section
+        analysis.overall_analysis = analysis.everything = text.strip()
+        analysis.needs_improvement = _parse_verdict(text, [])
+        return analysis
+
+    analysis.overall_analysis = body.get('overall', '')
+    analysis.evaluator_feedback = body.get('evaluator', '')
+    analysis.improvements_needed = body.get('verdict', '')
+    for name, block in criteria.items():
+        feedback = "\n".join(block).strip()
+        rating = RATING.search(feedback)
+        analysis.content_creator_feedback[name] = CriterionFeedback(feedback, float(rating.group(1)) if rating else None)
+    if 'creator' in body and not criteria:
+        analysis.content_creator_feedback['General'] = CriterionFeedback(body['creator'])
+
+    ratings = [item.rating for item in analysis.content_creator_feedback.values() if item.rating is not None]
+    analysis.needs_improvement = _parse_verdict(analysis.improvements_needed, ratings)
+    analysis.everything = "".join(
+        f"### {SECTION_TITLES[section]}\n{body[section]}\n\n" for section in ('overall', 'creator', 'evaluator') if body.get(section)
+    )
+    return analysis
+
+
+def needs_improvement(feedback):
+    # Also accepts feedback dicts stored before the verdict was parsed
+    if not feedback:
+        return False
+    if 'needs_improvement' in feedback:
+        return feedback['needs_improvement']
+    return feedback.get('improvements_needed', '').strip().upper().startswith('YES')
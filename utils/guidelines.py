@@ -9,7 +9,8 @@ EVALUATION_CRITERIA = {
             "9: Highly accurate, comprehensive, and insightful with minor room for improvement",
             "10: Perfect content quality, nothing more needed"
         ],
-        "prompt": "Evaluate the accuracy, depth, and relevance of the content. Consider complexity of ideas, use of expert knowledge, and alignment with the given prompt/objective. Suggest areas for improvement or expansion."
+        "prompt": "Evaluate the accuracy, depth, and relevance of the content. Consider complexity of ideas, use of expert knowledge, and alignment with the given prompt/objective. Suggest areas for improvement or expansion.",
+        "scope": "section"
     },
     "Critical Analysis and Argumentation": {
         "description": "Assess the level of critical thinking, insights, and quality of argumentation.",
@@ -21,7 +22,8 @@ EVALUATION_CRITERIA = {
             "9: Exceptional critical thinking with compelling argumentation, minor improvements possible",
             "10: Perfect critical analysis and argumentation, nothing more needed"
         ],
-        "prompt": "Evaluate the depth of analysis, presence of original insights, and strength of arguments. Assess the use of evidence/sources. Identify areas where the analysis could be deepened or argumentation improved."
+        "prompt": "Evaluate the depth of analysis, presence of original insights, and strength of arguments. Assess the use of evidence/sources. Identify areas where the analysis could be deepened or argumentation improved.",
+        "scope": "section"
     },
     "Structure and Clarity": {
         "description": "Evaluate how well ideas are organized and communicated.",
@@ -33,7 +35,8 @@ EVALUATION_CRITERIA = {
             "9: Exceptionally clear, coherent, and well-organized with minimal room for improvement",
             "10: Perfect structure and clarity, nothing more needed"
         ],
-        "prompt": "Assess the clarity of expression and logical flow of ideas. Identify any unclear passages or structural issues. Suggest improvements for clarity and coherence."
+        "prompt": "Assess the clarity of expression and logical flow of ideas. Identify any unclear passages or structural issues. Suggest improvements for clarity and coherence.",
+        "scope": "document"
     },
     "Language and Style": {
         "description": "Evaluate the quality of writing, including grammar, vocabulary, and stylistic choices.",
@@ -45,7 +48,8 @@ EVALUATION_CRITERIA = {
             "9: Exceptional writing with near-perfect use of language and style",
             "10: Perfect language and style, nothing more needed"
         ],
-        "prompt": "Assess the quality of writing, including grammar, vocabulary, and style. Consider the appropriateness for the intended audience and purpose. Suggest improvements in language use and style."
+        "prompt": "Assess the quality of writing, including grammar, vocabulary, and style. Consider the appropriateness for the intended audience and purpose. Suggest improvements in language use and style.",
+        "scope": "section"
     },
     "Perspective and Objectivity": {
         "description": "Evaluate the appropriateness of the perspective taken and the level of objectivity (when required).",
@@ -57,7 +61,8 @@ EVALUATION_CRITERIA = {
             "9: Near-perfect alignment of perspective, objective when required with minimal room for improvement",
             "10: Perfect perspective and objectivity, nothing more needed"
         ],
-        "prompt": "Assess whether the perspective taken is appropriate for the given prompt/objective. If objectivity is required, evaluate its presence. If a specific viewpoint is needed, assess how well it's presented. Suggest ways to improve the balance or perspective as needed."
+        "prompt": "Assess whether the perspective taken is appropriate for the given prompt/objective. If objectivity is required, evaluate its presence. If a specific viewpoint is needed, assess how well it's presented. Suggest ways to improve the balance or perspective as needed.",
+        "scope": "document"
     },
     "Relevance to Initial Objective and Accuracy": {
         "description": "Assess how well the content addresses the initial user-given objective and the accuracy of facts presented.",
@@ -69,7 +74,8 @@ EVALUATION_CRITERIA = {
             "9: Content exceptionally addresses and expands upon the initial objective with high accuracy; minimal room for improvement",
             "10: Perfect relevance to initial objective and factual accuracy, nothing more needed"
         ],
-        "prompt": "Compare the content to the initial user-given objective. Evaluate how well it addresses and fulfills this objective. Also assess the accuracy of the facts presented in the content."
+        "prompt": "Compare the content to the initial user-given objective. Evaluate how well it addresses and fulfills this objective. Also assess the accuracy of the facts presented in the content.",
+        "scope": "section"
     },
     "Creativity and Originality": {
         "description": "Assess the level of creativity and originality in the content.",
@@ -81,24 +87,32 @@ EVALUATION_CRITERIA = {
             "9: Exceptionally creative and original with minimal room for improvement",
             "10: Perfect creativity and originality, nothing more needed"
         ],
-        "prompt": "Evaluate the creativity and originality of the content. Consider unique approaches, novel ideas, or innovative presentations. Suggest areas where more creative approaches could be applied."
+        "prompt": "Evaluate the creativity and originality of the content. Consider unique approaches, novel ideas, or innovative presentations. Suggest areas where more creative approaches could be applied.",
+        "scope": "document"
     }
 }
 
 
-def get_evaluation_prompt(content, objective):
-    prompt = "Evaluate the following content based on these criteria:\n\n"
+def get_rubric_prompt():
+    # Static across calls so that it can form a cacheable prompt prefix
+    prompt = "Evaluate content based on these criteria:\n\n"
     for criterion, details in EVALUATION_CRITERIA.items():
         prompt += f"{criterion}:\n"
         prompt += f"Description: {details['description']}\n"
         prompt += "Rubric:\n" + "\n".join(details['rubric']) + "\n"
-        prompt += f"Evaluation task: {details['prompt'].format(objective=objective)}\n\n"
-    
-    prompt += f"Content to evaluate:\n\n{content}\n\n"
+        prompt += f"Evaluation task: {details['prompt']}\n\n"
+
     prompt += "For each criterion, provide:\n"
     prompt += "1. A score (1-10) based on the rubric\n"
     prompt += "2. A brief explanation for the score\n"
     prompt += "3. Specific suggestions for improvement\n"
     prompt += "\nFinally, provide an overall assessment and key recommendations for improvement."
-    
-    return prompt
\ No newline at end of file
+
+    return prompt
+
+
+EVALUATION_RUBRIC = get_rubric_prompt()
+
+
+def get_evaluation_prompt(content, objective):
+    return f"{EVALUATION_RUBRIC}\n\nObjective: {objective}\n\nContent to evaluate:\n\n{content}"
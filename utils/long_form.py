@@ -0,0 +1,136 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from config import LONG_FORM_CONCURRENCY, LONG_FORM_PREVIEW_CHARS, LOW_SCORE_THRESHOLD
+from utils.calibration import ai_scores
+from utils.scheduler import propagate
+
+
+class LongFormPipeline:
+    # Outline first, then sections written and evaluated concurrently. Later rounds
+    # rewrite only the sections that scored low or that the feedback names.
+    def __init__(self, creator, evaluator, concurrency=LONG_FORM_CONCURRENCY):
+        self.creator = creator
+        self.evaluator = evaluator
+        self.concurrency = concurrency
+        self.prompt = None
+        self.outline = []
+        self.sections = []
+        self.section_evaluations = []
+        self.document_evaluation = {}
+
+    def _map(self, function, items):
+        if not items:
+            return []
+        with ThreadPoolExecutor(max_workers=max(1, min(len(items), self.concurrency)), thread_name_prefix='section') as executor:
+            return list(executor.map(propagate(function), items))
+
+    def run_round(self, prompt, last_iteration=None):
+        start = time.perf_counter()
+        if prompt != self.prompt or not self.sections:
+            self._draft(prompt)
+            changed = list(range(len(self.sections)))
+        else:
+            changed = self._revise(last_iteration)
+        self._evaluate(changed)
+        logger.info(f"Long-form round: {len(changed)}/{len(self.sections)} sections written in {time.perf_counter() - start:.1f}s")
+        return self.stitch(), self.aggregate_evaluation()
+
+    def stitch(self):
+        return "\n\n".join(f"## {section['title']}\n\n{text.strip()}" for section, text in zip(self.outline, self.sections))
+
+    def _draft(self, prompt):
+        self.prompt = prompt
+        self.outline = self.creator.create_outline(prompt) or [{'title': "Main Content", 'brief': prompt}]
+        logger.info(f"Outline with {len(self.outline)} sections")
+        self.sections = self._map(lambda index: self.creator.create_section(prompt, self.outline, index), range(len(self.outline)))
+        self.section_evaluations = [{} for _ in self.outline]
+        self.document_evaluation = {}
+
+    def _section_mean(self, index):
+        scores = ai_scores(self.section_evaluations[index])
+        return sum(scores.values()) / len(scores) if scores else None
+
+    def targets(self, last_iteration):
+        feedback_text = ""
+        if last_iteration:
+            feedback = last_iteration.get('feedback_agent_analysis') or {}
+            feedback_text = " ".join([feedback.get('overall_analysis', '')] + list((feedback.get('content_creator_feedback') or {}).values())).lower()
+        targets = []
+        for index, section in enumerate(self.outline):
+            scores = ai_scores(self.section_evaluations[index])
+            weak = any(score < LOW_SCORE_THRESHOLD for score in scores.values())
+            if weak or section['title'].lower() in feedback_text:
+                targets.append(index)
+        if not targets:
+            means = [(self._section_mean(index), index) for index in range(len(self.outline))]
+            means = [(mean, index) for mean, index in means if mean is not None]
+            targets = [min(means)[1]] if means else list(range(len(self.outline)))
+        return targets
+
+    def section_feedback(self, index, last_iteration):
+        title = self.outline[index]['title']
+        lines = []
+        for criterion, details in self.section_evaluations[index].items():
+            lines.append(f"- {criterion} (score {details.get('score')}): {details.get('explanation', '')}")
+            lines.extend(f"  - {suggestion}" for suggestion in details.get('suggestions') or [])
+        if last_iteration:
+            feedback = last_iteration.get('feedback_agent_analysis') or {}
+            for criterion, text in (feedback.get('content_creator_feedback') or {}).items():
+                if title.lower() in text.lower():
+                    lines.append(f"- Feedback agent on {criterion}: {text}")
+            user_evaluation = last_iteration.get('user_evaluation_content') or {}
+            user_feedback = user_evaluation.get('feedback') if isinstance(user_evaluation, dict) else getattr(user_evaluation, 'feedback', None)
+            for criterion, text in (user_feedback or {}).items():
+                if text and criterion in self.section_evaluations[index]:
+                    lines.append(f"- User on {criterion} (whole document): {text}")
+        for criterion, details in self.document_evaluation.items():
+            lines.extend(f"- Document-level {criterion}: {suggestion}" for suggestion in details.get('suggestions') or [])
+        return "\n".join(lines) or "Improve the section's depth, evidence and clarity."
+
+    def _revise(self, last_iteration):
+        targets = self.targets(last_iteration)
+        revisions = {index: {'text': self.sections[index], 'feedback': self.section_feedback(index, last_iteration)} for index in targets}
+        texts = self._map(lambda index: self.creator.create_section(self.prompt, self.outline, index, revisions[index]), targets)
+        for index, text in zip(targets, texts):
+            self.sections[index] = text
+        return targets
+
+    def _evaluate(self, changed):
+        def evaluate(task):
+            if task == 'document':
+                previews = [text.strip()[:LONG_FORM_PREVIEW_CHARS] for text in self.sections]
+                return self.evaluator.evaluate_document_scope(self.prompt, self.outline, previews)
+            return self.evaluator.evaluate_section(self.prompt, self.outline, task, self.sections[task])
+
+        tasks = list(changed) + ['document']
+        for task, result in zip(tasks, self._map(evaluate, tasks)):
+            if task == 'document':
+                self.document_evaluation = result
+            else:
+                self.section_evaluations[task] = result
+
+    def aggregate_evaluation(self):
+        # Section-scoped criteria: length-weighted mean over sections, suggestions from the weakest one
+        per_criterion = {}
+        for index, evaluation in enumerate(self.section_evaluations):
+            weight = max(len(self.sections[index]), 1)
+            for criterion, details in evaluation.items():
+                if isinstance(details.get('score'), (int, float)):
+                    per_criterion.setdefault(criterion, []).append((details['score'], weight, index))
+
+        aggregated = {}
+        for criterion, entries in per_criterion.items():
+            total_weight = sum(weight for _, weight, _ in entries)
+            score = sum(score * weight for score, weight, _ in entries) / total_weight
+            weakest_score, _, weakest = min(entries)
+            details = self.section_evaluations[weakest][criterion]
+            aggregated[criterion] = {
+                'score': round(score, 1),
+                'explanation': (f"Weighted mean over {len(entries)} sections; weakest is "
+                                f"'{self.outline[weakest]['title']}' ({weakest_score}): {details.get('explanation', '')}"),
+                'suggestions': [f"[{self.outline[weakest]['title']}] {suggestion}" for suggestion in details.get('suggestions') or []],
+                'sections': {self.outline[index]['title']: score for score, _, index in entries},
+            }
+        aggregated.update(self.document_evaluation)
+        return aggregated
@@ -3,44 +3,63 @@ import yaml
 from collections import deque
 from models.evaluation import UserEvaluation
 from datetime import datetime
-import sqlite3
 import json
-from cohere import Client
+import hashlib
 from loguru import logger
-from config import COHERE_RERANK_MODEL, COHERE_EMBED_MODEL, COHERE_API_KEY
+from config import (COHERE_RERANK_MODEL, COHERE_EMBED_MODEL, USE_TOPIC_SUMMARIES, TOPIC_SUMMARY_COUNT,
+                    ANN_INDEX, ANN_MIN_ROWS, ANN_NPROBE, ANN_CANDIDATES)
+from utils.usage import usage, merge_summaries
+from utils.topics import TopicIndex
+from utils.analytics import ScoreAnalytics
+from utils.calibration import ScoreCalibrator
+from utils.ann_index import AnnIndex
+from utils.embeddings import embedding_client
+from utils.storage import open_storage, SQLiteStorage
+from utils.recorder import recorder, RecordedCohereClient
+from utils.single_flight import SingleFlight, request_key
+from utils.scheduler import current_priority
+from utils.profiler import profiler
+
+# Shared by every Memory in the process, so users retrieving for the same query share one call
+embedding_flight = SingleFlight('embedding')
+rerank_flight = SingleFlight('rerank')
+
+def content_hash(content):
+    return hashlib.sha256((content or '').encode('utf-8')).hexdigest()
+
 
 class Memory:
-    def __init__(self, max_size=100, db_path='memory.db'):
+    def __init__(self, max_size=100, db_path='memory.db', usage_tracker=None):
         self.iterations = deque(maxlen=max_size)
         self.session_id = datetime.now().strftime("%Y%m%d_%H%M%S")
         self.filename = f'memory_{self.session_id}.yaml'
         self.highest_scoring_iteration = None
         self.iteration_count = 0
         self.db_path = db_path
-        self.cohere_client = Client(COHERE_API_KEY)
+        self.usage = usage_tracker or usage
+        self.embedder = RecordedCohereClient(embedding_client, recorder)
+        self._open(db_path)
+
+    def use_database(self, db_path):
+        logger.info(f"Switching memory database to {db_path}")
+        self.storage.close()
+        self.db_path = db_path
+        self._open(db_path)
+
+    def _open(self, db_path):
+        self.storage = open_storage(db_path)
         self._init_db()
+        self.topics = TopicIndex(db_path)
+        self.analytics = ScoreAnalytics(db_path)
+        self.calibration = ScoreCalibrator(db_path)
+        # The ANN index is built from the SQLite iterations table
+        self.ann = AnnIndex(db_path) if ANN_INDEX and isinstance(self.storage, SQLiteStorage) else None
+        if self.ann:
+            self.ann.maybe_rebuild()
 
     def _init_db(self):
         logger.info("Initializing database.")
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS iterations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id TEXT,
-                timestamp TEXT,
-                prompt TEXT,
-                content TEXT,
-                ai_evaluation TEXT,
-                user_evaluation_content TEXT,
-                user_feedback_evaluator TEXT,
-                feedback_agent_analysis TEXT,
-                total_score REAL,
-                embedding TEXT
-            )
-        ''')
-        conn.commit()
-        conn.close()
+        self.storage.init_schema()
         logger.info("Database initialized successfully.")
 
     def add_iteration(self, prompt, content, ai_evaluation, user_evaluation_content, user_feedback_evaluator, feedback_agent_analysis):
@@ -58,59 +77,67 @@ class Memory:
             'user_feedback_evaluator': user_feedback_evaluator,
             'feedback_agent_analysis': feedback_agent_analysis,
             'metadata': {
-                'total_score': sum(user_evaluation_content.score.values()) / len(user_evaluation_content.score)
+                'total_score': sum(user_evaluation_content.score.values()) / len(user_evaluation_content.score),
+                'usage': self.usage.drain()
             }
         }
         self.iterations.append(iteration)
         self._update_highest_scoring_iteration(iteration)
         self.iteration_count += 1
         self._save_to_db(iteration)
+        self.calibration.update(ai_evaluation, user_evaluation_content.score)
 
     def _save_to_db(self, iteration):
         logger.info(f"Saving iteration to database: {iteration['timestamp']}")
+        iteration_hash = content_hash(iteration['content'])
+        # Not keyed by session: rows saved from this file under an older, truncated session id still match
+        existing = self.storage.find_iteration(iteration_hash, iteration['timestamp'])
+        if existing:
+            logger.info(f"Iteration already stored as row {existing}, skipping.")
+            return
+
         embedding = self._get_embedding(iteration['content'])
         logger.info(f"Generated embedding of length: {len(embedding)}")
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO iterations (
-                session_id, timestamp, prompt, content, ai_evaluation,
-                user_evaluation_content, user_feedback_evaluator,
-                feedback_agent_analysis, total_score, embedding
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            self.session_id,
-            iteration['timestamp'],
-            iteration['prompt'],
-            iteration['content'],
-            json.dumps(iteration['ai_evaluation']),
-            json.dumps(iteration['user_evaluation_content'].__dict__ if isinstance(iteration['user_evaluation_content'], UserEvaluation) else iteration['user_evaluation_content']),
-            iteration['user_feedback_evaluator'],
-            json.dumps(iteration['feedback_agent_analysis']),
-            iteration['metadata']['total_score'],
-            json.dumps(embedding)
-        ))
-        conn.commit()
-        conn.close()
-        logger.info(f"Iteration saved to database successfully. Row ID: {cursor.lastrowid}")
-
-    def _get_embedding(self, text):
+        row_id = self.storage.insert_iteration({
+            'session_id': self.session_id,
+            'timestamp': iteration['timestamp'],
+            'prompt': iteration['prompt'],
+            'content': iteration['content'],
+            'ai_evaluation': json.dumps(iteration['ai_evaluation']),
+            'user_evaluation_content': json.dumps(iteration['user_evaluation_content'].__dict__ if isinstance(iteration['user_evaluation_content'], UserEvaluation) else iteration['user_evaluation_content']),
+            'user_feedback_evaluator': iteration['user_feedback_evaluator'],
+            'feedback_agent_analysis': json.dumps(iteration['feedback_agent_analysis']),
+            'total_score': iteration['metadata']['total_score'],
+            'embedding': json.dumps(embedding),
+            'usage': json.dumps(iteration['metadata'].get('usage')),
+            'content_hash': iteration_hash,
+        })
+        logger.info(f"Iteration saved to database successfully. Row ID: {row_id}")
+        self.topics.add(row_id, embedding, iteration, iteration['metadata']['total_score'])
+        self.analytics.add(row_id, self.session_id, iteration)
+        if self.ann:
+            self.ann.add(row_id, embedding)
+
+    def _get_embedding(self, text, input_type="search_document"):
         logger.info(f"Generating embedding for text: {text[:50]}...")
-        response = self.cohere_client.embed(
-            texts=[text],
-            model=COHERE_EMBED_MODEL,
-            input_type="search_document"
-        )
+        with profiler.stage('embed'):
+            response, _ = embedding_flight.do(request_key(COHERE_EMBED_MODEL, input_type, text, current_priority()), lambda: self.embedder.embed(
+                texts=[text],
+                model=COHERE_EMBED_MODEL,
+                input_type=input_type
+            ))
         logger.info("Embedding generated successfully.")
         return response.embeddings[0]
 
-    def get_relevant_iterations(self, query, top_n=5):
+    def get_relevant_iterations(self, query, top_n=5, nprobe=ANN_NPROBE, candidates=ANN_CANDIDATES):
+        # nprobe and candidates tune recall against latency once the ANN index is in use
         logger.info(f"Fetching relevant iterations for query: {query}")
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, content FROM iterations')
-        all_iterations = cursor.fetchall()
-        conn.close()
+        if self.ann and self.ann.count() >= ANN_MIN_ROWS:
+            neighbours = self.ann.search(self._get_embedding(query, input_type="search_query"), candidates, nprobe)
+            all_iterations = self.storage.iteration_texts([iteration_id for iteration_id, _ in neighbours])
+            logger.info(f"ANN index returned {len(all_iterations)} candidates (nprobe={nprobe})")
+        else:
+            all_iterations = self.storage.iteration_texts()
 
         if not all_iterations:
             logger.info("No iterations found in the database.")
@@ -118,39 +145,59 @@ class Memory:
 
         ids, texts = zip(*all_iterations)
         logger.info(f"Reranking {len(texts)} iterations")
-        rerank_results = self.cohere_client.rerank(
-            query=query,
-            documents=texts,
-            top_n=top_n,
-            model=COHERE_RERANK_MODEL
-        )
+        with profiler.stage('rerank'):
+            rerank_results, _ = rerank_flight.do(request_key(COHERE_RERANK_MODEL, query, top_n, texts, current_priority()), lambda: self.embedder.rerank(
+                query=query,
+                documents=texts,
+                top_n=top_n,
+                model=COHERE_RERANK_MODEL
+            ))
         logger.info(f"Reranking complete. Top relevance score: {rerank_results.results[0].relevance_score if rerank_results.results else 'N/A'}")
 
+        stored = self.storage.iterations_by_id([ids[result.index] for result in rerank_results.results])
         relevant_iterations = []
         for result in rerank_results.results:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM iterations WHERE id = ?', (ids[result.index],))
-            iteration = cursor.fetchone()
-            conn.close()
+            iteration = stored.get(ids[result.index])
             if iteration:
                 relevant_iterations.append({
-                    'id': iteration[0],
-                    'session_id': iteration[1],
-                    'timestamp': iteration[2],
-                    'prompt': iteration[3],
-                    'content': iteration[4],
-                    'ai_evaluation': json.loads(iteration[5]),
-                    'user_evaluation_content': json.loads(iteration[6]),
-                    'user_feedback_evaluator': iteration[7],
-                    'feedback_agent_analysis': json.loads(iteration[8]),
-                    'total_score': iteration[9],
+                    'id': iteration['id'],
+                    'session_id': iteration['session_id'],
+                    'timestamp': iteration['timestamp'],
+                    'prompt': iteration['prompt'],
+                    'content': iteration['content'],
+                    'ai_evaluation': iteration['ai_evaluation'],
+                    'user_evaluation_content': iteration['user_evaluation_content'],
+                    'user_feedback_evaluator': iteration['user_feedback_evaluator'],
+                    'feedback_agent_analysis': iteration['feedback_agent_analysis'],
+                    'total_score': iteration['total_score'],
+                    'usage': iteration['usage'],
                     'relevance_score': result.relevance_score
                 })
 
         logger.info(f"Found {len(relevant_iterations)} relevant iterations.")
         return relevant_iterations
 
+    def add_rejected_candidate(self, prompt, content, ai_evaluation, total_score):
+        # Stored without embedding or user evaluation: rejected candidates are never retrieved
+        # by similarity, only shown to the creator as negative examples for the same prompt
+        self.storage.insert_iteration({
+            'session_id': self.session_id, 'timestamp': datetime.now().isoformat(), 'prompt': prompt, 'content': content,
+            'ai_evaluation': json.dumps(ai_evaluation), 'total_score': total_score, 'content_hash': content_hash(content),
+            'kind': 'rejected',
+        })
+
+    def get_rejected_candidates(self, prompt, limit=2):
+        rows = self.storage.rejected_candidates(self.session_id, prompt, limit)
+        return [{'content': row['content'], 'total_score': row['total_score'] or 0.0} for row in rows]
+
+    def get_relevant_summaries(self, query, top_n=TOPIC_SUMMARY_COUNT):
+        if not USE_TOPIC_SUMMARIES or not self.topics.count():
+            return []
+        logger.info(f"Fetching relevant topic summaries for query: {query}")
+        summaries = self.topics.relevant(self._get_embedding(query, input_type="search_query"), top_n)
+        logger.info(f"Found {len(summaries)} relevant topic summaries.")
+        return summaries
+
     def _update_highest_scoring_iteration(self, iteration):
         if not self.highest_scoring_iteration or iteration['metadata']['total_score'] > self.highest_scoring_iteration['metadata']['total_score']:
             self.highest_scoring_iteration = iteration
@@ -187,6 +234,10 @@ class Memory:
     def get_iteration_count(self):
         return self.iteration_count
 
+    def get_usage_summary(self, session_id=None):
+        return merge_summaries(self.storage.usage_rows(session_id))
+
+    @profiler.stage('yaml')
     def save_to_file(self):
         logger.info(f"Saving memory to file: {self.filename}")
         with open(self.filename, 'w') as f:
@@ -217,7 +268,7 @@ class Memory:
                         for iteration in loaded_data],
                         maxlen=self.iterations.maxlen
                     )
-                    self.session_id = filename.split('_')[1].split('.')[0]
+                    self.session_id = filename[len('memory_'):-len('.yaml')]
                     self.filename = filename
                     
                     # Save loaded data to SQLite
@@ -237,6 +288,7 @@ class Memory:
         self.filename = f'memory_{self.session_id}.yaml'
         self.iteration_count = 0
         self.highest_scoring_iteration = None
+        self.usage.reset_session()
         logger.info("New session started successfully.")
 
 memory = Memory()
\ No newline at end of file
@@ -0,0 +1,80 @@
+import hashlib
+import threading
+from collections import OrderedDict, defaultdict
+from loguru import logger
+from config import PREFIX_BLOCK_CHARS, PREFIX_MIN_CHARS, PREFIX_MAX_BLOCKS
+
+
+def serialize_messages(messages):
+    return "".join(f"<{message['role']}>\n{message['content']}\n" for message in messages)
+
+
+def prefix_block_hashes(text, block_chars=PREFIX_BLOCK_CHARS):
+    # One hash per complete block boundary, each covering everything before it
+    digest = hashlib.sha1()
+    hashes = []
+    for end in range(block_chars, len(text) + 1, block_chars):
+        digest.update(text[end - block_chars:end].encode('utf-8'))
+        hashes.append(digest.hexdigest())
+    return hashes
+
+
+class PrefixStats:
+    def __init__(self, block_chars=PREFIX_BLOCK_CHARS, min_chars=PREFIX_MIN_CHARS, max_blocks=PREFIX_MAX_BLOCKS):
+        self.block_chars = block_chars
+        self.min_chars = min_chars
+        self.max_blocks = max_blocks
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._seen.clear()
+            self.per_agent = defaultdict(lambda: {'requests': 0, 'hits': 0, 'prompt_chars': 0, 'shared_chars': 0})
+
+    def record(self, agent, messages):
+        text = serialize_messages(messages)
+        hashes = prefix_block_hashes(text, self.block_chars)
+        with self._lock:
+            shared_blocks = 0
+            for block_hash in hashes:
+                if block_hash not in self._seen:
+                    break
+                self._seen.move_to_end(block_hash)
+                shared_blocks += 1
+            for block_hash in hashes[shared_blocks:]:
+                self._seen[block_hash] = True
+            while len(self._seen) > self.max_blocks:
+                self._seen.popitem(last=False)
+
+            shared_chars = shared_blocks * self.block_chars
+            stats = self.per_agent[agent or 'unknown']
+            stats['requests'] += 1
+            stats['prompt_chars'] += len(text)
+            stats['shared_chars'] += shared_chars
+            if shared_chars >= self.min_chars:
+                stats['hits'] += 1
+        logger.debug(f"Prompt prefix [{agent}]: {shared_chars}/{len(text)} chars already seen")
+        return shared_chars
+
+    def report(self):
+        with self._lock:
+            report = {}
+            for agent, stats in self.per_agent.items():
+                report[agent] = {
+                    **stats,
+                    'hit_rate': stats['hits'] / stats['requests'] if stats['requests'] else 0.0,
+                    'shared_ratio': stats['shared_chars'] / stats['prompt_chars'] if stats['prompt_chars'] else 0.0,
+                }
+            return report
+
+    def log_report(self):
+        for agent, stats in self.report().items():
+            logger.info(
+                f"Prefix reuse [{agent}]: {stats['hits']}/{stats['requests']} hits ({stats['hit_rate']:.0%}), "
+                f"{stats['shared_ratio']:.0%} of prompt characters in a previously seen prefix"
+            )
+
+
+prefix_stats = PrefixStats()
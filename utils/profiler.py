@@ -0,0 +1,228 @@
+import contextvars
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from loguru import logger
+from config import PROFILE_INTERVAL, PROFILE_MAX_DEPTH, PROFILE_TOP_FUNCTIONS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER_INPUT = 'user-input'
+# Leaf frames of threads parked on a lock or queue; such threads are skipped unless inside a stage
+IDLE_FILES = ('threading.py', 'queue.py', 'selectors.py', os.path.join('concurrent', 'futures', 'thread.py'))
+
+_stages = contextvars.ContextVar('profile_stages', default=())
+
+
+def _location(filename):
+    if filename.startswith(ROOT + os.sep):
+        return os.path.relpath(filename, ROOT)
+    for marker in ('site-packages' + os.sep, 'dist-packages' + os.sep):
+        if marker in filename:
+            return filename.split(marker, 1)[1]
+    return os.path.basename(filename)
+
+
+def _thread_group(name):
+    # Pool workers (ThreadPoolExecutor-0_3, ingest_1) are merged into one profile per pool
+    return re.sub(r'([-_]\d+)+$', '', name) or name
+
+
+def _label(frame):
+    if isinstance(frame, str):
+        return f"[{frame}]"
+    return f"{frame.co_name} ({_location(frame.co_filename)}:{frame.co_firstlineno})"
+
+
+class SamplingProfiler:
+    # Wall-clock sampling of every thread from a background thread, every PROFILE_INTERVAL
+    # seconds. Stacks are aggregated as they are taken, so memory stays flat over a long
+    # session. Code marks what it is doing with stage(); the active stages (propagated into
+    # executor threads with the request context) head each stack, so the flamegraph splits
+    # by stage and agent before splitting by function.
+    def __init__(self, interval=PROFILE_INTERVAL, max_depth=PROFILE_MAX_DEPTH):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.running = False
+        self._thread_stages = {}
+        self._thread = None
+        self._stop = threading.Event()
+        self._reset()
+
+    def _reset(self):
+        self.stacks = defaultdict(lambda: [0, 0.0])  # (thread group, stages, frames) -> [samples, seconds]
+        self.samples = 0
+        self.wall_seconds = 0.0
+        self.sampler_seconds = 0.0
+        self.user_input_seconds = 0.0
+
+    @contextmanager
+    def stage(self, name):
+        # Also usable as a decorator; costs one check while the profiler is off
+        if not self.running:
+            yield
+            return
+        ident = threading.get_ident()
+        stages = _stages.get() + (name,)
+        token = _stages.set(stages)
+        self._thread_stages[ident] = stages
+        try:
+            yield
+        finally:
+            _stages.reset(token)
+            # Back to the enclosing stages, including those inherited from the submitting thread
+            if _stages.get():
+                self._thread_stages[ident] = _stages.get()
+            else:
+                self._thread_stages.pop(ident, None)
+
+    def start(self):
+        if self.running:
+            return
+        self._reset()
+        self._stop.clear()
+        self.running = True
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+        logger.info(f"Profiling every {self.interval * 1000:.0f}ms")
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        self.running = False
+        self._thread_stages.clear()
+
+    def _run(self):
+        own = threading.get_ident()
+        start = last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            cpu = time.thread_time()
+            self._sample(own, now - last)
+            self.sampler_seconds += time.thread_time() - cpu
+            self.wall_seconds = now - start
+            last = now
+
+    def _sample(self, own, seconds):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        self.samples += 1
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stages = self._thread_stages.get(ident, ())
+            if stages and stages[-1] == USER_INPUT:
+                self.user_input_seconds += seconds
+                continue
+            if not stages and frame.f_code.co_filename.endswith(IDLE_FILES):
+                continue
+            codes = []
+            while frame is not None and len(codes) < self.max_depth:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            entry = self.stacks[(_thread_group(names.get(ident, str(ident))), stages, tuple(reversed(codes)))]
+            entry[0] += 1
+            entry[1] += seconds
+
+    def _snapshot(self):
+        for _ in range(3):
+            try:
+                return list(self.stacks.items())
+            except RuntimeError:  # resized by the sampler thread meanwhile
+                continue
+        return []
+
+    def stage_totals(self):
+        totals = defaultdict(float)
+        for (_, stages, _), (_, seconds) in self._snapshot():
+            totals[' > '.join(stages) or '(no stage)'] += seconds
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+    def function_totals(self):
+        # label -> {'self', 'total', 'stages': {stage path: total seconds}}
+        functions = defaultdict(lambda: {'self': 0.0, 'total': 0.0, 'stages': defaultdict(float)})
+        for (_, stages, codes), (_, seconds) in self._snapshot():
+            if not codes:
+                continue
+            path = ' > '.join(stages) or '(no stage)'
+            functions[_label(codes[-1])]['self'] += seconds
+            for label in {_label(code) for code in codes}:
+                functions[label]['total'] += seconds
+                functions[label]['stages'][path] += seconds
+        return sorted(functions.items(), key=lambda item: (item[1]['self'], item[1]['total']), reverse=True)
+
+    def overhead(self):
+        return self.sampler_seconds / self.wall_seconds if self.wall_seconds else 0.0
+
+    def write_speedscope(self, path):
+        frames, index = [], {}
+
+        def frame_index(frame):
+            if frame not in index:
+                index[frame] = len(frames)
+                if isinstance(frame, str):
+                    frames.append({'name': _label(frame)})
+                else:
+                    frames.append({'name': frame.co_name, 'file': _location(frame.co_filename), 'line': frame.co_firstlineno})
+            return index[frame]
+
+        profiles = {}
+        for (group, stages, codes), (_, seconds) in self._snapshot():
+            profile = profiles.setdefault(group, {'type': 'sampled', 'name': group, 'unit': 'seconds', 'startValue': 0,
+                                                  'endValue': 0.0, 'samples': [], 'weights': []})
+            profile['samples'].append([frame_index(frame) for frame in stages + codes])
+            profile['weights'].append(seconds)
+            profile['endValue'] += seconds
+        with open(path, 'w') as f:
+            json.dump({'$schema': 'https://www.speedscope.app/file-format-schema.json', 'name': 'instructo',
+                       'exporter': 'instructo', 'shared': {'frames': frames}, 'profiles': list(profiles.values())}, f)
+
+    def write_collapsed(self, path):
+        # Folded stacks for flamegraph.pl and compatible tools, one line per distinct stack
+        with open(path, 'w') as f:
+            for (group, stages, codes), (samples, _) in self._snapshot():
+                labels = [group] + [_label(frame) for frame in stages + codes]
+                f.write(';'.join(label.replace(';', ':') for label in labels) + f" {samples}\n")
+
+    def write_summary(self, path, top=PROFILE_TOP_FUNCTIONS):
+        stages = self.stage_totals()
+        profiled = sum(seconds for _, seconds in stages) or 1e-9
+        lines = [
+            f"Profiled {self.wall_seconds:.1f}s wall clock, {self.samples} samples every {self.interval * 1000:.0f}ms, "
+            f"sampler overhead {self.overhead():.2%} of one core",
+            f"Waiting for user input (not profiled): {self.user_input_seconds:.1f}s",
+            "",
+            f"{'Stage':<60} {'Seconds':>9} {'Share':>7}",
+        ]
+        lines += [f"{name:<60} {seconds:>9.2f} {seconds / profiled:>7.1%}" for name, seconds in stages]
+        lines += ["", f"{'Function':<70} {'Self s':>8} {'Total s':>8}  Stages"]
+        for label, totals in self.function_totals()[:top]:
+            busiest = sorted(totals['stages'].items(), key=lambda item: item[1], reverse=True)[:2]
+            stage_names = ', '.join(f"{name} ({seconds / totals['total']:.0%})" for name, seconds in busiest)
+            lines.append(f"{label:<70} {totals['self']:>8.2f} {totals['total']:>8.2f}  {stage_names}")
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def write(self, prefix):
+        paths = {'speedscope': f"{prefix}.speedscope.json", 'collapsed': f"{prefix}.collapsed.txt",
+                 'summary': f"{prefix}.summary.txt"}
+        self.write_speedscope(paths['speedscope'])
+        self.write_collapsed(paths['collapsed'])
+        self.write_summary(paths['summary'])
+        return paths
+
+    def log_report(self):
+        if not self.samples:
+            return
+        stages = self.stage_totals()
+        profiled = sum(seconds for _, seconds in stages) or 1e-9
+        busiest = ', '.join(f"{name} {seconds / profiled:.0%}" for name, seconds in stages[:5])
+        logger.info(f"Profile: {self.wall_seconds:.1f}s, sampler overhead {self.overhead():.2%}; busiest stages: {busiest}")
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,201 @@
+import sqlite3
+import threading
+import time
+from contextlib import nullcontext
+from loguru import logger
+from config import (RATE_LIMITING, RATE_LIMIT_DB, RATE_LIMITS, RATE_LIMIT_BURST_SECONDS, RATE_LIMIT_COMPLETION_TOKENS,
+                    RATE_LIMIT_MAX_WAIT, RATE_LIMIT_RETRIES, RATE_LIMIT_COOLDOWN_SECONDS, SCHEDULER_BATCH_HEADROOM)
+from utils.usage import extract_usage
+from utils.scheduler import current_priority, BATCH
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+def estimate_tokens(messages, completion_tokens=RATE_LIMIT_COMPLETION_TOKENS):
+    # ~4 characters per token, plus a reservation for the completion
+    return sum(len(str(message.get('content') or '')) for message in messages) // 4 + completion_tokens
+
+
+def is_rate_limit_error(error):
+    return getattr(error, 'status_code', None) == 429 or type(error).__name__ in ('RateLimitError', 'TooManyRequestsError')
+
+
+def retry_after(error):
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return RATE_LIMIT_COOLDOWN_SECONDS
+
+
+class RateLimiter:
+    # Token buckets for requests and tokens per minute, one per provider/model key, kept in a
+    # SQLite file so that every thread and process on the host draws from the same quota.
+    # A caller reserves its share in one transaction (the balance may go negative) and then
+    # sleeps until the bucket would have covered it, so waiting callers are served in order
+    # instead of polling.
+    def __init__(self, db_path=RATE_LIMIT_DB, limits=RATE_LIMITS, enabled=RATE_LIMITING):
+        self.db_path = db_path
+        self.limits = limits
+        self.enabled = enabled
+        self.stats = {'calls': 0, 'waits': 0, 'wait_seconds': 0.0, 'rate_limited': 0}
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        if not self._initialized:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS rate_buckets (
+                    key TEXT PRIMARY KEY,
+                    requests REAL,
+                    tokens REAL,
+                    updated REAL,
+                    blocked_until REAL DEFAULT 0
+                )
+            ''')
+            self._initialized = True
+        return conn
+
+    def bucket_key(self, key):
+        # Models without limits of their own share the bucket of their provider
+        provider = key.split('/')[0]
+        return provider if key not in self.limits and provider in self.limits else key
+
+    def limits_for(self, key):
+        limits = self.limits.get(self.bucket_key(key)) or {}
+        requests_per_minute = limits.get('requests_per_minute') or 0
+        tokens_per_minute = limits.get('tokens_per_minute') or 0
+        return requests_per_minute, tokens_per_minute
+
+    def _refilled(self, cursor, key, now):
+        requests_per_minute, tokens_per_minute = self.limits_for(key)
+        request_capacity = max(1.0, requests_per_minute * RATE_LIMIT_BURST_SECONDS / 60)
+        token_capacity = tokens_per_minute * RATE_LIMIT_BURST_SECONDS / 60
+        row = cursor.execute('SELECT requests, tokens, updated, blocked_until FROM rate_buckets WHERE key = ?', (key,)).fetchone()
+        if not row:
+            return request_capacity, token_capacity, 0.0
+        requests, tokens, updated, blocked_until = row
+        elapsed = max(0.0, now - updated)
+        requests = min(request_capacity, requests + elapsed * requests_per_minute / 60)
+        tokens = min(token_capacity, tokens + elapsed * tokens_per_minute / 60)
+        return requests, tokens, blocked_until
+
+    def _store(self, cursor, key, requests, tokens, now, blocked_until):
+        cursor.execute('INSERT OR REPLACE INTO rate_buckets (key, requests, tokens, updated, blocked_until) VALUES (?, ?, ?, ?, ?)',
+                       (key, requests, tokens, now, blocked_until))
+
+    def reserve(self, key, tokens=0, deferrable=False):
+        # Takes one request and the estimated tokens, returns (seconds to wait before sending, reserved).
+        # Deferrable calls only take quota beyond the headroom left to other callers and reserve
+        # nothing while they would have to wait, so later interactive calls are not queued behind them.
+        key = self.bucket_key(key)
+        requests_per_minute, tokens_per_minute = self.limits_for(key)
+        if not self.enabled or not (requests_per_minute or tokens_per_minute):
+            return 0.0, True
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            available_requests, available_tokens, blocked_until = self._refilled(cursor, key, now)
+            available_requests -= 1
+            available_tokens -= tokens if tokens_per_minute else 0
+            request_floor = token_floor = 0.0
+            if deferrable:
+                # Never more headroom than a full bucket leaves after this call, or the call could never run
+                headroom = SCHEDULER_BATCH_HEADROOM * RATE_LIMIT_BURST_SECONDS / 60
+                request_floor = min(requests_per_minute * headroom, max(1.0, requests_per_minute * RATE_LIMIT_BURST_SECONDS / 60) - 1)
+                token_floor = min(tokens_per_minute * headroom, max(0.0, tokens_per_minute * RATE_LIMIT_BURST_SECONDS / 60 - tokens))
+            wait = max(0.0, blocked_until - now)
+            if requests_per_minute and available_requests < request_floor:
+                wait = max(wait, (request_floor - available_requests) * 60 / requests_per_minute)
+            if tokens_per_minute and available_tokens < token_floor:
+                wait = max(wait, (token_floor - available_tokens) * 60 / tokens_per_minute)
+            if deferrable and wait > 0:
+                cursor.execute('ROLLBACK')
+                return wait, False
+            if wait > RATE_LIMIT_MAX_WAIT:
+                cursor.execute('ROLLBACK')
+                raise RateLimitExceeded(f"Rate limit for {key} would need a {wait:.0f}s wait")
+            self._store(cursor, key, available_requests, available_tokens, now, blocked_until)
+            cursor.execute('COMMIT')
+        finally:
+            conn.close()
+        return wait, True
+
+    def settle(self, key, reserved_tokens, used_tokens):
+        # Corrects the token balance once the actual usage of a call is known
+        key = self.bucket_key(key)
+        if not self.enabled or not self.limits_for(key)[1] or used_tokens == reserved_tokens:
+            return
+        conn = self._connect()
+        try:
+            conn.execute('UPDATE rate_buckets SET tokens = tokens + ? WHERE key = ?', (reserved_tokens - used_tokens, key))
+        finally:
+            conn.close()
+
+    def block(self, key, seconds):
+        # After a 429 every process holds off, instead of each retrying on its own schedule
+        key = self.bucket_key(key)
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            requests, tokens, blocked_until = self._refilled(cursor, key, now)
+            self._store(cursor, key, min(requests, 0.0), tokens, now, max(blocked_until, now + seconds))
+            cursor.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def call(self, key, tokens, function, slot=nullcontext):
+        # Runs function within the key's limits; 429 responses are retried after the shared cooldown.
+        # slot is entered around function only, after the quota is reserved and any wait is over
+        deferrable = current_priority() == BATCH
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            reserved = False
+            while not reserved:
+                wait, reserved = self.reserve(key, tokens, deferrable)
+                with self._lock:
+                    self.stats['calls'] += reserved
+                    if wait:
+                        self.stats['waits'] += 1
+                        self.stats['wait_seconds'] += wait
+                if wait:
+                    logger.info(f"Rate limit for {key}: waiting {wait:.2f}s")
+                    time.sleep(wait)
+            try:
+                with slot():
+                    response = function()
+            except Exception as e:
+                if not is_rate_limit_error(e) or not self.enabled:
+                    raise
+                with self._lock:
+                    self.stats['rate_limited'] += 1
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+                cooldown = retry_after(e)
+                logger.warning(f"{key} returned 429, pausing all callers for {cooldown:.0f}s")
+                self.block(key, cooldown)
+                continue
+            used = extract_usage(response)
+            if used:
+                self.settle(key, tokens, used['total_tokens'])
+            return response
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def log_report(self):
+        snapshot = self.snapshot()
+        if snapshot['waits'] or snapshot['rate_limited']:
+            logger.info(f"Rate limiting: {snapshot['waits']}/{snapshot['calls']} calls waited "
+                        f"{snapshot['wait_seconds']:.1f}s in total, {snapshot['rate_limited']} rejected with 429")
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+from types import SimpleNamespace
+from loguru import logger
+from utils.profiler import profiler, USER_INPUT
+
+
+class ReplayExhausted(Exception):
+    pass
+
+
+class RecordedCallError(Exception):
+    # Raised on replay where the recorded call failed, so failover takes the same path
+    pass
+
+
+def request_key(kind, request):
+    return hashlib.sha1(f"{kind}:{json.dumps(request, sort_keys=True, default=str)}".encode('utf-8')).hexdigest()
+
+
+def to_plain(response):
+    if isinstance(response, (dict, list, str, int, float)) or response is None:
+        return response
+    for method in ('model_dump', 'dict', 'to_dict'):
+        if hasattr(response, method):
+            return getattr(response, method)()
+    return json.loads(json.dumps(response, default=lambda value: getattr(value, '__dict__', str(value))))
+
+
+class SessionRecorder:
+    # Captures every completion, Cohere call and user input of a session to a
+    # JSONL file, and replays them in order without touching the network.
+    def __init__(self):
+        self.mode = None
+        self.path = None
+        self.simulate_latency = False
+        self.external_seconds = 0.0
+        self._file = None
+        self._scratch = None
+        self._by_key = defaultdict(deque)
+        self._sequence = defaultdict(deque)
+        self._consumed = set()
+        self._lock = threading.Lock()
+
+    @property
+    def recording(self):
+        return self.mode == 'record'
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def start_recording(self, path, db_path=None):
+        self.mode = 'record'
+        self.path = path
+        self._file = open(path, 'w')
+        snapshot = None
+        if db_path:
+            # Retrieval results index into the rows present at record time
+            snapshot = f"{path}.db"
+            shutil.copyfile(db_path, snapshot)
+        self._write({'kind': 'meta', 'created': datetime.now().isoformat(), 'db_snapshot': snapshot})
+        logger.info(f"Recording session to {path}")
+
+    def start_replay(self, path, simulate_latency=False):
+        self.mode = 'replay'
+        self.path = path
+        self.simulate_latency = simulate_latency
+        db_snapshot = None
+        with open(path, 'r') as f:
+            for index, line in enumerate(f):
+                event = json.loads(line)
+                if event['kind'] == 'meta':
+                    db_snapshot = event.get('db_snapshot')
+                    continue
+                event['index'] = index
+                self._by_key[event['key']].append(event)
+                self._sequence[event['kind']].append(event)
+        logger.info(f"Replaying {sum(len(events) for events in self._sequence.values())} recorded events from {path}")
+        if db_snapshot:
+            # Work on a copy so replays never modify the snapshot
+            scratch = tempfile.NamedTemporaryFile(prefix='replay_', suffix='.db', delete=False)
+            scratch.close()
+            shutil.copyfile(db_snapshot, scratch.name)
+            self._scratch = scratch.name
+            return scratch.name
+        return None
+
+    def stop(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self._scratch:
+            for path in (self._scratch, f"{self._scratch}-journal"):
+                if os.path.exists(path):
+                    os.remove(path)
+            shutil.rmtree(f"{self._scratch}.ann", ignore_errors=True)
+            self._scratch = None
+        self.mode = None
+
+    def _write(self, event):
+        with self._lock:
+            self._file.write(json.dumps(event, default=str) + "\n")
+            self._file.flush()
+
+    def record(self, kind, request, response, elapsed, error=None):
+        self._write({
+            'kind': kind,
+            'key': request_key(kind, request),
+            'request': request,
+            'response': to_plain(response),
+            'elapsed': elapsed,
+            **({'error': error} if error else {}),
+        })
+
+    def replay(self, kind, request):
+        key = request_key(kind, request)
+        with self._lock:
+            event = self._next_unconsumed(self._by_key[key])
+            if event is None:
+                # The request changed since recording (e.g. an edited prompt): serve calls of this kind in order
+                event = self._next_unconsumed(self._sequence[kind])
+                if event is None:
+                    raise ReplayExhausted(f"No recorded {kind} events left in {self.path}")
+                logger.warning(f"No exact {kind} match in recording, using event #{event['index']}")
+            self._consumed.add(event['index'])
+            self.external_seconds += event['elapsed']
+        if self.simulate_latency and kind != 'input':
+            time.sleep(event['elapsed'])
+        if event.get('error'):
+            raise RecordedCallError(event['error'])
+        return event['response']
+
+    def _next_unconsumed(self, events):
+        while events and events[0]['index'] in self._consumed:
+            events.popleft()
+        return events.popleft() if events else None
+
+    def call(self, kind, request, live_call):
+        if self.replaying:
+            return self.replay(kind, request)
+        start = time.perf_counter()
+        try:
+            response = live_call()
+        except Exception as e:
+            # Recorded too: a replay must fail over exactly where the session did
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.external_seconds += elapsed
+            if self.recording:
+                self.record(kind, request, None, elapsed, error=f"{type(e).__name__}: {e}")
+            raise
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.external_seconds += elapsed
+        if self.recording:
+            self.record(kind, request, response, elapsed)
+        return response
+
+    def user_input(self, ask, *args, **kwargs):
+        request = {'args': [str(arg) for arg in args], 'kwargs': {key: str(value) for key, value in kwargs.items()}}
+        with profiler.stage(USER_INPUT):
+            return self.call('input', request, lambda: ask(*args, **kwargs))
+
+
+class RecordedCohereClient:
+    # Cohere client wrapper; the real client is created lazily so that replays
+    # need neither network access nor an API key
+    def __init__(self, client_factory, recorder):
+        self._client_factory = client_factory
+        self._client = None
+        self._recorder = recorder
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self._client_factory()
+        return self._client
+
+    def embed(self, texts, model=None, input_type=None):
+        request = {'texts': list(texts), 'model': model, 'input_type': input_type}
+        response = self._recorder.call('embed', request, lambda: {
+            'embeddings': list(self.client.embed(texts=texts, model=model, input_type=input_type).embeddings)
+        })
+        return SimpleNamespace(embeddings=response['embeddings'])
+
+    def rerank(self, query, documents, top_n=5, model=None):
+        documents_digest = hashlib.sha1("\x00".join(documents).encode('utf-8')).hexdigest()
+        request = {'query': query, 'documents': documents_digest, 'count': len(documents), 'top_n': top_n, 'model': model}
+
+        def live_call():
+            results = self.client.rerank(query=query, documents=documents, top_n=top_n, model=model).results
+            return {'results': [{'index': result.index, 'relevance_score': result.relevance_score} for result in results]}
+
+        response = self._recorder.call('rerank', request, live_call)
+        return SimpleNamespace(results=[SimpleNamespace(**result) for result in response['results']])
+
+
+recorder = SessionRecorder()
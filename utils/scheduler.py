@@ -0,0 +1,153 @@
+import contextvars
+import itertools
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from loguru import logger
+from config import (SCHEDULER, SCHEDULER_CONCURRENCY, SCHEDULER_WEIGHTS, SCHEDULER_INTERACTIVE_SLOTS,
+                    SCHEDULER_TENANT_CONCURRENCY)
+
+INTERACTIVE, REFINEMENT, BATCH = 'interactive', 'refinement', 'batch'
+PRIORITIES = (INTERACTIVE, REFINEMENT, BATCH)
+WAIT_WINDOW = 500
+
+_request_context = contextvars.ContextVar('request_context', default=(INTERACTIVE, None))
+
+
+@contextmanager
+def request_context(priority=None, tenant=None):
+    # Priority class and tenant of the completion calls made inside the block
+    current_priority, current_tenant = _request_context.get()
+    if priority is not None and priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority: {priority}")
+    token = _request_context.set((priority or current_priority, current_tenant if tenant is None else tenant))
+    try:
+        yield
+    finally:
+        _request_context.reset(token)
+
+
+def current_priority():
+    return _request_context.get()[0]
+
+
+def propagate(function):
+    # Executor threads do not inherit context variables; wraps function to run in the caller's context
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(function, *args, **kwargs)
+
+
+class _Ticket:
+    __slots__ = ('priority', 'tenant', 'start', 'finish', 'enqueued', 'granted')
+
+    def __init__(self, priority, tenant):
+        self.priority = priority
+        self.tenant = tenant
+        self.enqueued = time.perf_counter()
+        self.granted = threading.Event()
+
+
+class RequestScheduler:
+    # Grants completion call slots by weighted fair queueing across priority classes: each
+    # class's calls get virtual finish tags spaced 1/weight apart, and the free slot goes to
+    # the smallest tag, so under contention classes share slots in proportion to their weights
+    # and an idle class builds up no credit. Calls within a class are served in order, skipping
+    # tenants at their concurrency cap.
+    def __init__(self, concurrency=SCHEDULER_CONCURRENCY, weights=SCHEDULER_WEIGHTS,
+                 interactive_slots=SCHEDULER_INTERACTIVE_SLOTS, tenant_cap=SCHEDULER_TENANT_CONCURRENCY, enabled=SCHEDULER):
+        self.concurrency = concurrency
+        self.weights = weights
+        self.interactive_slots = min(interactive_slots, concurrency - 1)
+        self.tenant_cap = tenant_cap
+        self.enabled = enabled
+        self.virtual_time = 0.0
+        self.last_finish = {priority: 0.0 for priority in PRIORITIES}
+        self.queues = {priority: deque() for priority in PRIORITIES}
+        self.running = {priority: 0 for priority in PRIORITIES}
+        self.running_by_tenant = {}
+        self.served = {priority: 0 for priority in PRIORITIES}
+        self.waits = {priority: deque(maxlen=WAIT_WINDOW) for priority in PRIORITIES}
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def _eligible(self, ticket, running):
+        if ticket.priority != INTERACTIVE and running >= self.concurrency - self.interactive_slots:
+            return False
+        return not (ticket.tenant and self.tenant_cap and self.running_by_tenant.get(ticket.tenant, 0) >= self.tenant_cap)
+
+    def _dispatch(self):
+        running = sum(self.running.values())
+        while running < self.concurrency:
+            best = None
+            for queue in self.queues.values():
+                ticket = next((ticket for ticket in queue if self._eligible(ticket, running)), None)
+                if ticket and (best is None or ticket.finish < best.finish):
+                    best = ticket
+            if best is None:
+                return
+            self.queues[best.priority].remove(best)
+            self.virtual_time = max(self.virtual_time, best.start)
+            self.running[best.priority] += 1
+            if best.tenant:
+                self.running_by_tenant[best.tenant] = self.running_by_tenant.get(best.tenant, 0) + 1
+            running += 1
+            best.granted.set()
+
+    def acquire(self, priority, tenant=None):
+        ticket = _Ticket(priority, tenant)
+        with self._lock:
+            ticket.start = max(self.virtual_time, self.last_finish[priority])
+            ticket.finish = ticket.start + 1.0 / self.weights.get(priority, 1)
+            self.last_finish[priority] = ticket.finish
+            self.queues[priority].append(ticket)
+            self._dispatch()
+        ticket.granted.wait()
+        with self._lock:
+            self.served[priority] += 1
+            self.waits[priority].append(time.perf_counter() - ticket.enqueued)
+        return ticket
+
+    def release(self, ticket):
+        with self._lock:
+            self.running[ticket.priority] -= 1
+            if ticket.tenant:
+                self.running_by_tenant[ticket.tenant] -= 1
+                if not self.running_by_tenant[ticket.tenant]:
+                    del self.running_by_tenant[ticket.tenant]
+            self._dispatch()
+
+    @contextmanager
+    def slot(self):
+        if not self.enabled:
+            yield
+            return
+        priority, tenant = _request_context.get()
+        ticket = self.acquire(priority, tenant)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    def snapshot(self):
+        with self._lock:
+            waits = {priority: sorted(samples) for priority, samples in self.waits.items()}
+            return {
+                'concurrency': self.concurrency,
+                'queued': {priority: len(queue) for priority, queue in self.queues.items()},
+                'running': dict(self.running),
+                'served': dict(self.served),
+                'tenants_running': len(self.running_by_tenant),
+                'wait_p95_seconds': {priority: samples[max(0, math.ceil(0.95 * len(samples)) - 1)] if samples else 0.0
+                                     for priority, samples in waits.items()},
+            }
+
+    def log_report(self):
+        snapshot = self.snapshot()
+        if sum(snapshot['served'].values()):
+            waits = ", ".join(f"{priority} {seconds * 1000:.0f}ms" for priority, seconds in snapshot['wait_p95_seconds'].items())
+            logger.info(f"Scheduler: served {snapshot['served']}, p95 queue wait {waits}")
+
+
+scheduler = RequestScheduler()
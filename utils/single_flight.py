@@ -0,0 +1,72 @@
+import hashlib
+import json
+import threading
+from loguru import logger
+
+_flights = []
+
+
+def request_key(*parts):
+    # Canonical key of a request: equal for requests that only differ in dict ordering
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # Concurrent callers with the same key share one execution of the call: the first runs it,
+    # the rest wait for its result or exception. Nothing is cached once the call has finished.
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        _flights.append(self)
+
+    def do(self, key, function):
+        # Returns (result, shared); shared is True for callers that got another caller's result
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = _Call()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = function()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+        return call.result, False
+
+    def snapshot(self):
+        with self._lock:
+            return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._in_flight)}
+
+
+def flight_stats():
+    return {flight.name: flight.snapshot() for flight in _flights}
+
+
+def log_report():
+    for name, stats in flight_stats().items():
+        if stats['coalesced']:
+            logger.info(f"Single-flight {name}: {stats['coalesced']} of {stats['calls'] + stats['coalesced']} calls coalesced")
@@ -0,0 +1,61 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from agents.content_creator import GENERATION_FAILED
+from utils.scheduler import request_context, propagate, REFINEMENT
+
+
+class SpeculationStats:
+    def __init__(self):
+        self.started = 0
+        self.committed = 0
+        self.discarded = 0
+        self.seconds_saved = 0.0
+
+    def log_report(self):
+        if self.started:
+            logger.info(f"Speculative drafts: {self.started} started, {self.committed} committed, "
+                        f"{self.discarded} discarded, {self.seconds_saved:.1f}s of generation hidden behind user input")
+
+
+speculation_stats = SpeculationStats()
+
+
+class SpeculativeDraft:
+    # Drafts the next iteration in the background once the current one is stored with the
+    # user's ratings and the feedback analysis, while the user decides how to go on. It is
+    # the same call the next round would make, so it is used unless the user disagrees.
+    _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='speculation')
+
+    def __init__(self, creator, prompt):
+        self.generation_seconds = 0.0
+        self._future = self._executor.submit(propagate(self._draft), creator, prompt)
+        speculation_stats.started += 1
+
+    def _draft(self, creator, prompt):
+        start = time.perf_counter()
+        try:
+            with request_context(REFINEMENT):
+                return creator.create_content(prompt)
+        finally:
+            self.generation_seconds = time.perf_counter() - start
+
+    def take(self):
+        wait_start = time.perf_counter()
+        try:
+            content = self._future.result()
+        except Exception as e:
+            logger.error(f"Speculative draft failed: {e}")
+            content = None
+        waited = time.perf_counter() - wait_start
+        if not content or content == GENERATION_FAILED:
+            speculation_stats.discarded += 1
+            return None
+        speculation_stats.committed += 1
+        speculation_stats.seconds_saved += max(0.0, self.generation_seconds - waited)
+        return content
+
+    def discard(self):
+        # A draft already in flight cannot be interrupted; its result is simply dropped
+        self._future.cancel()
+        speculation_stats.discarded += 1
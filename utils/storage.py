@@ -0,0 +1,289 @@
+import hashlib
+import json
+import os
+import queue
+import re
+import sqlite3
+from contextlib import contextmanager
+from loguru import logger
+from config import STORAGE_BACKEND, POSTGRES_DSN, STORAGE_POOL_SIZE
+from utils.profiler import profiler
+
+ITERATION_COLUMNS = ('id', 'session_id', 'timestamp', 'prompt', 'content', 'ai_evaluation', 'user_evaluation_content',
+                     'user_feedback_evaluator', 'feedback_agent_analysis', 'total_score', 'embedding', 'usage',
+                     'content_hash', 'kind')
+JSON_COLUMNS = ('ai_evaluation', 'user_evaluation_content', 'feedback_agent_analysis', 'usage')
+
+
+def decode_iteration(row):
+    return {column: (json.loads(value) if column in JSON_COLUMNS and value else value) for column, value in row.items()}
+
+
+def schema_name(namespace):
+    # Readable prefix plus a hash of the exact name, so 'Alice' and 'alice' or 'a-b' and 'a_b'
+    # get separate schemas; stays within the 63-character identifier limit of Postgres
+    readable = re.sub(r'\W', '_', namespace).lower()[:40]
+    return f"{readable}_{hashlib.sha1(namespace.encode('utf-8')).hexdigest()[:12]}"
+
+
+class Storage:
+    # Iterations table behind a small pool of connections. Queries are written once with '?'
+    # placeholders and rows come back as dicts keyed by column name, whatever the backend.
+    placeholder = '?'
+
+    def __init__(self, pool_size=STORAGE_POOL_SIZE):
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _connect(self):
+        raise NotImplementedError
+
+    def _insert(self, cursor, query, params):
+        raise NotImplementedError
+
+    @contextmanager
+    def connection(self):
+        with profiler.stage('storage'):
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                try:
+                    self._pool.put_nowait(conn)
+                except queue.Full:
+                    conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _sql(self, query):
+        return query if self.placeholder == '?' else query.replace('?', self.placeholder)
+
+    def query(self, query, params=()):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(self._sql(query), params)
+            columns = [description[0] for description in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def execute(self, query, params=()):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(self._sql(query), params)
+            return cursor.rowcount
+
+    def find_iteration(self, content_hash, timestamp):
+        rows = self.query('SELECT id FROM iterations WHERE content_hash = ? AND timestamp = ?', (content_hash, timestamp))
+        return rows[0]['id'] if rows else None
+
+    def insert_iteration(self, values):
+        # values: column -> value, JSON columns already encoded; returns the new row id
+        columns = list(values)
+        query = f"INSERT INTO iterations ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        with self.connection() as conn:
+            return self._insert(conn.cursor(), self._sql(query), [values[column] for column in columns])
+
+    def iteration_texts(self, ids=None):
+        # (id, content) of rated iterations, optionally restricted to the given ids
+        if ids is None:
+            rows = self.query("SELECT id, content FROM iterations WHERE kind = 'iteration'")
+        elif not ids:
+            return []
+        else:
+            rows = self.query(f"SELECT id, content FROM iterations WHERE id IN ({','.join('?' * len(ids))})", list(ids))
+        return [(row['id'], row['content']) for row in rows]
+
+    def iterations_by_id(self, ids):
+        if not ids:
+            return {}
+        columns = ', '.join(column for column in ITERATION_COLUMNS if column != 'embedding')
+        rows = self.query(f"SELECT {columns} FROM iterations WHERE id IN ({','.join('?' * len(ids))})", list(ids))
+        return {row['id']: decode_iteration(row) for row in rows}
+
+    def rejected_candidates(self, session_id, prompt, limit):
+        return self.query('''
+            SELECT content, total_score FROM iterations
+            WHERE kind = 'rejected' AND session_id = ? AND prompt = ?
+            ORDER BY id DESC LIMIT ?
+        ''', (session_id, prompt, limit))
+
+    def usage_rows(self, session_id=None):
+        if session_id:
+            rows = self.query('SELECT usage FROM iterations WHERE session_id = ? AND usage IS NOT NULL', (session_id,))
+        else:
+            rows = self.query('SELECT usage FROM iterations WHERE usage IS NOT NULL')
+        return [json.loads(row['usage']) for row in rows]
+
+    def stream_iterations(self, columns=ITERATION_COLUMNS, chunk_size=5000, since_id=0):
+        # Keyset pagination: every chunk is its own short read, so a long export never holds
+        # a transaction open against the interactive writers
+        last_id = since_id
+        while True:
+            rows = self.query(f"SELECT {', '.join(columns)} FROM iterations WHERE id > ? ORDER BY id LIMIT ?", (last_id, chunk_size))
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1]['id']
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, db_path, pool_size=STORAGE_POOL_SIZE, read_only=False):
+        super().__init__(pool_size)
+        self.db_path = db_path
+        self.read_only = read_only
+
+    def _connect(self):
+        if self.read_only:
+            return sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+        return sqlite3.connect(self.db_path, check_same_thread=False)
+
+    def _insert(self, cursor, query, params):
+        cursor.execute(query, params)
+        return cursor.lastrowid
+
+    def init_schema(self):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS iterations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT,
+                    timestamp TEXT,
+                    prompt TEXT,
+                    content TEXT,
+                    ai_evaluation TEXT,
+                    user_evaluation_content TEXT,
+                    user_feedback_evaluator TEXT,
+                    feedback_agent_analysis TEXT,
+                    total_score REAL,
+                    embedding TEXT,
+                    usage TEXT,
+                    content_hash TEXT,
+                    kind TEXT DEFAULT 'iteration'
+                )
+            ''')
+            cursor.execute('PRAGMA table_info(iterations)')
+            columns = {row[1] for row in cursor.fetchall()}
+            for column in ('usage', 'content_hash'):
+                if column not in columns:
+                    logger.info(f"Adding {column} column to iterations table.")
+                    cursor.execute(f'ALTER TABLE iterations ADD COLUMN {column} TEXT')
+            if 'kind' not in columns:
+                # 'iteration' for rated iterations, 'rejected' for best-of-N candidates kept as negative examples
+                logger.info("Adding kind column to iterations table.")
+                cursor.execute("ALTER TABLE iterations ADD COLUMN kind TEXT DEFAULT 'iteration'")
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_iterations_content_hash ON iterations (content_hash)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_iterations_kind_session ON iterations (kind, session_id)')
+
+
+class PostgresStorage(Storage):
+    # One schema per memory database (per user in the API), named after the database file.
+    # A dsn of the form emulated://<directory> runs the same SQL against SQLite files through
+    # EmulatedPostgresConnection, to exercise this backend without a server.
+    placeholder = '%s'
+
+    def __init__(self, dsn, namespace, pool_size=STORAGE_POOL_SIZE):
+        super().__init__(pool_size)
+        self.dsn = dsn
+        self.namespace = schema_name(namespace)
+
+    def _connect(self):
+        if self.dsn.startswith('emulated://'):
+            directory = self.dsn[len('emulated://'):]
+            os.makedirs(directory, exist_ok=True)
+            return EmulatedPostgresConnection(os.path.join(directory, f"{self.namespace}.db"))
+        try:
+            import psycopg2
+        except ImportError as e:
+            raise RuntimeError("The postgres storage backend needs the psycopg2 package") from e
+        conn = psycopg2.connect(self.dsn)
+        with conn.cursor() as cursor:
+            cursor.execute(f'CREATE SCHEMA IF NOT EXISTS "{self.namespace}"')
+            cursor.execute(f'SET search_path TO "{self.namespace}"')
+        conn.commit()
+        return conn
+
+    def _insert(self, cursor, query, params):
+        cursor.execute(query + ' RETURNING id', params)
+        return cursor.fetchone()[0]
+
+    def init_schema(self):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS iterations (
+                    id BIGSERIAL PRIMARY KEY,
+                    session_id TEXT,
+                    timestamp TEXT,
+                    prompt TEXT,
+                    content TEXT,
+                    ai_evaluation TEXT,
+                    user_evaluation_content TEXT,
+                    user_feedback_evaluator TEXT,
+                    feedback_agent_analysis TEXT,
+                    total_score DOUBLE PRECISION,
+                    embedding TEXT,
+                    usage TEXT,
+                    content_hash TEXT,
+                    kind TEXT DEFAULT 'iteration'
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_iterations_content_hash ON iterations (content_hash)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_iterations_kind_session ON iterations (kind, session_id)')
+
+
+class _EmulatedCursor:
+    TRANSLATIONS = [
+        (re.compile(r'%s'), '?'),
+        (re.compile(r'\bBIGSERIAL PRIMARY KEY\b'), 'INTEGER PRIMARY KEY AUTOINCREMENT'),
+        (re.compile(r'\bDOUBLE PRECISION\b'), 'REAL'),
+    ]
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, params=()):
+        for pattern, replacement in self.TRANSLATIONS:
+            query = pattern.sub(replacement, query)
+        self._cursor.execute(query, params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class EmulatedPostgresConnection:
+    # The subset of a psycopg2 connection used by PostgresStorage, backed by SQLite
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self):
+        return _EmulatedCursor(self._conn.cursor())
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        self._conn.close()
+
+
+def open_storage(db_path, backend=STORAGE_BACKEND, read_only=False):
+    # db_path names the memory database; with the postgres backend it also keeps the
+    # derived SQLite tables (topics, calibration, score analytics) next to the application
+    if backend == 'postgres':
+        return PostgresStorage(POSTGRES_DSN, os.path.splitext(os.path.basename(db_path))[0])
+    if backend != 'sqlite':
+        raise ValueError(f"Unknown storage backend: {backend}")
+    return SQLiteStorage(db_path, read_only=read_only)
@@ -0,0 +1,72 @@
+import hashlib
+import math
+import random
+import re
+import time
+from types import SimpleNamespace
+from config import STUB_LLM_LATENCY
+from utils.guidelines import EVALUATION_CRITERIA
+
+# Offline stand-ins for the Perplexity and Cohere APIs, used for local load
+# testing and development without network access or API keys.
+
+
+def _stub_text(agent, messages):
+    prompt = messages[-1]['content'] if messages else ''
+    if agent == 'evaluator':
+        seed = int(hashlib.md5(prompt.encode('utf-8')).hexdigest(), 16)
+        rng = random.Random(seed)
+        return "\n".join(
+            f"{criterion}\nScore: {rng.randint(5, 10)}\nExplanation: Stub evaluation of {criterion.lower()}.\n- Stub suggestion."
+            for criterion in EVALUATION_CRITERIA
+        )
+    if agent == 'feedback':
+        creator_feedback = "\n".join(f"- {criterion}: 8/10. Stub feedback." for criterion in EVALUATION_CRITERIA)
+        return (
+            "### [###Overall Analysis###]\nStub overall analysis.\n\n"
+            f"### [###Feedback for Content Creator###]\n{creator_feedback}\n\n"
+            "### [###Feedback for Evaluator###]\nStub evaluator feedback.\n\n"
+            "### [###Improvements Needed###]\nNO. Stub responses never request improvements."
+        )
+    topic = re.search(r'Prompt: (.*)', prompt)
+    topic = topic.group(1) if topic else 'the requested topic'
+    return f"# {topic}\n\n## Introduction\nStub content about {topic}.\n\n## Conclusion\nStub conclusion."
+
+
+def stub_completion(model, messages, agent=None):
+    if STUB_LLM_LATENCY:
+        time.sleep(random.uniform(0.5, 1.5) * STUB_LLM_LATENCY)
+    content = _stub_text(agent, messages)
+    prompt_tokens = sum(len(message['content']) for message in messages) // 4
+    completion_tokens = len(content) // 4
+    return {
+        'model': model,
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        'usage': {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def _stub_vector(text, dimensions=64):
+    vector = [0.0] * dimensions
+    for token in re.findall(r'\w+', text.lower()):
+        vector[int(hashlib.md5(token.encode('utf-8')).hexdigest(), 16) % dimensions] += 1.0
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+class StubCohereClient:
+    def embed(self, texts, model=None, input_type=None):
+        return SimpleNamespace(embeddings=[_stub_vector(text) for text in texts])
+
+    def rerank(self, query, documents, top_n=5, model=None):
+        query_vector = _stub_vector(query)
+        scored = []
+        for index, document in enumerate(documents):
+            score = sum(a * b for a, b in zip(query_vector, _stub_vector(document)))
+            scored.append(SimpleNamespace(index=index, relevance_score=score))
+        scored.sort(key=lambda result: result.relevance_score, reverse=True)
+        return SimpleNamespace(results=scored[:top_n])
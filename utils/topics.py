@@ -0,0 +1,256 @@
+import json
+import math
+import re
+import sqlite3
+from collections import Counter
+from datetime import datetime
+from loguru import logger
+from config import TOPIC_SIMILARITY_THRESHOLD
+
+SUMMARY_CONTENT_CHARS = 500
+SUMMARY_THEME_TERMS = 50
+STOPWORDS = set("""
+a about above after again against all also am an and any are as at be because been before being below between both
+but by can could did do does doing down during each few for from further had has have having he her here hers him
+his how i if in into is it its itself just more most much my no nor not now of off on once only or other our ours
+out over own same she should so some such than that the their theirs them then there these they this those through
+to too under until up very was we were what when where which while who whom why will with would you your yours
+content evaluator feedback score criterion criteria improvement improvements needed overall analysis stub
+""".split())
+
+
+def normalize(vector):
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+def cosine(a, b):
+    return sum(x * y for x, y in zip(a, b))
+
+
+def feedback_terms(iteration):
+    texts = []
+    user_evaluation = iteration.get('user_evaluation_content') or {}
+    user_feedback = user_evaluation.get('feedback') if isinstance(user_evaluation, dict) else getattr(user_evaluation, 'feedback', None)
+    if isinstance(user_feedback, dict):
+        texts.extend(str(text) for text in user_feedback.values())
+    texts.append(str(iteration.get('user_feedback_evaluator') or ''))
+    analysis = iteration.get('feedback_agent_analysis')
+    if isinstance(analysis, dict):
+        texts.append(str(analysis.get('everything') or analysis.get('overall_analysis') or ''))
+    words = re.findall(r"[a-z][a-z'-]{2,}", " ".join(texts).lower())
+    return Counter(word for word in words if word not in STOPWORDS)
+
+
+def criterion_scores(iteration):
+    ai_scores = {}
+    evaluation = iteration.get('ai_evaluation')
+    if isinstance(evaluation, dict):
+        for criterion, details in evaluation.items():
+            if isinstance(details, dict) and isinstance(details.get('score'), (int, float)):
+                ai_scores[criterion] = float(details['score'])
+    user_evaluation = iteration.get('user_evaluation_content') or {}
+    user_scores = user_evaluation.get('score') if isinstance(user_evaluation, dict) else getattr(user_evaluation, 'score', None)
+    return ai_scores, dict(user_scores or {})
+
+
+class TopicIndex:
+    def __init__(self, db_path, threshold=TOPIC_SIMILARITY_THRESHOLD):
+        self.db_path = db_path
+        self.threshold = threshold
+        self._init_db()
+
+    def _init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS topic_clusters (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                centroid TEXT,
+                size INTEGER,
+                sample_prompt TEXT,
+                best_iteration_id INTEGER,
+                best_score REAL,
+                best_content TEXT,
+                score_totals TEXT,
+                feedback_terms TEXT,
+                updated_at TEXT
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS iteration_topics (
+                iteration_id INTEGER PRIMARY KEY,
+                cluster_id INTEGER
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def count(self):
+        conn = sqlite3.connect(self.db_path)
+        count = conn.execute('SELECT COUNT(*) FROM topic_clusters').fetchone()[0]
+        conn.close()
+        return count
+
+    def _load_centroids(self, cursor):
+        cursor.execute('SELECT id, centroid FROM topic_clusters')
+        return [(cluster_id, json.loads(centroid)) for cluster_id, centroid in cursor.fetchall()]
+
+    def _nearest(self, centroids, embedding):
+        best_id, best_similarity = None, -1.0
+        for cluster_id, centroid in centroids:
+            similarity = cosine(centroid, embedding)
+            if similarity > best_similarity:
+                best_id, best_similarity = cluster_id, similarity
+        return best_id, best_similarity
+
+    def add(self, iteration_id, embedding, iteration, total_score):
+        embedding = normalize(embedding)
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cluster_id, similarity = self._nearest(self._load_centroids(cursor), embedding)
+        if cluster_id is None or similarity < self.threshold:
+            cursor.execute(
+                'INSERT INTO topic_clusters (centroid, size, sample_prompt, score_totals, feedback_terms) VALUES (?, 0, ?, ?, ?)',
+                (json.dumps(embedding), iteration.get('prompt'), json.dumps({}), json.dumps({}))
+            )
+            cluster_id = cursor.lastrowid
+            logger.info(f"Created topic cluster {cluster_id} for iteration {iteration_id}")
+        self._merge(cursor, cluster_id, iteration_id, embedding, iteration, total_score)
+        conn.commit()
+        conn.close()
+        return cluster_id
+
+    def _merge(self, cursor, cluster_id, iteration_id, embedding, iteration, total_score):
+        cursor.execute(
+            'SELECT centroid, size, best_score, score_totals, feedback_terms FROM topic_clusters WHERE id = ?',
+            (cluster_id,)
+        )
+        centroid, size, best_score, score_totals, terms = cursor.fetchone()
+        centroid = json.loads(centroid)
+        if size:
+            centroid = normalize([(c * size + e) / (size + 1) for c, e in zip(centroid, embedding)])
+
+        totals = json.loads(score_totals)
+        ai_scores, user_scores = criterion_scores(iteration)
+        for source, scores in (('ai', ai_scores), ('user', user_scores)):
+            for criterion, score in scores.items():
+                entry = totals.setdefault(criterion, {}).setdefault(source, [0.0, 0])
+                entry[0] += score
+                entry[1] += 1
+
+        term_counts = Counter(json.loads(terms))
+        term_counts.update(feedback_terms(iteration))
+        term_counts = dict(term_counts.most_common(SUMMARY_THEME_TERMS))
+
+        cursor.execute('''
+            UPDATE topic_clusters SET centroid = ?, size = ?, score_totals = ?, feedback_terms = ?, updated_at = ?
+            WHERE id = ?
+        ''', (json.dumps(centroid), size + 1, json.dumps(totals), json.dumps(term_counts), datetime.now().isoformat(), cluster_id))
+        if best_score is None or (total_score or 0.0) > best_score:
+            cursor.execute(
+                'UPDATE topic_clusters SET best_iteration_id = ?, best_score = ?, best_content = ? WHERE id = ?',
+                (iteration_id, total_score, (iteration.get('content') or '')[:SUMMARY_CONTENT_CHARS], cluster_id)
+            )
+        cursor.execute('INSERT OR REPLACE INTO iteration_topics (iteration_id, cluster_id) VALUES (?, ?)', (iteration_id, cluster_id))
+
+    def rebuild(self, refinement_passes=1):
+        # Offline job: single-pass leader clustering over every stored embedding, then
+        # k-means style reassignment passes, then summaries recomputed from scratch
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, prompt, content, ai_evaluation, user_evaluation_content, user_feedback_evaluator,
+                   feedback_agent_analysis, total_score, embedding
+            FROM iterations WHERE embedding IS NOT NULL ORDER BY id
+        ''')
+        rows = []
+        for row in cursor.fetchall():
+            iteration = {
+                'prompt': row[1], 'content': row[2], 'ai_evaluation': json.loads(row[3]),
+                'user_evaluation_content': json.loads(row[4]), 'user_feedback_evaluator': row[5],
+                'feedback_agent_analysis': json.loads(row[6]),
+            }
+            rows.append((row[0], normalize(json.loads(row[8])), iteration, row[7]))
+
+        centroids = []
+        for _, embedding, _, _ in rows:
+            _, similarity = self._nearest(enumerate(centroids), embedding)
+            if not centroids or similarity < self.threshold:
+                centroids.append(embedding)
+
+        assignments = [0] * len(rows)
+        for _ in range(refinement_passes + 1):
+            for index, (_, embedding, _, _) in enumerate(rows):
+                assignments[index], _ = self._nearest(enumerate(centroids), embedding)
+            members = [[] for _ in centroids]
+            for index, cluster in enumerate(assignments):
+                members[cluster].append(rows[index][1])
+            centroids = [normalize([sum(values) / len(group) for values in zip(*group)]) if group else centroid
+                         for group, centroid in zip(members, centroids)]
+
+        cursor.execute('DELETE FROM topic_clusters')
+        cursor.execute('DELETE FROM iteration_topics')
+        cluster_ids = {}
+        for index, (iteration_id, embedding, iteration, total_score) in enumerate(rows):
+            cluster = assignments[index]
+            if cluster not in cluster_ids:
+                cursor.execute(
+                    'INSERT INTO topic_clusters (centroid, size, sample_prompt, score_totals, feedback_terms) VALUES (?, 0, ?, ?, ?)',
+                    (json.dumps(centroids[cluster]), iteration['prompt'], json.dumps({}), json.dumps({}))
+                )
+                cluster_ids[cluster] = cursor.lastrowid
+            self._merge(cursor, cluster_ids[cluster], iteration_id, embedding, iteration, total_score)
+        # _merge drifts centroids as a running mean; pin them to the refined ones
+        for cluster, cluster_id in cluster_ids.items():
+            cursor.execute('UPDATE topic_clusters SET centroid = ? WHERE id = ?', (json.dumps(centroids[cluster]), cluster_id))
+        conn.commit()
+        conn.close()
+        logger.info(f"Rebuilt {len(cluster_ids)} topic clusters from {len(rows)} iterations")
+        return len(cluster_ids), len(rows)
+
+    def relevant(self, query_embedding, top_n=3):
+        query_embedding = normalize(query_embedding)
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        similarities = [(cosine(centroid, query_embedding), cluster_id) for cluster_id, centroid in self._load_centroids(cursor)]
+        # Clusters the query would not even join are other topics; a prompt on a new topic gets no summaries
+        scored = sorted((item for item in similarities if item[0] >= self.threshold), reverse=True)[:top_n]
+        summaries = []
+        for similarity, cluster_id in scored:
+            cursor.execute('''
+                SELECT size, sample_prompt, best_iteration_id, best_score, best_content, score_totals, feedback_terms
+                FROM topic_clusters WHERE id = ?
+            ''', (cluster_id,))
+            size, sample_prompt, best_id, best_score, best_content, score_totals, terms = cursor.fetchone()
+            averages = {}
+            for criterion, sources in json.loads(score_totals).items():
+                averages[criterion] = {source: total / count for source, (total, count) in sources.items() if count}
+            summaries.append({
+                'cluster_id': cluster_id,
+                'similarity': similarity,
+                'size': size,
+                'sample_prompt': sample_prompt,
+                'best_iteration_id': best_id,
+                'best_score': best_score,
+                'best_content': best_content,
+                'average_scores': averages,
+                'feedback_themes': [term for term, _ in Counter(json.loads(terms)).most_common(8)],
+            })
+        conn.close()
+        return summaries
+
+
+def format_topic_summary(summary):
+    text = f"Topic (similarity {summary['similarity']:.2f}, {summary['size']} iterations), e.g. \"{summary['sample_prompt']}\"\n"
+    if summary['average_scores']:
+        text += "Average scores (AI / user):\n"
+        for criterion, scores in summary['average_scores'].items():
+            ai = f"{scores['ai']:.1f}" if 'ai' in scores else '-'
+            user = f"{scores['user']:.1f}" if 'user' in scores else '-'
+            text += f"- {criterion}: {ai} / {user}\n"
+    if summary['feedback_themes']:
+        text += f"Recurring feedback themes: {', '.join(summary['feedback_themes'])}\n"
+    if summary['best_content']:
+        text += f"Best-scoring content (score {summary['best_score']:.1f}):\n{summary['best_content']}\n"
+    return text
@@ -0,0 +1,135 @@
+import threading
+from collections import defaultdict
+import litellm
+from loguru import logger
+from config import SESSION_TOKEN_BUDGET, SESSION_COST_BUDGET, BUDGET_ACTION, BUDGET_DOWNGRADE_MODEL
+
+
+def _empty_totals():
+    return {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0, 'cost': 0.0}
+
+
+def _add_totals(target, source):
+    for key, value in source.items():
+        target[key] = target.get(key, 0) + value
+    return target
+
+
+def extract_usage(response):
+    usage = getattr(response, 'usage', None)
+    if usage is None and isinstance(response, dict):
+        usage = response.get('usage')
+    if usage is None:
+        return None
+
+    def field(name):
+        value = usage.get(name) if isinstance(usage, dict) else getattr(usage, name, None)
+        return int(value or 0)
+
+    prompt_tokens = field('prompt_tokens')
+    completion_tokens = field('completion_tokens')
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': field('total_tokens') or prompt_tokens + completion_tokens,
+    }
+
+
+def estimate_cost(response):
+    try:
+        return float(litellm.completion_cost(completion_response=response) or 0.0)
+    except Exception as e:
+        # Unknown models have no pricing entry; count their tokens but not their cost
+        logger.debug(f"Could not compute completion cost: {e}")
+        return 0.0
+
+
+class UsageTracker:
+    def __init__(self, token_budget=SESSION_TOKEN_BUDGET, cost_budget=SESSION_COST_BUDGET,
+                 action=BUDGET_ACTION, downgrade_model=BUDGET_DOWNGRADE_MODEL):
+        self.token_budget = token_budget
+        self.cost_budget = cost_budget
+        self.action = action
+        self.downgrade_model = downgrade_model
+        self._lock = threading.Lock()
+        self.reset_session()
+
+    def reset_session(self):
+        with self._lock:
+            self.session_totals = _empty_totals()
+            self.by_agent = defaultdict(_empty_totals)
+            self.by_model = defaultdict(_empty_totals)
+            self._pending = []
+
+    def record(self, agent, model, response):
+        tokens = extract_usage(response)
+        if tokens is None:
+            logger.warning(f"No usage data in response from {model}")
+            return None
+
+        entry = {'calls': 1, **tokens, 'cost': estimate_cost(response)}
+        agent = agent or 'unknown'
+        with self._lock:
+            _add_totals(self.session_totals, entry)
+            _add_totals(self.by_agent[agent], entry)
+            _add_totals(self.by_model[model], entry)
+            self._pending.append({'agent': agent, 'model': model, **entry})
+        logger.info(f"Usage [{agent}/{model}]: {entry['total_tokens']} tokens, ${entry['cost']:.6f}")
+        return entry
+
+    def drain(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        return summarize(pending)
+
+    def budget_exceeded(self):
+        with self._lock:
+            if self.token_budget and self.session_totals['total_tokens'] >= self.token_budget:
+                return True
+            if self.cost_budget and self.session_totals['cost'] >= self.cost_budget:
+                return True
+        return False
+
+    def apply_budget(self, model):
+        # None means the call must not be made
+        if not self.budget_exceeded():
+            return model
+        if self.action == 'downgrade' and self.downgrade_model:
+            if model != self.downgrade_model:
+                logger.warning(f"Session budget exceeded, downgrading {model} to {self.downgrade_model}")
+            return self.downgrade_model
+        logger.warning("Session budget exceeded, refusing further completions")
+        return None
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'total': dict(self.session_totals),
+                'by_agent': {k: dict(v) for k, v in self.by_agent.items()},
+                'by_model': {k: dict(v) for k, v in self.by_model.items()},
+            }
+
+
+def summarize(entries):
+    summary = {'total': _empty_totals(), 'by_agent': {}, 'by_model': {}}
+    for entry in entries:
+        totals = {k: entry[k] for k in _empty_totals()}
+        _add_totals(summary['total'], totals)
+        _add_totals(summary['by_agent'].setdefault(entry['agent'], _empty_totals()), totals)
+        _add_totals(summary['by_model'].setdefault(entry['model'], _empty_totals()), totals)
+    return summary
+
+
+def merge_summaries(summaries):
+    merged = {'total': _empty_totals(), 'by_agent': {}, 'by_model': {}}
+    for summary in summaries:
+        if not summary:
+            continue
+        _add_totals(merged['total'], summary.get('total', {}))
+        for group in ('by_agent', 'by_model'):
+            for key, totals in summary.get(group, {}).items():
+                _add_totals(merged[group].setdefault(key, _empty_totals()), totals)
+    return merged
+
+
+usage = UsageTracker()